@@ -1,49 +1,113 @@
 import logging
-from queue import Queue
 import sys
-import time
 
 VERSION = '0.1.0'
 
 import requests
 
-from halti_agent import comms, halti_agent_info
+from halti_agent import capacity, comms, halti_agent_info, logpipeline, metrics, settings
 from halti_agent import containers as container_client
+from halti_agent.heartbeat import HeartbeatEncoder
+from halti_agent.inventory import event_action, event_container_id
+from halti_agent.journal import StateJournal
+from halti_agent.mailbox import DesiredStateMailbox
+from halti_agent.prefetch import Prefetcher, prefetch_images
+from halti_agent.push import PushChannel, push_url
+from halti_agent.scheduler import HeartbeatScheduler
+from halti_agent.spool import Spool
 from halti_agent.state import load_state
 from halti_agent.statekeeper import StatekeeperWorker
 
 
 logger = logging.getLogger('halti-agent')
-desired_state_queue = Queue()
+desired_state_queue = DesiredStateMailbox()
+heartbeat_encoder = HeartbeatEncoder()
 
 
-def heartbeat():
-    """Perform a single Halti Heartbeat."""
+def heartbeat(statekeeper=None, capacity_reporter=None):
+    """Perform a single Halti Heartbeat, reporting statekeeper's readiness and backoffs."""
     logger.debug('Heartbeat!')
     try:
-        payload = {'containers': container_client.list_containers()}
-        return comms.heartbeat(payload)
+        payload = {'containers': container_client.list_containers(),
+                   'ready': statekeeper.ready.is_set() if statekeeper else True,
+                   'backoff': statekeeper.reconciler.failures.report() if statekeeper else {},
+                   'stats': container_client.stats_summary()}
+        node_capacity = capacity_reporter.report() if capacity_reporter else None
+        if node_capacity is not None:
+            payload['capacity'] = node_capacity
+        response = comms.heartbeat(heartbeat_encoder.encode(payload))
+        heartbeat_encoder.acknowledge(response)
+        if node_capacity is not None:
+            capacity_reporter.sent(node_capacity)
+        if response.get('resync') and capacity_reporter:
+            capacity_reporter.invalidate()
+        logger.debug('Heartbeat %s (%s): %s bytes, %s sent, encoded in %.4fs',
+                     heartbeat_encoder.stats['seq'], heartbeat_encoder.stats['mode'],
+                     comms.heartbeat_stats['raw_bytes'], comms.heartbeat_stats['sent_bytes'],
+                     comms.heartbeat_stats['encode_seconds'])
+        return response
     except requests.RequestException as e:
-        logger.error('Heartbeat failed: {}'.format(e))
+        logger.error('Heartbeat failed: %s', e)
         return None
 
 
-def main_loop(state, statekeeper):
-    """Check that statekeeper is running and perform Halti Heartbeats."""
+def register_gauges(statekeeper):
+    """Expose queue depths and counters kept by the agent's components as metrics."""
+    event_buffer = comms.event_buffer
+    pull_stats = container_client.pull_manager.stats
+    gauges = {
+        'desired_state_queue_depth': desired_state_queue.qsize,
+        'desired_states_dropped': lambda: desired_state_queue.dropped,
+        'desired_states_skipped': lambda: statekeeper.skipped,
+        'reconcile_pending_seconds': lambda: max(desired_state_queue.pending_seconds(),
+                                                 statekeeper.lag_seconds()),
+        'event_buffer_depth': event_buffer.qsize,
+        'event_send_failures': lambda: event_buffer.failed_attempts,
+        'events_rejected': lambda: event_buffer.rejected,
+        'events_dropped': lambda: event_buffer.dropped + (
+            event_buffer.spool.dropped if event_buffer.spool is not None else 0),
+        'heartbeat_raw_bytes': lambda: comms.heartbeat_stats['raw_bytes'],
+        'heartbeat_sent_bytes': lambda: comms.heartbeat_stats['sent_bytes'],
+        'heartbeat_encode_seconds': lambda: comms.heartbeat_stats['encode_seconds'],
+        'log_records_dropped': lambda: logpipeline.stats['dropped'],
+        'log_records_suppressed': lambda: logpipeline.stats['suppressed'],
+    }
+    for stat in pull_stats:
+        gauges['image_' + stat] = lambda stat=stat: pull_stats[stat]
+    log_shipper = container_client.log_shipper
+    if log_shipper is not None:
+        gauges['log_lines_dropped'] = log_shipper.dropped
+        gauges['log_followers'] = lambda: len(log_shipper.followers)
+        for stat in log_shipper.stats:
+            gauges['log_' + stat] = lambda stat=stat: log_shipper.stats[stat]
+    for name, fn in gauges.items():
+        metrics.gauge(name, fn)
+
+
+def main_loop(state, statekeeper, scheduler, prefetcher, capacity_reporter, push_channel=None):
+    """Check that statekeeper is running and perform Halti Heartbeats.
+
+    While push_channel delivers desired state, heartbeats deliver the last pushed
+    state again instead of their responses (the statekeeper skips it until it
+    is due for a resync).
+    """
     while statekeeper.is_alive():
-        hb = heartbeat()
+        hb = heartbeat(statekeeper, capacity_reporter)
         if hb:
-            desired_state_queue.put(hb)
-        time.sleep(state['heartbeat_interval'])
+            if push_channel is None or not push_channel.redeliver():
+                desired_state_queue.put(hb)
+            prefetcher.offer(prefetch_images(hb))
+        scheduler.wait()
 
     logger.error('Statekeeper has crashed. Exiting Halti-Agent.')
     sys.exit(-1)
 
 
 if __name__ == '__main__':
+    settings.configure_logging()
     logger.info('Starting Halti-Agent...')
-    logger.info('VERSION:'+VERSION)
-    logger.info('Information: {}'.format(halti_agent_info()))
+    logger.info('VERSION: %s', VERSION)
+    logger.info('Information: %s', halti_agent_info())
 
     # load state from STATE_FILE or Halti Master
     state = load_state(container_client)
@@ -51,10 +115,53 @@ if __name__ == '__main__':
     # save instance_id to a global so comms has access to it
     # this ID never mutates after this when the agent is running
     comms.INSTANCE_ID = state['instance_id']
-
-    statekeeper = StatekeeperWorker(desired_state_queue, container_client=container_client)
+    # replay events spooled while master was unreachable
+    comms.event_buffer.attach_spool(Spool(settings.EVENT_SPOOL_FILE, settings.EVENT_SPOOL_SIZE))
+    comms.event_buffer.wake()
+
+    inventory = container_client.start_inventory()
+    if settings.LOG_SHIP_ENABLED:
+        container_client.start_log_shipper()
+
+    journal = StateJournal(settings.STATE_JOURNAL_FILE, settings.STATE_JOURNAL_MAX_ENTRIES)
+    statekeeper = StatekeeperWorker(desired_state_queue, container_client=container_client,
+                                    journal=journal)
+    if settings.WARM_START:
+        statekeeper.warm_start(container_client.list_containers())
     statekeeper.daemon = True
     statekeeper.start()
 
+    if metrics.ENABLED:
+        register_gauges(statekeeper)
+        metrics.start_exporter()
+
+    scheduler = HeartbeatScheduler(state['heartbeat_interval'],
+                                   busy=statekeeper.reconciling.is_set)
+    inventory.add_listener(lambda event: scheduler.poke())
+
+    if settings.STATS_ENABLED:
+        container_client.start_stats_sampler()
+    if settings.IMAGE_GC_ENABLED:
+        container_client.start_image_gc(busy=statekeeper.reconciling.is_set)
+
+    prefetcher = Prefetcher(container_client.pull_manager, busy=statekeeper.reconciling.is_set)
+    prefetcher.start()
+
+    docker_root = container_client.docker_root_dir()
+    capacity_reporter = capacity.CapacityReporter(lambda: capacity.measure(
+        docker_root,
+        services=(journal.last_applied() or {}).get('services') or [],
+        stats=container_client.stats_summary()))
+
+    push_channel = None
+    if settings.PUSH_ENABLED:
+        def on_desired_state(desired_state):
+            desired_state_queue.put(desired_state)
+            prefetcher.offer(prefetch_images(desired_state))
+        push_channel = PushChannel(push_url(comms.INSTANCE_ID), on_desired_state)
+        inventory.add_listener(lambda event: push_channel.send_container_event(
+            event_container_id(event), event_action(event)))
+        push_channel.start()
+
     logger.info('Starting Halti-Agent main loop (health checks and heartbeat).')
-    main_loop(state, statekeeper)
+    main_loop(state, statekeeper, scheduler, prefetcher, capacity_reporter, push_channel)
@@ -0,0 +1,139 @@
+"""
+Synthetic fleets, fake clients and a stub Halti Master for benchmarks.
+
+The fakes follow the mock container client pattern of test/test_statekeeper.py:
+they record calls instead of talking to Docker.
+"""
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Thread
+import uuid
+
+
+def synthetic_service(i, version='v1'):
+    """Return a Halti Service with a few ports, envs and extra hosts."""
+    return {
+        'service_id': str(uuid.UUID(int=i)),
+        'name': 'service-{}'.format(i),
+        'version': version,
+        'instances': 1,
+        'ports': [{'protocol': 'tcp', 'port': 8000 + i % 100},
+                  {'protocol': 'udp', 'port': 9000 + i % 100, 'source': 20000 + i},
+                  '80'],
+        'memory': 128,
+        'cpu': 0.25,
+        'environment': [{'key': 'ENV_{}'.format(n), 'value': str(n)} for n in range(10)],
+        'extra_hosts': [{'host': 'db', 'ip': '10.0.0.{}'.format(i % 250)}],
+        'enabled': True,
+        'image': 'registry.example.com/service-{}:{}'.format(i % 50, version),
+    }
+
+
+def synthetic_container(service, container_id=None):
+    """Return a Docker container listing entry running service."""
+    name = service['service_id']
+    return {
+        'Ports': [{'PublicPort': 20000, 'PrivatePort': 8000, 'IP': '127.0.0.1', 'Type': 'tcp'}],
+        'NetworkSettings': {'Networks': {'bridge': {'IPAddress': '172.17.0.4',
+                                                    'Gateway': '172.17.0.1'}}},
+        'Command': 'java -jar app-standalone.jar',
+        'ImageID': 'sha256:' + '0' * 64,
+        'Labels': {'halti': 'true', 'service': service['name'], 'version': service['version']},
+        'Status': 'Up 49 minutes',
+        'Names': ['/' + name],
+        'Created': 1474885093,
+        'Mounts': [],
+        'Id': container_id or name.replace('-', ''),
+        'State': 'running',
+        'HostConfig': {'NetworkMode': 'default'},
+        'Image': service['image'],
+    }
+
+
+def synthetic_fleet(size, changed=0.1):
+    """Return (containers, services) where a fraction changed of services has a new version.
+
+    Every tenth service is new and every tenth container is no longer desired.
+    """
+    services = [synthetic_service(i) for i in range(size)]
+    containers = [synthetic_container(service) for i, service in enumerate(services)
+                  if i % 10 != 0]
+    containers += [synthetic_container(synthetic_service(size + i))
+                   for i in range(max(1, size // 10))]
+    for i in range(int(size * changed)):
+        services[i * 7 % size] = synthetic_service(i * 7 % size, version='v2')
+    return containers, services
+
+
+class FakeContainerClient(object):
+    """container_client that only counts calls."""
+
+    def __init__(self, containers):
+        self.containers = containers
+        self.stopped = self.pulled = self.started = 0
+
+    def list_containers(self):
+        return self.containers
+
+    def stop_and_remove(self, container_id):
+        self.stopped += 1
+
+    def pull_image(self, spec):
+        self.pulled += 1
+        return True
+
+    def start_container(self, spec, pull=True):
+        self.started += 1
+
+
+class FakeDockerClient(object):
+    """docker_client for containers.start_container that records created containers."""
+
+    def __init__(self):
+        self.created = 0
+
+    def create_host_config(self, **kwargs):
+        return dict(kwargs)
+
+    def create_container(self, **kwargs):
+        self.created += 1
+        return {'Id': 'c{}'.format(self.created)}
+
+    def start(self, container):
+        pass
+
+    def containers(self, filters=None):
+        return []
+
+
+class _StubMasterHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = b'{"services": []}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubMaster(object):
+    """Local Halti Master that answers every POST with an empty desired state."""
+
+    def __enter__(self):
+        self.server = _ThreadingHTTPServer(('127.0.0.1', 0), _StubMasterHandler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
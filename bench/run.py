@@ -0,0 +1,194 @@
+"""
+Benchmarks for the reconciliation and heartbeat hot paths.
+
+Usage:
+    python -m bench.run [--sizes 10,100,1000,10000] [--output results.json]
+                        [--compare baseline.json]
+
+Results are written as JSON: one record per (benchmark, fleet size) with
+throughput, latency percentiles and allocation counts. With --compare the
+median latencies are compared to an earlier result file.
+"""
+import argparse
+import json
+import logging
+import platform
+import sys
+import time
+import tracemalloc
+
+from halti_agent import __version__, comms, func_utils, settings
+from halti_agent.reconciler import Reconciler
+from halti_agent.statekeeper import current_and_desired, determine_container_actions, set_state
+
+from bench.fakes import (FakeContainerClient, FakeDockerClient, StubMaster,
+                         synthetic_fleet, synthetic_service)
+
+DEFAULT_SIZES = [10, 100, 1000, 10000]
+
+
+def percentile(samples, p):
+    """Return the p:th percentile (0-100) of sorted samples."""
+    index = min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))
+    return samples[index]
+
+
+def measure(fn, repeat, ops=1):
+    """Run fn repeat times. Returns a result dict, ops is the number of operations per call."""
+    fn()  # warm up
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    samples.sort()
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    fn()
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    allocations = sum(stat.count_diff for stat in after.compare_to(before, 'lineno')
+                      if stat.count_diff > 0)
+
+    return {
+        'repeat': repeat,
+        'ops_per_second': ops * repeat / sum(samples),
+        'latency_seconds': {
+            'min': samples[0],
+            'p50': percentile(samples, 50),
+            'p95': percentile(samples, 95),
+            'p99': percentile(samples, 99),
+            'max': samples[-1],
+        },
+        'allocations': allocations,
+        'peak_bytes': peak,
+    }
+
+
+def bench_diff(size):
+    containers, services = synthetic_fleet(size)
+    current, desired = current_and_desired(containers, services)
+    return lambda: func_utils.diff(current, desired), 1
+
+
+def bench_current_and_desired(size):
+    containers, services = synthetic_fleet(size)
+    return lambda: current_and_desired(containers, services), 1
+
+
+def bench_determine_container_actions(size):
+    containers, services = synthetic_fleet(size)
+    current, desired = current_and_desired(containers, services)
+    return lambda: determine_container_actions(current, desired), 1
+
+
+def bench_set_state(size):
+    containers, services = synthetic_fleet(size)
+    container_client = FakeContainerClient(containers)
+    reconciler = Reconciler()
+    desired_state = {'services': services}
+    return lambda: set_state(desired_state, container_client, reconciler), 1
+
+
+def bench_start_container(size):
+    from halti_agent import containers
+    containers.docker_client = FakeDockerClient()
+    specs = [synthetic_service(i) for i in range(size)]
+
+    def start_all():
+        for spec in specs:
+            containers.start_container(spec, pull=False)
+    return start_all, size
+
+
+def bench_encode_heartbeat(size):
+    containers, _ = synthetic_fleet(size)
+    payload = {'containers': containers}
+    return lambda: comms.encode_json(payload), 1
+
+
+def bench_post_heartbeat(size):
+    containers, _ = synthetic_fleet(size)
+    payload = {'containers': containers}
+    return lambda: comms.post_json(comms.HEARTBEAT_URL.format('bench'), payload), 1
+
+
+BENCHMARKS = [
+    ('func_utils.diff', bench_diff),
+    ('statekeeper.current_and_desired', bench_current_and_desired),
+    ('statekeeper.determine_container_actions', bench_determine_container_actions),
+    ('statekeeper.set_state', bench_set_state),
+    ('containers.start_container', bench_start_container),
+    ('comms.encode_json', bench_encode_heartbeat),
+    ('comms.post_json', bench_post_heartbeat),
+]
+
+
+def repeat_for(size):
+    """Fewer repeats for larger fleets to keep runs short."""
+    return max(5, min(200, 20000 // size))
+
+
+def run(sizes, names=None):
+    """Run benchmarks against a stub master and return the results document."""
+    results = []
+    with StubMaster() as master:
+        settings.HALTI_SERVER_URL = master.url
+        for name, setup in BENCHMARKS:
+            if names and name not in names:
+                continue
+            for size in sizes:
+                fn, ops = setup(size)
+                result = measure(fn, repeat_for(size), ops)
+                result.update(benchmark=name, size=size)
+                results.append(result)
+                print('{:<42} {:>6} {:>12.1f} ops/s  p50 {:.6f}s  p99 {:.6f}s'.format(
+                    name, size, result['ops_per_second'], result['latency_seconds']['p50'],
+                    result['latency_seconds']['p99']), file=sys.stderr)
+        comms.flush(timeout=10)
+    return {
+        'agent_version': __version__,
+        'python': platform.python_version(),
+        'created': time.time(),
+        'results': results,
+    }
+
+
+def compare(document, baseline):
+    """Print p50 latency change of each result against baseline."""
+    old = {(r['benchmark'], r['size']): r for r in baseline['results']}
+    for result in document['results']:
+        previous = old.get((result['benchmark'], result['size']))
+        if previous is None:
+            continue
+        ratio = result['latency_seconds']['p50'] / previous['latency_seconds']['p50']
+        print('{:<42} {:>6} {:>+8.1%}'.format(result['benchmark'], result['size'], ratio - 1))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--sizes', default=','.join(str(s) for s in DEFAULT_SIZES),
+                        help='comma separated fleet sizes')
+    parser.add_argument('--benchmark', action='append', help='run only the named benchmark(s)')
+    parser.add_argument('--output', help='write JSON results to this file (default: stdout)')
+    parser.add_argument('--compare', help='compare against an earlier JSON result file')
+    args = parser.parse_args(argv)
+    # per action log lines would dominate the measurements
+    logging.disable(logging.WARNING)
+
+    document = run([int(size) for size in args.sizes.split(',')], args.benchmark)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(document, output, indent=2)
+    elif not args.compare:
+        json.dump(document, sys.stdout, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(document, json.load(baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Startup benchmark: how long importing the agent takes.
+
+Usage:
+    python -m bench.startup [--repeat 10] [--budget 0.5]
+
+Every import runs in a fresh interpreter, so nothing is cached between runs.
+Imports must not talk to the Docker daemon or Halti Master, which makes the
+timings comparable on machines without either. Exits with status 1 if the
+median import time of the agent exceeds the budget (seconds).
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+from bench.run import percentile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ['halti_agent', 'halti_agent.containers', 'agent']
+
+
+def time_import(module, repeat):
+    """Return sorted wall times (seconds) of importing module in a new interpreter."""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.check_call([sys.executable, '-c', 'import ' + module], cwd=ROOT)
+        samples.append(time.perf_counter() - started)
+    return sorted(samples)
+
+
+def slowest_imports(module, count):
+    """Return [(cumulative microseconds, module name)] of the slowest imports of module."""
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                            cwd=ROOT, stderr=subprocess.PIPE, universal_newlines=True).stderr
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--budget', type=float, default=0.5,
+                        help='maximum median seconds to import the agent')
+    args = parser.parse_args(argv)
+
+    # an interpreter that imports nothing, subtracted from the results
+    baseline = percentile(time_import('sys', args.repeat), 50)
+    medians = {}
+    for module in MODULES:
+        medians[module] = percentile(time_import(module, args.repeat), 50) - baseline
+        print('{:<28} p50 {:.3f}s'.format(module, medians[module]))
+
+    print('\nslowest imports of agent:')
+    for cumulative, name in slowest_imports('agent', 10):
+        print('{:>10.3f}s  {}'.format(cumulative / 1e6, name))
+
+    if medians['agent'] > args.budget:
+        print('\nimporting agent took {:.3f}s, budget is {:.3f}s'.format(
+            medians['agent'], args.budget), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
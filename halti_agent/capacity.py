@@ -0,0 +1,117 @@
+"""
+capacity reports the node's live headroom so master can place services sensibly.
+
+A capacity report is built from cheap reads only: /proc/meminfo, getloadavg,
+statvfs of Docker's root dir, the desired services' reservations (the memory
+and cores their containers are limited to, see specs.reservation) and the usage
+percentiles of the stats sampler.
+
+CapacityReporter caches the report for settings.CAPACITY_INTERVAL seconds and
+hands it to the heartbeat only when a value has changed by more than
+settings.CAPACITY_THRESHOLD (relative) since it was last sent, or when the last
+report is older than settings.CAPACITY_MAX_AGE.
+"""
+import logging
+import os
+import time
+
+from halti_agent import settings
+from halti_agent.specs import reservation
+
+logger = logging.getLogger('halti-agent')
+
+
+def read_meminfo(path='/proc/meminfo'):
+    """Return /proc/meminfo as {field: bytes}."""
+    meminfo = {}
+    with open(path) as meminfo_file:
+        for line in meminfo_file:
+            key, _, value = line.partition(':')
+            parts = value.split()
+            if parts:
+                meminfo[key] = int(parts[0]) * (1024 if parts[1:] == ['kB'] else 1)
+    return meminfo
+
+
+def measure(path, services=(), stats=None):
+    """Return the capacity report of the node, Docker's root dir is at path."""
+    capacity = {'cpus': os.cpu_count()}
+    try:
+        meminfo = read_meminfo()
+        capacity['memory_total_bytes'] = meminfo.get('MemTotal', 0)
+        capacity['memory_available_bytes'] = meminfo.get('MemAvailable',
+                                                         meminfo.get('MemFree', 0))
+    except OSError:
+        pass
+    try:
+        for minutes, load in zip((1, 5, 15), os.getloadavg()):
+            capacity['load_average_{}m'.format(minutes)] = round(load, 2)
+    except OSError:
+        pass
+    try:
+        disk = os.statvfs(path)
+        capacity['disk_total_bytes'] = disk.f_blocks * disk.f_frsize
+        capacity['disk_free_bytes'] = disk.f_bavail * disk.f_frsize
+    except OSError:
+        pass
+
+    reservations = []
+    for service in services:
+        try:
+            reservations.append(reservation(service))
+        except (AttributeError, TypeError, ValueError) as ex:
+            # an invalid spec reserves nothing, it is not started
+            logger.warning('cannot measure the reservation of service %r: %s', service, ex)
+    capacity['reserved_memory_bytes'] = sum(memory for memory, _ in reservations)
+    capacity['reserved_cpus'] = round(sum(cpus for _, cpus in reservations), 2)
+    windows = (stats or {}).values()
+    capacity['used_memory_bytes'] = int(sum(
+        (window.get('memory_bytes') or {}).get('p50', 0) for window in windows))
+    capacity['used_cpus'] = round(sum(
+        (window.get('cpu_percent') or {}).get('p50', 0) for window in windows) / 100, 2)
+    return capacity
+
+
+def changed(old, new, threshold):
+    """Return True if any value of new differs from old by more than threshold (relative)."""
+    if set(old) != set(new):
+        return True
+    return any(abs(new[key] - old[key]) > threshold * max(abs(old[key]), 1) for key in new)
+
+
+class CapacityReporter(object):
+    """Cached capacity reports that are sent only when they change."""
+
+    def __init__(self, measure, threshold=None, interval=None, max_age=None):
+        """Init reporter, measure() returns a capacity report (see capacity.measure)."""
+        self._measure = measure
+        self.threshold = settings.CAPACITY_THRESHOLD if threshold is None else threshold
+        self.interval = settings.CAPACITY_INTERVAL if interval is None else interval
+        self.max_age = max_age or settings.CAPACITY_MAX_AGE
+        self._current = self._measured_at = None
+        self._sent = self._sent_at = None
+
+    def current(self):
+        """Return the latest capacity report, measuring again once it is interval old."""
+        now = time.monotonic()
+        if self._current is None or now - self._measured_at >= self.interval:
+            self._current = self._measure()
+            self._measured_at = now
+        return self._current
+
+    def report(self):
+        """Return the capacity report if it should be sent, otherwise None."""
+        capacity = self.current()
+        if (self._sent is None or time.monotonic() - self._sent_at >= self.max_age or
+                changed(self._sent, capacity, self.threshold)):
+            return capacity
+        return None
+
+    def sent(self, capacity):
+        """Mark capacity as received by master."""
+        self._sent = capacity
+        self._sent_at = time.monotonic()
+
+    def invalidate(self):
+        """Send the next report whether it has changed or not."""
+        self._sent = None
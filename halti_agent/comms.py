@@ -1,20 +1,37 @@
 """
 comms module handles communications with Halti Master.
 
-Currently a keep-alive HTTP connection and JSON is used but we should be able to
-change this to anything with minimal effort.
+Currently pooled keep-alive HTTP connections and JSON are used but we should be
+able to change this to anything with minimal effort.
+
+Every request has a timeout and is retried with jittered exponential backoff.
+Halti Events are buffered and sent in batches by a background thread, so
+callers never wait for Halti Master.
 """
+from collections import deque
+import gzip
 import json
 import logging
+import random
+from threading import Condition, Thread
+import time
+import zlib
+
 import requests
+from requests.adapters import HTTPAdapter
 
-from halti_agent import settings
+from halti_agent import metrics, settings
 
 logger = logging.getLogger('halti-agent-comms')
 
 s = requests.Session()
 s.headers.update({'Content-Type': 'application/json',
                   'Accept': 'application/json'})
+_adapter = HTTPAdapter(pool_connections=settings.COMMS_POOL_CONNECTIONS,
+                       pool_maxsize=settings.COMMS_POOL_MAXSIZE,
+                       pool_block=True)
+s.mount('http://', _adapter)
+s.mount('https://', _adapter)
 
 # store instance ID here so comms always has access to it
 INSTANCE_ID = None
@@ -23,20 +40,94 @@ INSTANCE_ID = None
 HEARTBEAT_URL = '/api/v1/instances/{}/heartbeat'
 REGISTER_URL = '/api/v1/instances/register'
 NOTIFY_URL = '/api/v1/instances/{}/notify'
+NOTIFY_BULK_URL = '/api/v1/instances/{}/notify/bulk'
+LOGS_URL = '/api/v1/instances/{}/logs'
 
 
-def post_json(url, payload):
-    """HTTP Post payload to given url with correct headers."""
+COMPRESSORS = {
+    'gzip': gzip.compress,
+    'deflate': zlib.compress,
+}
+
+# sizes and encode time of the latest heartbeat
+heartbeat_stats = {'raw_bytes': 0, 'sent_bytes': 0, 'encode_seconds': 0.0}
+
+
+def compress(body, compression=None):
+    """Compress body with compression ('gzip', 'deflate' or None).
+
+    Returns (body, headers) where headers contain the Content-Encoding if any.
+    """
+    if not compression:
+        return body, {}
+    return COMPRESSORS[compression](body), {'Content-Encoding': compression}
+
+
+def encode_json(payload, compression=None):
+    """Serialise payload, optionally compressed. Returns (body, headers)."""
+    return compress(json.dumps(payload).encode('utf-8'), compression)
+
+
+def backoff_delay(attempt, base=None, cap=None):
+    """Return seconds to wait before retry number attempt (0-based), with jitter."""
+    base = settings.COMMS_BACKOFF_BASE if base is None else base
+    cap = settings.COMMS_BACKOFF_CAP if cap is None else cap
+    delay = min(cap, base * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+
+def post_encoded(url, body, headers=None, retries=None):
+    """HTTP Post an already encoded JSON body to given url.
+
+    Connection errors, timeouts and 5xx responses are retried up to retries
+    times (default: settings.COMMS_RETRIES), after which the error is raised.
+    4xx responses raise requests.HTTPError at once.
+    """
     full_url = settings.HALTI_SERVER_URL + url
-    data = json.dumps(payload)
-    res_json = s.post(full_url, data=data).json()
-    logger.debug('received data: {}'.format(res_json))
+    endpoint = url.rsplit('/', 1)[-1]
+    retries = settings.COMMS_RETRIES if retries is None else retries
+    attempt = 0
+    while True:
+        try:
+            with metrics.timed('master_call_seconds', endpoint=endpoint):
+                res = s.post(full_url, data=body, headers=headers,
+                             timeout=settings.COMMS_TIMEOUT)
+            if res.status_code >= 500:
+                res.raise_for_status()
+            break
+        except requests.RequestException as ex:
+            metrics.inc('master_call_failures_total', endpoint=endpoint)
+            if attempt >= retries:
+                raise
+            delay = backoff_delay(attempt)
+            logger.warning('POST %s failed (%s), retrying in %.2fs', url, ex, delay)
+            time.sleep(delay)
+            attempt += 1
+    if res.status_code >= 400:
+        # master rejected the request, retrying it would not help
+        metrics.inc('master_call_failures_total', endpoint=endpoint)
+        res.raise_for_status()
+
+    res_json = res.json()
+    logger.debug('received data: %s', res_json)
     return res_json
 
 
+def post_json(url, payload, compression=None, retries=None):
+    """HTTP Post payload to given url with correct headers."""
+    body, headers = encode_json(payload, compression)
+    return post_encoded(url, body, headers, retries=retries)
+
+
 def heartbeat(payload):
     """Perform Halti Heartbeat with Halti Master."""
-    return post_json(HEARTBEAT_URL.format(INSTANCE_ID), payload)
+    started = time.monotonic()
+    raw = json.dumps(payload).encode('utf-8')
+    body, headers = compress(raw, settings.HEARTBEAT_COMPRESSION)
+    heartbeat_stats.update(raw_bytes=len(raw),
+                           sent_bytes=len(body),
+                           encode_seconds=time.monotonic() - started)
+    return post_encoded(HEARTBEAT_URL.format(INSTANCE_ID), body, headers)
 
 
 def register(payload):
@@ -44,12 +135,182 @@ def register(payload):
     return post_json(REGISTER_URL, payload)
 
 
+def ship_logs(lines):
+    """Send a batch of container log lines (see logship), gzipped and without retries."""
+    return post_json(LOGS_URL.format(INSTANCE_ID), {'lines': lines}, compression='gzip',
+                     retries=0)
+
+
+def is_rejection(ex):
+    """Return True if ex is a 4xx response, master will not accept the request later either."""
+    response = getattr(ex, 'response', None)
+    return response is not None and 400 <= response.status_code < 500
+
+
 def notify_master(event, meta):
-    """Notify master with an Halti Event."""
-    try:
-        return post_json(NOTIFY_URL.format(INSTANCE_ID), halti_event(event, meta))
-    except requests.RequestException as ex:
-        logger.error('could not notify master: {}'.format(ex), exc_info=True)
+    """Notify master with an Halti Event. Does not wait for the event to be sent."""
+    message = halti_event(event, meta)
+    metrics.inc('halti_events_total', event=event, event_type=message['event_type'])
+    event_buffer.put(message)
+
+
+def flush(timeout=None):
+    """Wait until all buffered events have been sent. Returns False on timeout."""
+    return event_buffer.flush(timeout)
+
+
+class EventBuffer(Thread):
+    """Buffer of Halti Events that a background thread sends to master in order.
+
+    Events are sent in batches of up to batch_size events, waiting at most window
+    seconds for a batch to fill. A failed batch is retried with backoff. While
+    master cannot be reached, buffered events are spilled to spool (if given) and
+    replayed oldest first once master is reachable again. Without a spool the
+    oldest events are dropped when the buffer is full.
+
+    Batches go to the bulk endpoint. If master responds to it with 404 (an older
+    master), events are sent one by one from then on. A batch master rejects
+    otherwise (4xx) is sent one by one, and the events master rejects are
+    dropped: sending them again would not help.
+    """
+
+    def __init__(self, batch_size=None, window=None, maxlen=None, spool=None):
+        """Init an empty buffer, the thread is started by wake or put."""
+        Thread.__init__(self)
+        self.daemon = True
+        self.batch_size = batch_size or settings.NOTIFY_BATCH_SIZE
+        self.window = settings.NOTIFY_BATCH_WINDOW if window is None else window
+        self.spool = spool
+        self._cond = Condition()
+        self._events = deque()
+        self._maxlen = maxlen or settings.EVENT_BUFFER_SIZE
+        self._sending = False
+        self.bulk = self.batch_size > 1
+        self.sent = self.batches = self.dropped = self.rejected = self.failed_attempts = 0
+
+    def attach_spool(self, spool):
+        """Spool events to spool while master cannot be reached."""
+        with self._cond:
+            self.spool = spool
+
+    def wake(self):
+        """Start sending (e.g. events spooled by a previous run)."""
+        with self._cond:
+            if not self.is_alive():
+                self.start()
+            self._cond.notify_all()
+
+    def put(self, event):
+        """Queue an event to be sent."""
+        with self._cond:
+            if len(self._events) >= self._maxlen:
+                if self.spool is not None:
+                    self._spill()
+                else:
+                    self._events.popleft()
+                    self.dropped += 1
+            self._events.append(event)
+        self.wake()
+
+    def qsize(self):
+        """Return the number of events waiting to be sent."""
+        with self._cond:
+            return len(self._events) + len(self.spool or ())
+
+    def flush(self, timeout=None):
+        """Block until every queued event is sent. Returns False on timeout."""
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not self._events and not self.spool and not self._sending, timeout)
+
+    def send(self, batch):
+        """Send a batch of events, return (events done, error or None).
+
+        The first events done of batch have been sent or rejected by master
+        (4xx, counted in self.rejected) and must not be sent again. error is the
+        requests.RequestException (connection error, timeout or 5xx) that stopped
+        the rest from being sent.
+        """
+        if self.bulk:
+            try:
+                post_json(NOTIFY_BULK_URL.format(INSTANCE_ID), {'events': batch}, retries=0)
+                return len(batch), None
+            except ValueError as ex:
+                # master received the events but did not respond with JSON
+                logger.warning('invalid response from master: %s', ex)
+                return len(batch), None
+            except requests.RequestException as ex:
+                if not is_rejection(ex):
+                    return 0, ex
+                if ex.response.status_code == 404:
+                    logger.warning('master does not support bulk events, sending one by one')
+                    self.bulk = False
+                # else one by one, so only the events master rejects are dropped
+        for done, event in enumerate(batch):
+            try:
+                post_json(NOTIFY_URL.format(INSTANCE_ID), event, retries=0)
+            except ValueError as ex:
+                logger.warning('invalid response from master: %s', ex)
+            except requests.RequestException as ex:
+                if not is_rejection(ex):
+                    return done, ex
+                logger.error('master rejected event %s, dropping it: %s', event.get('event'), ex)
+                metrics.inc('halti_events_rejected_total', event=event.get('event'))
+                self.rejected += 1
+        return len(batch), None
+
+    def _spill(self):
+        """Move buffered events to the spool, must hold self._cond."""
+        self.spool.extend(self._events)
+        self._events.clear()
+
+    def _next_batch(self):
+        """Wait for and return ('spool' or 'memory', events), must hold self._cond."""
+        if self.spool:
+            return 'spool', self.spool.peek(self.batch_size)
+        self._cond.wait_for(lambda: self._events or self.spool)
+        if self.spool:
+            return 'spool', self.spool.peek(self.batch_size)
+        self._cond.wait_for(lambda: len(self._events) >= self.batch_size, self.window)
+        return 'memory', list(self._events)[:self.batch_size]
+
+    def run(self):
+        """Send events forever."""
+        attempt = 0
+        while True:
+            with self._cond:
+                source, batch = self._next_batch()
+                self._sending = True
+            rejected = self.rejected
+            done, error = self.send(batch)
+
+            with self._cond:
+                if source == 'spool':
+                    self.spool.pop(done)
+                else:
+                    # events may have been dropped or spilled while being sent
+                    for event in batch[:done]:
+                        if self._events and self._events[0] is event:
+                            self._events.popleft()
+                self.sent += done - (self.rejected - rejected)
+                self.batches += 1 if done else 0
+                if error is not None and self.spool is not None:
+                    self._spill()
+                self._sending = False
+                self._cond.notify_all()
+
+            if error is None:
+                attempt = 0
+                continue
+            delay = backoff_delay(attempt)
+            logger.error('could not notify master: %s, retrying in %.2fs', error, delay)
+            self.failed_attempts += 1
+            attempt += 1
+            time.sleep(delay)
+
+
+# the agent attaches a Spool of settings.EVENT_SPOOL_FILE at startup
+event_buffer = EventBuffer()
 
 
 class Events(object):
@@ -59,6 +320,7 @@ class Events(object):
     START_CONTAINER = 'START_CONTAINER'
     START_CONTAINER_FAILED = 'START_CONTAINER_FAILED'
     STOP_CONTAINER = 'STOP_CONTAINER'
+    AGENT_READY = 'AGENT_READY'
 
 
 def halti_event(event, meta=''):
@@ -4,109 +4,520 @@ Containers module uses and abstracts away the docker_client.
 There are currently no plans to support other containers than Docker,
 but we try keep this as a possibility.
 """
+import json
 import logging
+import re
+import socket
+import time
+from threading import Lock
 
-from halti_agent import comms, settings
-from halti_agent.func_utils import env_pairs_to_dict
+from halti_agent import comms, metrics, settings
+from halti_agent.cpusets import CpusetAllocator, CpusetError
+from halti_agent.imagegc import ImageCollector, disk_usage
+from halti_agent.inventory import ContainerInventory
+from halti_agent.journal import write_atomic
+from halti_agent.logship import LogShipper, create_sink
+from halti_agent.pulls import PullManager
+from halti_agent.specs import SpecCompiler, SpecError, binds_host_ports, update_strategy
+from halti_agent.stats import StatsSampler
 
 from docker import Client
-from docker.errors import DockerException, APIError
+from docker.errors import DockerException, APIError, NotFound
 
 logger = logging.getLogger('halti-agent')
 
-logger.info('starting docker client with {}'.format(settings.DOCKER_OPTIONS))
-docker_client = Client(**settings.DOCKER_OPTIONS)
+# created on first use by get_docker_client, may be replaced (e.g. in tests)
+docker_client = None
+_docker_client_lock = Lock()
+
+# name suffix of a new container started next to the old one during a rolling update
+SURGE_SUFFIX = '-next'
+
+# ContainerInventory, set by start_inventory
+inventory = None
+# ImageCollector, set by start_image_gc
+image_collector = None
+# StatsSampler, set by start_stats_sampler
+stats_sampler = None
+# LogShipper, set by start_log_shipper
+log_shipper = None
+# set by docker_root_dir
+docker_root = None
+
+# the daemon's answer to a client whose API version it does not support
+VERSION_REJECTED = re.compile(r'client version \S+ is too (new|old)|client is newer than server',
+                              re.IGNORECASE)
+
+
+def load_api_versions():
+    """Return the cached API versions as {daemon base_url: version}."""
+    try:
+        with open(settings.DOCKER_VERSION_CACHE) as cache_file:
+            versions = json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+    return versions if isinstance(versions, dict) else {}
+
+
+def load_api_version(base_url):
+    """Return the API version negotiated with the daemon at base_url earlier, or None."""
+    return load_api_versions().get(base_url)
+
+
+def save_api_version(base_url, version):
+    """Remember the API version negotiated with the daemon at base_url, None forgets it."""
+    versions = load_api_versions()
+    if version is None:
+        versions.pop(base_url, None)
+    else:
+        versions[base_url] = version
+    try:
+        write_atomic(settings.DOCKER_VERSION_CACHE, json.dumps(versions))
+    except OSError as ex:
+        logger.warning('caching Docker API version failed: %s', ex)
+
+
+def renegotiate_if_rejected(client, base_url, response):
+    """Drop client and the API version cached for base_url if the daemon rejected it.
+
+    The request fails as before, the next get_docker_client negotiates again
+    (e.g. after the daemon was downgraded or dropped an old API version).
+    """
+    global docker_client
+    if response.status_code != 400 or not VERSION_REJECTED.search(response.text):
+        return
+    logger.warning('Docker daemon rejected API version %s, negotiating again: %s',
+                   client.api_version, response.text.strip())
+    with _docker_client_lock:
+        save_api_version(base_url, None)
+        if docker_client is client:
+            docker_client = None
+
+
+def create_docker_client():
+    """Create a Docker client, negotiating the API version only if it is not cached.
+
+    A negotiated version is negotiated again once the daemon rejects it, see
+    renegotiate_if_rejected.
+    """
+    options = settings.docker_options()
+    base_url = options.get('base_url') or 'default'
+    negotiate = options.get('version') == 'auto'
+    if negotiate:
+        cached = load_api_version(base_url)
+        if cached is not None:
+            logger.info('using cached Docker API version %s', cached)
+            options = dict(options, version=cached)
+            negotiate = False
+
+    logger.info('starting docker client with %s', options)
+    client = Client(**options)
+    if negotiate:
+        save_api_version(base_url, client.api_version)
+    hooks = getattr(client, 'hooks', None)
+    if settings.docker_options().get('version') == 'auto' and hooks is not None:
+        hooks['response'].append(lambda response, *args, **kwargs: renegotiate_if_rejected(
+            client, base_url, response))
+    return client
+
+
+def get_docker_client():
+    """Return the shared Docker client, creating it on first use."""
+    global docker_client
+    if docker_client is None:
+        with _docker_client_lock:
+            if docker_client is None:
+                docker_client = create_docker_client()
+    return docker_client
+
+
+def poll_containers(filters=None, stopped=False):
+    """List running (all if stopped) containers managed by Halti from the Docker daemon."""
+    with metrics.timed('docker_call_seconds', call='containers'):
+        return get_docker_client().containers(all=stopped,
+                                              filters=dict(filters or {}, label='halti'))
+
+
+def container_events(since, until):
+    """Yield Docker events of containers managed by Halti."""
+    return get_docker_client().events(since=since, until=until, decode=True,
+                                      filters={'label': 'halti', 'type': 'container'})
+
+
+def start_inventory():
+    """Start keeping an event-fed inventory used by list_containers."""
+    global inventory
+    inventory = ContainerInventory(poll=poll_containers, events=container_events)
+    inventory.daemon = True
+    inventory.start()
+    return inventory
+
+
+def refresh_inventory(container_id):
+    """Update inventory right after this agent changed a container."""
+    if inventory is not None:
+        inventory.refresh(container_id)
 
 
 def list_containers():
     """Return containers managed by Halti."""
-    return docker_client.containers(filters={'label': 'halti'})
+    if inventory is not None and inventory.is_synced():
+        return inventory.containers()
+    return poll_containers()
+
+
+def container_stats(container_id):
+    """Return a single Docker stats sample of a container."""
+    with metrics.timed('docker_call_seconds', call='stats'):
+        return get_docker_client().stats(container_id, stream=False)
+
+
+def start_stats_sampler():
+    """Start sampling resource usage of Halti containers, see stats_summary."""
+    global stats_sampler
+    stats_sampler = StatsSampler(list_containers=list_containers,
+                                 stats=lambda container_id: container_stats(container_id))
+    stats_sampler.start()
+    return stats_sampler
+
+
+def stats_summary():
+    """Return resource usage percentiles of Halti containers by name, {} if not sampled."""
+    if stats_sampler is None:
+        return {}
+    return stats_sampler.summary()
 
 
 def stop_and_remove(container_id):
     """Stop and remove the provided container."""
-    docker_client.stop(container_id)
-    docker_client.remove_container(container_id)
+    with metrics.timed('docker_call_seconds', call='stop'):
+        get_docker_client().stop(container_id)
+    with metrics.timed('docker_call_seconds', call='remove_container'):
+        get_docker_client().remove_container(container_id)
+    refresh_inventory(container_id)
 
 
 def pull_container(image):
-    """Pull a container. Relays image to docker_client.pull."""
-    docker_client.pull(image, insecure_registry=settings.ALLOW_INSECURE_REGISTRY)
+    """Pull a container. Relays image to docker_client.pull.
+
+    Returns the number of bytes downloaded.
+    """
+    layers = {}
+    with metrics.timed('docker_call_seconds', call='pull'):
+        progress = get_docker_client().pull(
+            image, insecure_registry=settings.ALLOW_INSECURE_REGISTRY, stream=True, decode=True)
+        for status in progress:
+            # a streamed pull reports failures in the stream instead of raising
+            if 'error' in status:
+                raise DockerException(status['error'])
+            detail = status.get('progressDetail') or {}
+            if detail.get('total'):
+                layers[status.get('id')] = detail['total']
+    metrics.inc('pulled_bytes_total', sum(layers.values()))
+    return sum(layers.values())
+
+
+def inspect_image(image):
+    """Return Docker's image dict or None if image is not available locally."""
+    try:
+        with metrics.timed('docker_call_seconds', call='inspect_image'):
+            return get_docker_client().inspect_image(image)
+    except NotFound:
+        return None
+
+
+# look functions up on call so they can be replaced (e.g. in tests)
+pull_manager = PullManager(pull=lambda image: pull_container(image),
+                           inspect=lambda image: inspect_image(image))
+
+
+def remove_image(image):
+    """Remove an image (tag) from the Docker daemon."""
+    with metrics.timed('docker_call_seconds', call='remove_image'):
+        get_docker_client().remove_image(image)
+
+
+def docker_root_dir():
+    """Return the directory Docker stores images and containers in (settings.IMAGE_GC_PATH)."""
+    global docker_root
+    if docker_root is None:
+        docker_root = (settings.IMAGE_GC_PATH or
+                       get_docker_client().info().get('DockerRootDir', '/var/lib/docker'))
+    return docker_root
+
+
+def start_image_gc(busy=None):
+    """Start removing unused images under disk pressure, busy() postpones collection."""
+    global image_collector
+    path = docker_root_dir()
+    logger.info('collecting images when %s is %.0f%% full', path,
+                settings.IMAGE_GC_HIGH_WATERMARK * 100)
+    image_collector = ImageCollector(remove_image=lambda image: remove_image(image),
+                                     disk_usage=lambda: disk_usage(path),
+                                     pull_manager=pull_manager, busy=busy)
+    image_collector.start()
+    return image_collector
+
+
+def container_logs(container_id, since=None):
+    """Yield chunks of a container's stdout/stderr with timestamps until it stops."""
+    return get_docker_client().logs(container_id, stream=True, follow=True, timestamps=True,
+                                    since=since)
 
 
-def start_container(spec):
-    """Start a Docker container as per the given spec (= Halti Service)"""
+def start_log_shipper():
+    """Start shipping the logs of Halti containers to settings.LOG_SHIP_SINK."""
+    global log_shipper
+    log_shipper = LogShipper(list_containers=list_containers,
+                             logs=lambda container_id, since: container_logs(container_id, since),
+                             sink=create_sink())
+    log_shipper.start()
+    return log_shipper
+
+
+def track_images(services):
+    """Tell the image collector which images the desired services use."""
+    if image_collector is not None:
+        image_collector.track(services)
+
+
+def pull_image(spec):
+    """Pull the image of the given spec (= Halti Service), notifying master.
+
+    The spec may set 'pull_policy' (see pulls.POLICIES).
+    Returns True if the image is ready to be started.
+    """
     comms.notify_master(comms.Events.PULL_START, spec['image'])
     try:
-        pull_container(spec['image'])
+        pull_manager.ensure(spec['image'], spec.get('pull_policy', settings.PULL_POLICY))
     except DockerException as ex:
-        logger.error('DockerException: pulling image. {}'.format(ex), exc_info=True)
+        logger.error('DockerException: pulling image. %s', ex, exc_info=True)
         comms.notify_master(comms.Events.PULL_FAILED, str(ex))
-        return
+        return False
+    return True
+
 
-    env = env_pairs_to_dict(spec['environment'])
-    env['HALTI_SERVICE_ID'] = spec['service_id']
+spec_compiler = SpecCompiler(
+    create_host_config=lambda **kwargs: get_docker_client().create_host_config(**kwargs))
 
-    ports = {}
-    ports_declaration = []
+# assigns cores to services with exclusive_cpus, None if settings.CPUSET_POOL is not set
+cpuset_allocator = CpusetAllocator(settings.CPUSET_POOL) if settings.CPUSET_POOL else None
 
-    for port in spec['ports']:
 
-        is_digit = lambda port: hasattr(port, 'isdigit') and port.isdigit()
+def assign_cpuset(params, owner):
+    """Return the cpuset to pin a container of params to or None, raises CpusetError."""
+    if not params.exclusive_cpus:
+        return None
+    if cpuset_allocator is None:
+        logger.warning('%s asks for exclusive CPUs but CPUSET_POOL is not set', owner)
+        return None
+    # stopped containers keep their cores, the restart policy starts them again
+    return cpuset_allocator.allocate(owner, params.exclusive_cpus,
+                                     lambda: poll_containers(stopped=True))
+
+
+def start_container(spec, pull=True):
+    """Start a Docker container as per the given spec (= Halti Service)
+
+    Set pull=False if the image has already been pulled with pull_image.
+    Returns True if the container was started.
+    """
+    if pull and not pull_image(spec):
+        return False
+
+    try:
+        params = spec_compiler.compile(spec)
+    except SpecError as ex:
+        logger.error('%s', ex)
+        comms.notify_master(comms.Events.START_CONTAINER_FAILED, str(ex))
+        return False
 
-        if type(port) is int or is_digit(port):
-            # for backwards compatibility
-            ports_declaration.append(port)
-            ports[int(port)] = (settings.PORT_BIND_IP,)
-        else:
-            # port, protocol = port['port'], port['protocol']
-            k = '{}/{}'.format(port['port'], port['protocol'])
-            if port['protocol'] == 'udp':
-                ports_declaration.append((port['port'], 'udp'))
+    return create_and_start(params, spec['service_id']) is not None
+
+
+def create_and_start(params, service_id, name=None):
+    """Create and start a container of compiled params, return its ID or None on failure."""
+    owner = name or params.name
+    container = None
+    try:
+        cpuset = assign_cpuset(params, owner)
+        with metrics.timed('docker_call_seconds', call='create_container'):
+            container = get_docker_client().create_container(
+                **params.create_kwargs(name, cpuset=cpuset))
+
+        comms.notify_master(comms.Events.START_CONTAINER, service_id)
+        with metrics.timed('docker_call_seconds', call='start'):
+            get_docker_client().start(container=container.get('Id'))
+        refresh_inventory(container.get('Id'))
+    except CpusetError as ex:
+        logger.error('%s', ex)
+        comms.notify_master(comms.Events.START_CONTAINER_FAILED, str(ex))
+        return None
+    except APIError as ex:
+        logger.error('Docker API Error: starting container. %s', ex, exc_info=True)
+        comms.notify_master(comms.Events.START_CONTAINER_FAILED, str(ex))
+        return None
+    finally:
+        if cpuset_allocator is not None:
+            if container is None:
+                cpuset_allocator.release(owner)
             else:
-                ports_declaration.append(port['port'])
+                cpuset_allocator.created(owner)
+    return container.get('Id')
+
+
+def remove_container(container_id):
+    """Remove a container whether it is running or not."""
+    try:
+        with metrics.timed('docker_call_seconds', call='remove_container'):
+            get_docker_client().remove_container(container_id, force=True)
+    except NotFound:
+        pass
+    refresh_inventory(container_id)
+
+
+def container_ip(container_info):
+    """Return the IP address of an inspected container on its first network, or None."""
+    network = container_info.get('NetworkSettings') or {}
+    if network.get('IPAddress'):
+        return network['IPAddress']
+    for settings_of_network in (network.get('Networks') or {}).values():
+        if (settings_of_network or {}).get('IPAddress'):
+            return settings_of_network['IPAddress']
+    return None
 
-            if 'source' in port:
-                ports[k] = (settings.PORT_BIND_IP, port['source'])
+
+def published_ports(container_info):
+    """Return [(ip, port)] to probe the TCP ports an inspected container publishes at.
+
+    Ports bound to all addresses are probed at settings.PORT_BIND_IP, the agent
+    may run in a container of its own where 127.0.0.1 is not the host. If that
+    is a wildcard too, the container's own address and port are probed.
+    """
+    ports = (container_info.get('NetworkSettings') or {}).get('Ports') or {}
+    own_ip = container_ip(container_info)
+    published = []
+    for port, bindings in ports.items():
+        if not port.endswith('/tcp'):
+            continue
+        for binding in bindings or []:
+            ip = binding.get('HostIp')
+            if not ip or ip == '0.0.0.0':
+                ip = settings.PORT_BIND_IP
+            if ip and ip != '0.0.0.0':
+                published.append((ip, int(binding['HostPort'])))
+            elif own_ip:
+                published.append((own_ip, int(port.split('/')[0])))
             else:
-                ports[k] = (settings.PORT_BIND_IP,)
-
-    labels = {'halti': 'true',
-              'service': spec['name'],
-              'version': spec['version']}
-
-    # Extract extra hosts
-    extra_hosts = None
-    if 'extra_hosts' in spec:
-        logger.info('Extra hosts defined in spec {}'.format(spec['name']))
-        extra_hosts = {}
-        for host in spec['extra_hosts']:
-            extra_hosts[host['host']] = host['ip']
-
-    host_conf = docker_client.create_host_config(
-        restart_policy={'Name': 'always'},
-        extra_hosts=extra_hosts,
-        port_bindings=ports
-    )
-
-    container_params = {
-            "image": spec['image'],
-            "name": spec['service_id'],
-            "ports": ports_declaration,
-            "environment": env,
-            "labels": labels,
-            "host_config": host_conf
-    }
-    if 'command' in spec and len(spec.get('command')) > 0:
-        logger.info('Command defined in spec {}'.format(spec['name']))
-        container_params['command'] = spec.get('command')
+                published.append(('127.0.0.1', int(binding['HostPort'])))
+    return published
+
+
+def port_open(ip, port):
+    """Return True if a TCP connection to ip:port succeeds."""
+    try:
+        with socket.create_connection((ip, port), timeout=1):
+            return True
+    except OSError:
+        return False
+
+
+def wait_ready(container_id, timeout):
+    """Wait until a started container is ready, return False if it is not within timeout.
+
+    Docker's health status is used when the image has a healthcheck. Otherwise the
+    container is ready when its published TCP ports accept connections, or when it
+    has no published ports, after it has kept running for settings.READY_GRACE.
+    A container Docker cannot inspect is not ready.
+    """
+    started = time.monotonic()
+    while time.monotonic() - started < timeout:
+        try:
+            with metrics.timed('docker_call_seconds', call='inspect_container'):
+                info = get_docker_client().inspect_container(container_id)
+        except APIError as ex:
+            logger.error('Docker API Error: inspecting %s. %s', container_id, ex)
+            return False
+        state = info.get('State') or {}
+        health = (state.get('Health') or {}).get('Status')
+        if not state.get('Running') or health == 'unhealthy':
+            return False
+        if health == 'healthy':
+            return True
+        if health is None:
+            ports = published_ports(info)
+            if ports and all(port_open(ip, port) for ip, port in ports):
+                return True
+            if not ports and time.monotonic() - started >= settings.READY_GRACE:
+                return True
+        time.sleep(settings.READY_POLL_INTERVAL)
+    return False
+
+
+def rolling_update(container, spec):
+    """Replace a running container with a container of spec, whose image is already pulled.
+
+    If the spec's update_strategy allows a surge, the new container is started
+    under a temporary name next to the old one and swapped in once it is ready.
+    Otherwise (or if the spec binds fixed host ports) the old container is
+    stopped before the new one is started.
+
+    Returns True if spec's container is running in the end.
+    """
+    service_id = spec['service_id']
+    strategy = update_strategy(spec)
+    if strategy.max_surge < 1 or binds_host_ports(spec):
+        if strategy.max_unavailable < 1:
+            logger.warning('%s cannot run two versions at once, recreating', service_id)
+        comms.notify_master(comms.Events.STOP_CONTAINER, service_id)
+        stop_and_remove(container['Id'])
+        return start_container(spec, pull=False)
 
     try:
-        container = docker_client.create_container(**container_params)
+        params = spec_compiler.compile(spec)
+    except SpecError as ex:
+        logger.error('%s', ex)
+        comms.notify_master(comms.Events.START_CONTAINER_FAILED, str(ex))
+        return False
 
-        comms.notify_master(comms.Events.START_CONTAINER, spec['service_id'])
-        docker_client.start(container=container.get('Id'))
+    try:
+        # left over from an interrupted update
+        remove_container(service_id + SURGE_SUFFIX)
     except APIError as ex:
-        logger.error('Docker API Error: starting container. {}'.format(ex), exc_info=True)
+        logger.error('Docker API Error: removing %s%s. %s', service_id, SURGE_SUFFIX, ex)
         comms.notify_master(comms.Events.START_CONTAINER_FAILED, str(ex))
-        return
+        return False
+    new_id = create_and_start(params, service_id, name=service_id + SURGE_SUFFIX)
+    if new_id is None:
+        return False
+
+    if not wait_ready(new_id, strategy.ready_timeout):
+        logger.error('%s %s did not become ready, keeping %s', service_id, spec['version'],
+                     container['Labels'].get('version'))
+        comms.notify_master(comms.Events.START_CONTAINER_FAILED,
+                            '{} not ready'.format(service_id))
+        discard_surge(new_id)
+        return False
+
+    comms.notify_master(comms.Events.STOP_CONTAINER, service_id)
+    try:
+        stop_and_remove(container['Id'])
+        with metrics.timed('docker_call_seconds', call='rename'):
+            get_docker_client().rename(new_id, service_id)
+    except APIError as ex:
+        # the next pass starts the service again if its old container is gone
+        logger.error('Docker API Error: swapping in %s %s. %s', service_id, spec['version'],
+                     ex, exc_info=True)
+        comms.notify_master(comms.Events.START_CONTAINER_FAILED, str(ex))
+        discard_surge(new_id)
+        return False
+    refresh_inventory(new_id)
+    return True
+
+
+def discard_surge(container_id):
+    """Remove a surge container of a failed rolling update, failures are only logged."""
+    try:
+        remove_container(container_id)
+    except APIError as ex:
+        logger.error('Docker API Error: removing %s. %s', container_id, ex)
@@ -0,0 +1,93 @@
+"""
+cpusets hands out cores to services that ask for exclusive CPUs.
+
+Cores are taken from a pool (settings.CPUSET_POOL, e.g. '2-7') that should be
+left out of every other container's cpuset. The cores assigned to a container
+are stored in its CPUSET_LABEL label, so the allocation is recovered from the
+containers, stopped ones included, instead of being kept in memory only: a
+restarted agent or a container removed behind the agent's back never leaks
+cores.
+"""
+import logging
+from threading import Lock
+
+from halti_agent.errors import HaltiException
+from halti_agent.specs import CPUSET_LABEL
+
+logger = logging.getLogger('halti-agent')
+
+
+class CpusetError(HaltiException):
+    """Exclusive CPUs cannot be assigned."""
+
+
+def parse_cpuset(cpuset):
+    """'0-2,5' => {0, 1, 2, 5}"""
+    cpus = set()
+    for part in filter(None, (cpuset or '').split(',')):
+        first, _, last = part.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def format_cpuset(cpus):
+    """{0, 1, 5} => '0,1,5'"""
+    return ','.join(str(cpu) for cpu in sorted(cpus))
+
+
+class CpusetAllocator(object):
+    """Assigns non-overlapping cores of a pool."""
+
+    def __init__(self, pool):
+        """Init allocator, pool is a cpuset string of the cores to hand out."""
+        self.pool = parse_cpuset(pool)
+        self._lock = Lock()
+        # owner -> cores assigned to a container being created
+        self._pending = {}
+        # owners whose container has been created, kept until the next listing shows it
+        self._created = set()
+
+    def in_use(self, containers):
+        """Return cores assigned to containers (dicts as docker_client.containers returns)."""
+        cpus = set()
+        for container in containers:
+            cpus |= parse_cpuset((container.get('Labels') or {}).get(CPUSET_LABEL))
+        return cpus
+
+    def allocate(self, owner, count, list_containers):
+        """Assign count free cores to owner (a container name), return them as a cpuset string.
+
+        list_containers() returns the Halti containers, stopped ones included,
+        and is called while holding the allocator's lock so that concurrent
+        allocations see each other's containers. Call created(owner) once the
+        owner's container has been created, or release(owner) if its creation
+        failed.
+        """
+        with self._lock:
+            containers = list_containers()
+            # created before this listing, their labels tell their cores from now on
+            for created in self._created:
+                self._pending.pop(created, None)
+            self._created.clear()
+
+            used = self.in_use(containers)
+            for cpus in self._pending.values():
+                used |= cpus
+            free = sorted(self.pool - used)
+            if len(free) < count:
+                raise CpusetError('{} needs {} exclusive CPUs, {} of {} free'.format(
+                    owner, count, len(free), len(self.pool)))
+            self._pending[owner] = set(free[:count])
+            return format_cpuset(self._pending[owner])
+
+    def created(self, owner):
+        """Keep the cores of owner reserved until a later listing shows its container."""
+        with self._lock:
+            if owner in self._pending:
+                self._created.add(owner)
+
+    def release(self, owner):
+        """Forget the assignment of owner, whose container was not created."""
+        with self._lock:
+            self._pending.pop(owner, None)
+            self._created.discard(owner)
@@ -0,0 +1,86 @@
+"""
+dependencies orders service starts by the services they depend on.
+
+A service spec may list other services of the node it needs in 'depends_on',
+by service_id or name:
+
+    {'service_id': ..., 'name': 'api', 'depends_on': ['postgres', 'redis'], ...}
+
+The dependencies form a DAG that is split into levels (see start_levels): the
+services of a level depend only on services of earlier levels, so a level is
+started in parallel once the services it needs are ready (see reconciler).
+Services in a dependency cycle, or depending on one, cannot be ordered and are
+reported in DependencyCycle.
+"""
+import logging
+
+from halti_agent.errors import HaltiException
+
+logger = logging.getLogger('halti-agent')
+
+
+class DependencyCycle(HaltiException):
+    """Services whose dependencies cannot be ordered."""
+
+    def __init__(self, services):
+        self.services = set(services)
+        HaltiException.__init__(
+            self, 'dependency cycle: {}'.format(', '.join(sorted(self.services))))
+
+
+def depends_on(spec):
+    """Return the names or service_ids spec depends on."""
+    names = spec.get('depends_on') or []
+    if isinstance(names, str):
+        names = [names]
+    return [name for name in names if isinstance(name, str)]
+
+
+def dependency_graph(desired):
+    """Return {service_id: {service_id, ...}} of desired services ({service_id: spec}).
+
+    Dependencies that are not desired on this node are ignored.
+    """
+    by_name = {spec.get('name'): service_id for service_id, spec in desired.items()}
+    graph = {}
+    for service_id, spec in desired.items():
+        graph[service_id] = set()
+        for name in depends_on(spec):
+            dependency = name if name in desired else by_name.get(name)
+            if dependency is None:
+                logger.warning('%s depends on %s, which is not on this node', service_id, name)
+            else:
+                graph[service_id].add(dependency)
+    return graph
+
+
+def start_levels(graph):
+    """Return [{service_id, ...}, ...], every service after the services it depends on.
+
+    Dependencies outside graph are ignored. Raises DependencyCycle if some
+    services cannot be ordered.
+    """
+    remaining = {service_id: dependencies & set(graph)
+                 for service_id, dependencies in graph.items()}
+    levels = []
+    while remaining:
+        level = {service_id for service_id, dependencies in remaining.items()
+                 if not dependencies}
+        if not level:
+            raise DependencyCycle(remaining)
+        levels.append(level)
+        remaining = {service_id: dependencies - level
+                     for service_id, dependencies in remaining.items()
+                     if service_id not in level}
+    return levels
+
+
+def critical_path(graph, seconds):
+    """Return the longest chain of seconds[service_id] along dependencies in graph."""
+    finished = {}
+    for level in start_levels(graph):
+        for service_id in level:
+            finished[service_id] = seconds.get(service_id, 0) + max(
+                [finished[dependency] for dependency in graph[service_id]
+                 if dependency in finished], default=0)
+    return max(finished.values(), default=0)
@@ -0,0 +1,74 @@
+"""
+failures keeps services that fail to start from being retried on every pass.
+
+A service version whose pull, start or update fails is put in backoff: it is
+skipped by statekeeper.determine_container_actions until its retry time, which
+doubles with every consecutive failure from settings.FAILURE_BACKOFF_BASE up to
+settings.FAILURE_BACKOFF_CAP seconds. A running older version is left alone
+meanwhile. A new version of the service or a successful start ends the backoff,
+and so does removing the service from the node's desired state (see prune).
+"""
+import logging
+import time
+from threading import Lock
+
+from halti_agent import settings
+from halti_agent.comms import backoff_delay
+
+logger = logging.getLogger('halti-agent')
+
+
+class FailureTracker(object):
+    """Consecutive failures and retry times by service."""
+
+    def __init__(self, base=None, cap=None):
+        """Init tracker, base and cap bound the backoff in seconds."""
+        self.base = base or settings.FAILURE_BACKOFF_BASE
+        self.cap = cap or settings.FAILURE_BACKOFF_CAP
+        self._lock = Lock()
+        # service_id -> {'version', 'failures', 'retry_at', 'reason'}
+        self._failures = {}
+
+    def failed(self, service_id, version, reason):
+        """Record a failure of service_id's version, return seconds until it is retried."""
+        with self._lock:
+            entry = self._failures.get(service_id)
+            if entry is None or entry['version'] != version:
+                entry = self._failures[service_id] = {'version': version, 'failures': 0}
+            delay = backoff_delay(entry['failures'], self.base, self.cap)
+            entry.update(failures=entry['failures'] + 1, retry_at=time.monotonic() + delay,
+                         reason=reason)
+        logger.warning('%s %s failed %s times (%s), retrying in %.0fs',
+                       service_id, version, entry['failures'], reason, delay)
+        return delay
+
+    def succeeded(self, service_id, version):
+        """End the backoff of service_id's version."""
+        with self._lock:
+            entry = self._failures.get(service_id)
+            if entry is not None and entry['version'] == version:
+                del self._failures[service_id]
+
+    def prune(self, service_ids):
+        """Forget the failures of services other than service_ids, e.g. removed ones."""
+        with self._lock:
+            for service_id in set(self._failures) - set(service_ids):
+                del self._failures[service_id]
+
+    def in_backoff(self, service_id, version):
+        """Return True if service_id's version should not be retried yet."""
+        with self._lock:
+            entry = self._failures.get(service_id)
+            return (entry is not None and entry['version'] == version and
+                    time.monotonic() < entry['retry_at'])
+
+    def report(self):
+        """Return failing services for the heartbeat: {service_id: {...}}."""
+        now = time.monotonic()
+        with self._lock:
+            return {
+                service_id: {'version': entry['version'], 'failures': entry['failures'],
+                             'reason': entry['reason'],
+                             'retry_in': round(max(0, entry['retry_at'] - now), 1)}
+                for service_id, entry in self._failures.items()
+            }
@@ -1,6 +1,8 @@
 """
 Small functional helpers.
 """
+import hashlib
+import json
 
 
 def diff(a, b):
@@ -20,3 +22,9 @@ def env_pairs_to_dict(env_list):
         env_pair['key']: env_pair['value']
         for env_pair in env_list
     }
+
+
+def fingerprint(data):
+    """Return a stable hex digest of JSON serialisable data."""
+    canonical = json.dumps(data, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
@@ -0,0 +1,94 @@
+"""
+heartbeat builds Halti Heartbeat payloads.
+
+In delta mode a heartbeat only carries the container fields that changed since
+the last heartbeat Halti Master acknowledged. Every heartbeat has a sequence
+number ('seq'). Master acknowledges a heartbeat by returning its sequence number
+as 'ack_seq' and can ask for a full heartbeat by returning 'resync': true.
+
+Until master has acknowledged a heartbeat (e.g. masters that do not know about
+deltas) full heartbeats are sent, so delta mode is always safe to enable.
+"""
+import logging
+import time
+from collections import OrderedDict
+
+from halti_agent import settings
+
+logger = logging.getLogger('halti-agent')
+
+FULL = 'full'
+DELTA = 'delta'
+
+# sent heartbeats remembered while waiting for an acknowledgement
+MAX_UNACKED = 8
+
+
+def diff_containers(base, containers):
+    """Return (changed, removed) between two {container ID: container} dicts.
+
+    changed maps container IDs to the fields that differ from base,
+    new containers are included with all their fields.
+    """
+    changed = {}
+    for container_id, container in containers.items():
+        old = base.get(container_id, {})
+        fields = {k: v for k, v in container.items() if old.get(k) != v or k not in old}
+        if fields:
+            changed[container_id] = fields
+    removed = sorted(set(base) - set(containers))
+    return changed, removed
+
+
+class HeartbeatEncoder(object):
+    """Turn heartbeat payloads into full or delta heartbeats."""
+
+    def __init__(self, mode=None):
+        """Init encoder, mode is FULL or DELTA (default: settings.HEARTBEAT_MODE)."""
+        self.mode = mode or settings.HEARTBEAT_MODE
+        self.seq = 0
+        self._unacked = OrderedDict()  # seq -> {container ID: container}
+        self._acked_seq = None
+        self._acked = None
+        self.stats = {'seq': 0, 'mode': FULL, 'diff_seconds': 0.0, 'resyncs': 0}
+
+    def encode(self, payload):
+        """Return heartbeat for payload ({'containers': [...], ...})."""
+        started = time.monotonic()
+        self.seq += 1
+        containers = payload['containers']
+        snapshot = {container['Id']: container for container in containers}
+        self._unacked[self.seq] = snapshot
+        while len(self._unacked) > MAX_UNACKED:
+            self._unacked.popitem(last=False)
+
+        heartbeat = dict(payload, seq=self.seq)
+        if self.mode == DELTA and self._acked is not None:
+            changed, removed = diff_containers(self._acked, snapshot)
+            del heartbeat['containers']
+            heartbeat.update(mode=DELTA, delta={
+                'base_seq': self._acked_seq,
+                'changed': changed,
+                'removed': removed,
+            })
+        else:
+            heartbeat['mode'] = FULL
+
+        self.stats.update(seq=self.seq, mode=heartbeat['mode'],
+                          diff_seconds=time.monotonic() - started)
+        return heartbeat
+
+    def acknowledge(self, response):
+        """Update the acknowledged state from Halti Master's heartbeat response."""
+        if response.get('resync'):
+            logger.info('Master requested a full heartbeat.')
+            self.stats['resyncs'] += 1
+            self._acked_seq = self._acked = None
+            return
+
+        ack_seq = response.get('ack_seq')
+        if ack_seq in self._unacked:
+            self._acked_seq, self._acked = ack_seq, self._unacked[ack_seq]
+            for seq in list(self._unacked):
+                if seq <= ack_seq:
+                    del self._unacked[seq]
@@ -0,0 +1,141 @@
+"""
+imagegc removes images that Halti services no longer use.
+
+ImageCollector remembers the images desired states have referred to. The images
+of the desired services and the settings.IMAGE_GC_KEEP_VERSIONS previous images
+of every desired service (for a fast rollback) are kept. Once usage of the
+Docker data disk passes settings.IMAGE_GC_HIGH_WATERMARK, the rest are removed
+least recently desired first until usage drops to settings.IMAGE_GC_LOW_WATERMARK.
+
+Images that no desired state has referred to since the agent started (e.g.
+pulled by hand) are never removed. Collection never runs while the statekeeper
+is reconciling, and pulls are paused while images are being removed.
+
+ImageCollector receives the functions that talk to Docker as params for
+testability (see: ImageCollector.__init__).
+"""
+import logging
+import os
+import time
+from collections import OrderedDict
+from threading import Lock, Thread
+
+from halti_agent import metrics, settings
+
+logger = logging.getLogger('halti-agent-imagegc')
+
+
+def disk_usage(path):
+    """Return used fraction (0..1) of the filesystem path is on."""
+    stat = os.statvfs(path)
+    if not stat.f_blocks:
+        return 0.0
+    return 1 - stat.f_bavail / float(stat.f_blocks)
+
+
+class ImageCollector(Thread):
+    """Disk-pressure driven removal of images Halti services no longer use."""
+
+    def __init__(self, remove_image, disk_usage, pull_manager, busy=None, keep_versions=None,
+                 high_watermark=None, low_watermark=None, interval=None):
+        """Init collector.
+
+        - remove_image(image) removes an image (tag) from the Docker daemon
+        - disk_usage() returns the used fraction of Docker's data disk
+        - busy() returns True while reconciliation is in progress
+        """
+        Thread.__init__(self)
+        self.daemon = True
+        self._remove_image = remove_image
+        self._disk_usage = disk_usage
+        self.pull_manager = pull_manager
+        self._busy = busy or (lambda: False)
+        self.keep_versions = (settings.IMAGE_GC_KEEP_VERSIONS
+                              if keep_versions is None else keep_versions)
+        self.high_watermark = high_watermark or settings.IMAGE_GC_HIGH_WATERMARK
+        self.low_watermark = low_watermark or settings.IMAGE_GC_LOW_WATERMARK
+        self.interval = interval or settings.IMAGE_GC_INTERVAL
+
+        self._lock = Lock()
+        # service_id -> OrderedDict(image -> last desired), most recent last
+        self._history = {}
+        self._desired = set()  # service_ids of the latest desired state
+        self.removed = 0
+
+    def track(self, services):
+        """Remember the images a desired state's services refer to."""
+        now = time.time()
+        with self._lock:
+            self._desired = {service['service_id'] for service in services}
+            for service in services:
+                images = self._history.setdefault(service['service_id'], OrderedDict())
+                images[service['image']] = now
+                images.move_to_end(service['image'])
+
+    def protected(self):
+        """Return images that must be kept."""
+        with self._lock:
+            return {
+                image
+                for service_id in self._desired
+                for image in list(self._history.get(service_id, {}))[-(self.keep_versions + 1):]
+            }
+
+    def candidates(self):
+        """Return removable images, least recently desired first."""
+        protected = self.protected()
+        last_desired = {}
+        with self._lock:
+            for images in self._history.values():
+                for image, desired_at in images.items():
+                    last_desired[image] = max(desired_at, last_desired.get(image, 0))
+        return sorted((image for image in last_desired if image not in protected),
+                      key=lambda image: last_desired[image])
+
+    def _forget(self, image):
+        with self._lock:
+            for service_id, images in list(self._history.items()):
+                images.pop(image, None)
+                if not images:
+                    del self._history[service_id]
+        self.pull_manager.forget(image)
+
+    def collect(self):
+        """Remove candidates while disk usage is above the watermark, return removed images."""
+        usage = self._disk_usage()
+        if usage < self.high_watermark:
+            return []
+
+        logger.info('disk usage %.0f%% above %.0f%%, removing unused images',
+                    usage * 100, self.high_watermark * 100)
+        removed = []
+        with self.pull_manager.paused():
+            for image in self.candidates():
+                if usage <= self.low_watermark:
+                    break
+                try:
+                    self._remove_image(image)
+                except Exception as ex:
+                    # e.g. still used by a container
+                    logger.warning('removing image %s failed: %s', image, ex)
+                    continue
+                self._forget(image)
+                removed.append(image)
+                usage = self._disk_usage()
+        self.removed += len(removed)
+        metrics.inc('images_removed_total', len(removed))
+        logger.info('removed %s images, disk usage %.0f%%', len(removed), usage * 100)
+        return removed
+
+    def run(self):
+        """Collect images every interval when statekeeper is idle."""
+        logger.info('Image collector started.')
+        while True:
+            time.sleep(self.interval)
+            if self._busy():
+                logger.debug('Reconciling, postponing image collection.')
+                continue
+            try:
+                self.collect()
+            except Exception as ex:
+                logger.error('image collection failed: %s', ex, exc_info=True)
@@ -0,0 +1,114 @@
+"""
+inventory keeps an in-process view of the containers managed by Halti.
+
+The inventory is seeded with a full listing and kept current from the Docker
+events stream on a background thread. The listing is repeated every
+settings.INVENTORY_RESYNC_INTERVAL seconds to repair any drift (e.g. events
+lost while the stream was reconnecting).
+
+ContainerInventory receives the functions that talk to Docker as params for
+testability (see: ContainerInventory.__init__).
+"""
+import logging
+import time
+from threading import Event, Lock, Thread
+
+from halti_agent import settings
+
+logger = logging.getLogger('halti-agent-inventory')
+
+# container event actions that may change a container's listing
+RELEVANT_ACTIONS = {'create', 'start', 'restart', 'die', 'stop', 'kill', 'oom',
+                    'pause', 'unpause', 'rename', 'update', 'destroy'}
+
+
+def event_container_id(event):
+    """Return the container ID of a Docker event."""
+    return event.get('id') or event.get('Actor', {}).get('ID')
+
+
+def event_action(event):
+    """Return the action of a Docker event ('health_status: healthy' => 'health_status')."""
+    return (event.get('Action') or event.get('status') or '').split(':')[0]
+
+
+class ContainerInventory(Thread):
+    """Event-fed cache of Halti containers."""
+
+    def __init__(self, poll, events, resync_interval=None):
+        """Init inventory.
+
+        - poll(filters=None) lists running Halti containers, optionally filtered
+        - events(since, until) yields decoded Docker events of Halti containers
+        """
+        Thread.__init__(self)
+        self._poll = poll
+        self._events = events
+        self.resync_interval = resync_interval or settings.INVENTORY_RESYNC_INTERVAL
+
+        self._lock = Lock()
+        self._containers = {}  # container ID -> container dict
+        self._listeners = []
+        self.synced = Event()
+        self.resyncs = 0
+        self.events_seen = 0
+
+    def add_listener(self, listener):
+        """Call listener(event) after an event has changed the inventory."""
+        self._listeners.append(listener)
+
+    def is_synced(self):
+        """Return True if the inventory is current and can be used instead of polling."""
+        return self.synced.is_set()
+
+    def containers(self):
+        """Return containers as docker_client.containers would."""
+        with self._lock:
+            return list(self._containers.values())
+
+    def resync(self):
+        """Replace the inventory with a full listing."""
+        containers = self._poll()
+        with self._lock:
+            self._containers = {container['Id']: container for container in containers}
+        self.resyncs += 1
+        self.synced.set()
+
+    def refresh(self, container_id):
+        """Re-list a single container, removing it if it is no longer running."""
+        containers = self._poll(filters={'id': container_id})
+        with self._lock:
+            self._containers.pop(container_id, None)
+            for container in containers:
+                self._containers[container['Id']] = container
+
+    def handle_event(self, event):
+        """Update inventory based on a Docker event."""
+        self.events_seen += 1
+        action = event_action(event)
+        container_id = event_container_id(event)
+        if action not in RELEVANT_ACTIONS or container_id is None:
+            return
+        if action == 'destroy':
+            with self._lock:
+                self._containers.pop(container_id, None)
+        else:
+            self.refresh(container_id)
+        for listener in self._listeners:
+            listener(event)
+
+    def run(self):
+        """Follow Docker events forever, resyncing periodically and on errors."""
+        logger.info('Container inventory started.')
+        while True:
+            try:
+                # events since the listing started are replayed, refreshes are idempotent
+                since = int(time.time())
+                self.resync()
+                until = since + int(self.resync_interval)
+                for event in self._events(since=since, until=until):
+                    self.handle_event(event)
+            except Exception as ex:
+                logger.error('Container inventory out of sync: %s', ex, exc_info=True)
+                self.synced.clear()
+                time.sleep(settings.INVENTORY_RETRY_INTERVAL)
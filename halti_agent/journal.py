@@ -0,0 +1,110 @@
+"""
+journal persists what the statekeeper has applied, so a restarted agent whose
+running containers still match the last applied desired state can resume from
+it instead of reconciling blind (see StatekeeperWorker.warm_start).
+
+The journal is an append-only JSON lines file. Every applied desired state adds
+one record with the actions it took:
+
+    {"fingerprint": ..., "applied_at": ..., "services": [...], "actions": [...]}
+
+"services" is left out (null) when it equals the previous record's services,
+which keeps the periodic re-applies of an unchanged state small. Once the
+journal has more than max_entries records it is compacted into the latest one.
+Records are fsynced and compaction replaces the file atomically, so a crash
+leaves at most a torn last line, which reads skip.
+"""
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger('halti-agent')
+
+
+def write_atomic(path, text):
+    """Replace file at path with text, never leaving a partially written file."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as tmp_file:
+        tmp_file.write(text)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    os.replace(tmp_path, path)
+    # make the rename itself durable
+    try:
+        dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+
+class StateJournal(object):
+    """Append-only log of applied desired states."""
+
+    def __init__(self, path, max_entries):
+        """Init journal, records left in path by a previous run are kept."""
+        self.path = path
+        self.max_entries = max_entries
+        records = self._read()
+        self._count = len(records)
+        self._last = self._resolve(records)
+
+    def last_applied(self):
+        """Return the latest record with its services, or None if nothing was applied."""
+        return self._last
+
+    def record(self, fingerprint, services, timings=()):
+        """Append an applied desired state and the reconciler.ActionTimings it took."""
+        record = {
+            'fingerprint': fingerprint,
+            'applied_at': time.time(),
+            'services': services,
+            'actions': [[timing.service_id, timing.action, round(timing.seconds, 3),
+                         None if timing.error is None else str(timing.error)]
+                        for timing in timings],
+        }
+        full_record = record
+        if self._last is not None and self._last['fingerprint'] == fingerprint:
+            record = dict(record, services=None)
+
+        if self._count >= self.max_entries:
+            write_atomic(self.path, json.dumps(full_record) + '\n')
+            self._count = 1
+        else:
+            with open(self.path, 'a') as journal_file:
+                journal_file.write(json.dumps(record) + '\n')
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+            self._count += 1
+        self._last = full_record
+
+    def _resolve(self, records):
+        """Return the latest record with services filled in from an earlier record."""
+        if not records:
+            return None
+        last = records[-1]
+        for record in reversed(records):
+            if record.get('fingerprint') != last.get('fingerprint'):
+                break
+            if record.get('services') is not None:
+                return dict(last, services=record['services'])
+        logger.warning('%s: services of the latest record are missing', self.path)
+        return None
+
+    def _read(self):
+        records = []
+        try:
+            with open(self.path) as journal_file:
+                for line in journal_file:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        logger.warning('skipping corrupt line in %s', self.path)
+        except FileNotFoundError:
+            pass
+        return records
@@ -0,0 +1,177 @@
+"""
+logpipeline keeps writing logs off the threads that produce them.
+
+Records are put on a bounded queue by a QueueHandler and written to stderr by a
+QueueListener thread, so a slow terminal or log collector never stalls
+reconciliation or heartbeats. A full queue drops records (counted in
+stats['dropped']) instead of blocking.
+
+Every record carries the correlation ID of the reconcile pass it belongs to
+(see correlation). The ID is kept per thread, worker threads are handed the ID
+of the pass explicitly (see reconciler). With settings.LOG_FORMAT=json
+records are written as one JSON object per line.
+
+Repeated warnings and errors of a crash loop (same call site, message and
+arguments) are rate limited: at most settings.LOG_RATE_BURST of them pass per
+settings.LOG_RATE_INTERVAL seconds, the rest are counted in stats['suppressed']
+and the number of suppressed records is appended to the next one that passes.
+
+Loggers should be called with %-style arguments, which are formatted only if
+the record passes the level and the rate limit.
+"""
+import atexit
+from collections import OrderedDict
+from contextlib import contextmanager
+import copy
+from datetime import datetime, timezone
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import sys
+from threading import local, Lock
+import time
+import uuid
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(correlation_id)s - %(message)s'
+NO_CORRELATION = '-'
+
+stats = {'dropped': 0, 'suppressed': 0}
+
+_thread_state = local()
+
+
+def correlation_id():
+    """Return the correlation ID of the current thread or None."""
+    return getattr(_thread_state, 'correlation_id', None)
+
+
+@contextmanager
+def correlation(value=None):
+    """Tag records this thread logs in the block with value, a new random ID by default."""
+    previous = correlation_id()
+    _thread_state.correlation_id = value or uuid.uuid4().hex[:12]
+    try:
+        yield _thread_state.correlation_id
+    finally:
+        _thread_state.correlation_id = previous
+
+
+class CorrelationFilter(logging.Filter):
+    """Adds correlation_id to records, must run in the thread that logs."""
+
+    def filter(self, record):
+        record.correlation_id = correlation_id() or NO_CORRELATION
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """Passes at most burst records of level or above per repeated record and interval.
+
+    Records repeat when they come from the same call site with the same
+    message and arguments. The windows of at most max_keys repeated records
+    are kept, the oldest are forgotten first.
+    """
+
+    def __init__(self, burst, interval, level=logging.WARNING, clock=time.monotonic,
+                 max_keys=1024):
+        logging.Filter.__init__(self)
+        self.burst = burst
+        self.interval = interval
+        self.level = level
+        self.max_keys = max_keys
+        self._clock = clock
+        self._lock = Lock()
+        # (pathname, lineno, levelno, msg, args) -> [window started, records, suppressed]
+        self._windows = OrderedDict()
+
+    def filter(self, record):
+        if record.levelno < self.level or self.burst <= 0:
+            return True
+        # not the formatted message, a record with bad args must not raise here
+        key = (record.pathname, record.lineno, record.levelno, str(record.msg),
+               repr(record.args))
+        now = self._clock()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window is not None else 0
+                window = self._windows[key] = [now, 0, suppressed]
+                self._windows.move_to_end(key)
+                while len(self._windows) > self.max_keys:
+                    self._windows.popitem(last=False)
+            window[1] += 1
+            if window[1] > self.burst:
+                window[2] += 1
+                stats['suppressed'] += 1
+                return False
+            record.suppressed, window[2] = window[2], 0
+        return True
+
+
+class AsyncHandler(QueueHandler):
+    """QueueHandler that drops records when the queue is full."""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            stats['dropped'] += 1
+
+    def prepare(self, record):
+        """Format the message in the logging thread, args may change after the call."""
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        if getattr(record, 'suppressed', 0):
+            record.message += ' ({} similar records suppressed)'.format(record.suppressed)
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg, record.args, record.exc_info = record.message, None, None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record."""
+
+    def format(self, record):
+        entry = {
+            'time': '{}.{:03d}+00:00'.format(
+                datetime.fromtimestamp(record.created, timezone.utc).strftime(
+                    '%Y-%m-%dT%H:%M:%S'), int(record.msecs)),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'correlation_id', NO_CORRELATION) != NO_CORRELATION:
+            entry['correlation_id'] = record.correlation_id
+        if getattr(record, 'suppressed', 0):
+            entry['suppressed'] = record.suppressed
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+def configure(level, json_format=False, queue_size=10000, rate_burst=10, rate_interval=60,
+              stream=None):
+    """Route the root logger through a queue to stream (stderr), return the QueueListener."""
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT))
+
+    queue_handler = AsyncHandler(queue.Queue(queue_size))
+    queue_handler.addFilter(CorrelationFilter())
+    queue_handler.addFilter(RateLimitFilter(rate_burst, rate_interval))
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    listener = QueueListener(queue_handler.queue, handler)
+    listener.start()
+    # write out queued records when the agent exits
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,251 @@
+"""
+logship ships the stdout/stderr of Halti containers to a sink.
+
+Every running Halti container has a LogFollower thread reading its Docker log
+stream (follow=True, timestamps=True) line by line into a ring buffer of
+settings.LOG_SHIP_BUFFER_LINES lines, truncating lines longer than
+settings.LOG_SHIP_MAX_LINE. A full buffer drops its oldest line and counts it,
+so a chatty container or an unreachable sink never grows memory.
+
+LogShipper starts and forgets followers as containers come and go, and every
+settings.LOG_SHIP_FLUSH_INTERVAL seconds drains the buffers round-robin into
+batches of up to settings.LOG_SHIP_BATCH_LINES lines that are handed to a sink:
+
+- MasterSink posts gzipped JSON to Halti Master (see comms.ship_logs)
+- FileSink appends gzip members of JSON lines to a local file
+
+A batch the sink fails to take is dropped and counted, a follower that is
+restarted resumes from the timestamp of the last line it read.
+
+Lines are shipped as {'container': <name>, 'time': <RFC3339 timestamp>, 'line': ...}.
+"""
+from collections import deque
+from datetime import datetime, timezone
+import gzip
+import json
+import logging
+import os
+import time
+from threading import Lock, Thread
+
+from halti_agent import comms, settings
+
+logger = logging.getLogger('halti-agent-logship')
+
+# room for the '<RFC3339Nano timestamp> ' prefix of every line
+STAMP_BYTES = 32
+
+
+def stamp_key(stamp):
+    """Return a sortable key of a Docker RFC3339Nano timestamp (trailing zeros are cut)."""
+    seconds, _, fraction = stamp.rstrip('Z').partition('.')
+    return seconds, fraction.ljust(9, '0')
+
+
+def stamp_seconds(stamp):
+    """Return the epoch seconds of a Docker timestamp, as logs(since=...) takes them."""
+    parsed = datetime.strptime(stamp[:19], '%Y-%m-%dT%H:%M:%S')
+    return int(parsed.replace(tzinfo=timezone.utc).timestamp())
+
+
+class LogBuffer(object):
+    """Ring buffer of the latest lines of a container."""
+
+    def __init__(self, size):
+        self._lines = deque(maxlen=size)
+        self._lock = Lock()
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._lines)
+
+    def append(self, line):
+        """Add line, dropping the oldest line when full."""
+        with self._lock:
+            if len(self._lines) == self._lines.maxlen:
+                self.dropped += 1
+            self._lines.append(line)
+
+    def pop(self):
+        """Remove and return the oldest line, None if empty."""
+        with self._lock:
+            return self._lines.popleft() if self._lines else None
+
+
+class LogFollower(Thread):
+    """Reads the log stream of one container until the container stops."""
+
+    def __init__(self, name, container_id, logs, buffer_lines=None, max_line=None, since=None):
+        """Init follower.
+
+        - logs(container_id, since) yields chunks of the container's log stream
+        - since is the timestamp of the last line already read, if any
+        """
+        Thread.__init__(self)
+        self.daemon = True
+        self.name = name
+        self.container_id = container_id
+        self._logs = logs
+        self.max_line = max_line or settings.LOG_SHIP_MAX_LINE
+        self.buffer = LogBuffer(buffer_lines or settings.LOG_SHIP_BUFFER_LINES)
+        self.last_stamp = since
+
+    def add(self, raw):
+        """Buffer a raw '<timestamp> <line>' of the log stream."""
+        stamp, _, text = raw.decode('utf-8', 'replace').rstrip('\r').partition(' ')
+        if self.last_stamp is not None and stamp_key(stamp) <= stamp_key(self.last_stamp):
+            # replayed after a restart, since is in whole seconds
+            return
+        self.last_stamp = stamp
+        self.buffer.append({'container': self.name, 'time': stamp,
+                            'line': text[:self.max_line]})
+
+    def follow(self):
+        """Buffer lines until the log stream ends."""
+        since = stamp_seconds(self.last_stamp) if self.last_stamp else None
+        partial, truncated = b'', False
+        for chunk in self._logs(self.container_id, since):
+            lines = (partial + chunk).split(b'\n')
+            partial = lines.pop()
+            for line in lines:
+                if truncated:
+                    # the rest of a line that was cut at max_line
+                    truncated = False
+                    continue
+                self.add(line)
+            if len(partial) > self.max_line + STAMP_BYTES:
+                if not truncated:
+                    self.add(partial)
+                partial, truncated = b'', True
+        if partial and not truncated:
+            self.add(partial)
+
+    def run(self):
+        try:
+            self.follow()
+        except Exception as ex:
+            logger.debug('following logs of %s failed: %s', self.name, ex)
+
+
+class MasterSink(object):
+    """Ships batches to Halti Master."""
+
+    def __call__(self, lines):
+        comms.ship_logs(lines)
+
+
+class FileSink(object):
+    """Appends batches as gzip members of JSON lines, keeping one rotated file."""
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def __call__(self, lines):
+        body = ''.join(json.dumps(line) + '\n' for line in lines).encode('utf-8')
+        try:
+            if os.path.getsize(self.path) >= self.max_bytes:
+                os.replace(self.path, self.path + '.1')
+        except FileNotFoundError:
+            pass
+        with open(self.path, 'ab') as log_file:
+            log_file.write(gzip.compress(body))
+
+
+def create_sink():
+    """Return the sink of settings.LOG_SHIP_SINK ('master' or 'file')."""
+    if settings.LOG_SHIP_SINK == 'file':
+        return FileSink(settings.LOG_SHIP_FILE, settings.LOG_SHIP_FILE_MAX_BYTES)
+    return MasterSink()
+
+
+class LogShipper(Thread):
+    """Follows the logs of all Halti containers and ships them in batches."""
+
+    def __init__(self, list_containers, logs, sink, flush_interval=None, batch_lines=None,
+                 follower=LogFollower):
+        """Init shipper.
+
+        - list_containers() returns Halti containers (see containers.list_containers)
+        - logs(container_id, since) yields chunks of a container's log stream
+        - sink(lines) ships a batch of lines, raising if it could not
+        """
+        Thread.__init__(self)
+        self.daemon = True
+        self._list_containers = list_containers
+        self._logs = logs
+        self._sink = sink
+        self._follower = follower
+        self.flush_interval = flush_interval or settings.LOG_SHIP_FLUSH_INTERVAL
+        self.batch_lines = batch_lines or settings.LOG_SHIP_BATCH_LINES
+
+        self.followers = {}  # container ID -> LogFollower
+        self._positions = {}  # container ID -> last timestamp read by a finished follower
+        self._dropped = 0  # lines dropped by forgotten followers
+        self.stats = {'lines_shipped': 0, 'lines_failed': 0, 'batches_shipped': 0,
+                      'batches_failed': 0}
+
+    def dropped(self):
+        """Return the number of lines dropped by full buffers."""
+        return self._dropped + sum(follower.buffer.dropped
+                                   for follower in list(self.followers.values()))
+
+    def update_followers(self):
+        """Follow new containers, restart followers of running containers whose stream ended."""
+        running = {container['Id']: container['Names'][0][1:]
+                   for container in self._list_containers()}
+        for container_id, follower in list(self.followers.items()):
+            if follower.is_alive() or len(follower.buffer):
+                continue
+            del self.followers[container_id]
+            self._dropped += follower.buffer.dropped
+            self._positions[container_id] = follower.last_stamp
+        for container_id in set(self._positions) - set(running):
+            del self._positions[container_id]
+        for container_id, name in running.items():
+            if container_id not in self.followers:
+                follower = self._follower(name, container_id, self._logs,
+                                          since=self._positions.get(container_id))
+                follower.start()
+                self.followers[container_id] = follower
+
+    def batches(self):
+        """Yield batches of buffered lines, taking one line of each container in turn."""
+        buffers = [follower.buffer for follower in list(self.followers.values())]
+        batch = []
+        while buffers:
+            for buffer in list(buffers):
+                line = buffer.pop()
+                if line is None:
+                    buffers.remove(buffer)
+                    continue
+                batch.append(line)
+                if len(batch) >= self.batch_lines:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+    def flush(self):
+        """Ship everything buffered."""
+        for batch in self.batches():
+            try:
+                self._sink(batch)
+            except Exception as ex:
+                logger.warning('shipping %s log lines failed: %s', len(batch), ex)
+                self.stats['lines_failed'] += len(batch)
+                self.stats['batches_failed'] += 1
+                continue
+            self.stats['lines_shipped'] += len(batch)
+            self.stats['batches_shipped'] += 1
+
+    def run(self):
+        """Follow and ship forever."""
+        logger.info('Log shipper started.')
+        while True:
+            try:
+                self.update_followers()
+                self.flush()
+            except Exception as ex:
+                logger.error('shipping logs failed: %s', ex, exc_info=True)
+            time.sleep(self.flush_interval)
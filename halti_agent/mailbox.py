@@ -0,0 +1,56 @@
+"""
+mailbox holds the latest desired state for the statekeeper.
+
+Unlike a Queue, a mailbox only ever holds one item. Putting a new desired state
+replaces (drops) one that has not been picked up yet, so a slow set_state pass
+is followed by the most recent desired state instead of a backlog of stale ones.
+"""
+from threading import Condition
+import time
+
+
+class DesiredStateMailbox(object):
+    """Latest-value mailbox with the subset of the Queue API the agent uses."""
+
+    def __init__(self):
+        """Init an empty mailbox."""
+        self._cond = Condition()
+        self._item = None
+        self._put_at = None
+        # monotonic time the item last returned by get was put
+        self.last_put_at = None
+        self.dropped = 0
+
+    def put(self, item):
+        """Store item, replacing any item that has not been taken yet."""
+        with self._cond:
+            if self._item is not None:
+                self.dropped += 1
+            self._item = item
+            self._put_at = time.monotonic()
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """Remove and return the latest item, blocking until one is available.
+
+        Returns None if timeout passes without an item.
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._item is not None, timeout):
+                return None
+            item, self._item = self._item, None
+            self.last_put_at = self._put_at
+            return item
+
+    def task_done(self):
+        """Queue compatibility, a mailbox does not track unfinished tasks."""
+
+    def pending_seconds(self):
+        """Return how long the waiting item has waited, 0 if there is none."""
+        with self._cond:
+            return 0 if self._item is None else time.monotonic() - self._put_at
+
+    def qsize(self):
+        """Return the number of waiting items (0 or 1)."""
+        with self._cond:
+            return 0 if self._item is None else 1
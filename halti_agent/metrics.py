@@ -0,0 +1,253 @@
+"""
+metrics keeps Prometheus-style metrics of the agent and serves them.
+
+Metrics are recorded only when an exporter is configured (settings.METRICS_PORT
+or settings.METRICS_SOCKET). Otherwise inc, observe and timed return right
+away, so instrumented hot paths pay next to nothing.
+
+Gauges are callbacks that are evaluated only when metrics are scraped.
+
+With settings.TRACING each reconcile pass is logged as a span tree:
+    trace reconcile 1.234s [stop 3f2a... 0.301s, pull 9c1b... 0.812s, ...]
+"""
+from collections import defaultdict
+import errno
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import logging
+import os
+import socket
+from socketserver import StreamRequestHandler, ThreadingMixIn, UnixStreamServer
+import stat
+from threading import Lock, Thread
+import time
+
+from halti_agent import settings
+
+logger = logging.getLogger('halti-agent-metrics')
+
+ENABLED = bool(settings.METRICS_PORT or settings.METRICS_SOCKET)
+TRACING = settings.TRACING
+
+PREFIX = 'halti_agent_'
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v) for k, v in pairs) + '}'
+
+
+class Registry(object):
+    """Counters, histograms and gauges by name and labels."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.counters = defaultdict(lambda: defaultdict(float))
+        # name -> label key -> [bucket counts..., sum, count]
+        self.histograms = defaultdict(dict)
+        self.gauges = {}
+
+    def inc(self, name, amount, labels):
+        with self._lock:
+            self.counters[name][_label_key(labels)] += amount
+
+    def observe(self, name, value, labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self.histograms[name].get(key)
+            if series is None:
+                series = self.histograms[name][key] = [0] * (len(BUCKETS) + 2)
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        """Return metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append('# TYPE {}{} counter'.format(PREFIX, name))
+                for key, value in sorted(series.items()):
+                    lines.append('{}{}{} {}'.format(PREFIX, name, _format_labels(key), value))
+            for name, series in sorted(self.histograms.items()):
+                lines.append('# TYPE {}{} histogram'.format(PREFIX, name))
+                for key, values in sorted(series.items()):
+                    for bound, count in zip(BUCKETS, values):
+                        lines.append('{}{}_bucket{} {}'.format(
+                            PREFIX, name, _format_labels(key, [('le', bound)]), count))
+                    lines.append('{}{}_bucket{} {}'.format(
+                        PREFIX, name, _format_labels(key, [('le', '+Inf')]), values[-1]))
+                    lines.append('{}{}_sum{} {}'.format(
+                        PREFIX, name, _format_labels(key), values[-2]))
+                    lines.append('{}{}_count{} {}'.format(
+                        PREFIX, name, _format_labels(key), values[-1]))
+            gauges = sorted(self.gauges.items())
+        for name, fn in gauges:
+            try:
+                value = fn()
+            except Exception as ex:
+                logger.warning('gauge %s failed: %s', name, ex)
+                continue
+            lines.append('# TYPE {}{} gauge'.format(PREFIX, name))
+            lines.append('{}{} {}'.format(PREFIX, name, value))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def inc(name, amount=1, **labels):
+    """Increment counter name."""
+    if ENABLED:
+        registry.inc(name, amount, labels)
+
+
+def observe(name, value, **labels):
+    """Observe value in histogram name."""
+    if ENABLED:
+        registry.observe(name, value, labels)
+
+
+def gauge(name, fn):
+    """Register fn() as the value of gauge name."""
+    registry.gauges[name] = fn
+
+
+class _Timer(object):
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        registry.observe(self.name, time.monotonic() - self.started, self.labels)
+
+
+class _Noop(object):
+    """Stand-in for timers and spans when they are disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def add(self, name, seconds):
+        pass
+
+
+_NOOP = _Noop()
+
+
+def timed(name, **labels):
+    """Context manager that observes its duration in histogram name."""
+    if not ENABLED:
+        return _NOOP
+    return _Timer(name, labels)
+
+
+class Span(object):
+    """A traced operation with child operations, logged when it ends."""
+
+    def __init__(self, name):
+        self.name = name
+        self.children = []
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.monotonic() - self.started
+        logger.info('trace %s', self)
+
+    def add(self, name, seconds):
+        """Add a finished child operation (e.g. one that ran in another thread)."""
+        self.children.append((name, seconds))
+
+    def __str__(self):
+        children = ', '.join('{} {:.3f}s'.format(name, seconds) for name, seconds in self.children)
+        return '{} {:.3f}s [{}]'.format(self.name, self.seconds, children)
+
+
+def span(name):
+    """Context manager that traces an operation if settings.TRACING is on."""
+    if not TRACING:
+        return _NOOP
+    return Span(name)
+
+
+class _HTTPHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _SocketHandler(StreamRequestHandler):
+
+    def handle(self):
+        self.wfile.write(registry.render().encode('utf-8'))
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _ThreadingUnixServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def remove_stale_socket(path):
+    """Remove a Unix socket left by a previous process, so it can be bound again."""
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return
+    except FileNotFoundError:
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+            return
+    raise OSError(errno.EADDRINUSE, 'metrics socket {} is in use'.format(path))
+
+
+def start_exporter():
+    """Serve metrics over HTTP and/or a Unix socket as configured in settings."""
+    servers = []
+    if settings.METRICS_PORT:
+        servers.append(_ThreadingHTTPServer((settings.METRICS_BIND, int(settings.METRICS_PORT)),
+                                            _HTTPHandler))
+        logger.info('Serving metrics at http://%s:%s/metrics', settings.METRICS_BIND,
+                    settings.METRICS_PORT)
+    if settings.METRICS_SOCKET:
+        remove_stale_socket(settings.METRICS_SOCKET)
+        servers.append(_ThreadingUnixServer(settings.METRICS_SOCKET, _SocketHandler))
+        logger.info('Serving metrics at %s', settings.METRICS_SOCKET)
+    for server in servers:
+        Thread(target=server.serve_forever, daemon=True).start()
+    return servers
@@ -0,0 +1,111 @@
+"""
+prefetch warms images before statekeeper needs them.
+
+Halti Master may advertise images of upcoming desired state in the heartbeat
+response ('prefetch': [image, ...]). With settings.PREFETCH_DESIRED the images of
+the current desired services are prefetched as well.
+
+Prefetching has a lower priority than reconciliation: a prefetch starts only
+while no reconciliation pull is in progress, at most
+settings.PREFETCH_CONCURRENCY prefetches run at once and prefetching pauses when
+more than settings.PREFETCH_MAX_BYTES_PER_MINUTE bytes were downloaded in the
+last minute. Hit rates are kept in PullManager.stats (prefetches, prefetch_hits).
+
+An image is prefetched once per settings.PREFETCH_SEEN_TTL seconds however often
+it is offered, so an image removed by image GC meanwhile is prefetched again.
+"""
+from collections import deque, OrderedDict
+import logging
+import time
+from threading import BoundedSemaphore, Condition, Thread
+
+from halti_agent import settings
+from halti_agent.pulls import IF_NOT_PRESENT
+
+logger = logging.getLogger('halti-agent-prefetch')
+
+
+def prefetch_images(desired_state):
+    """Return images to prefetch according to a heartbeat response."""
+    images = list(desired_state.get('prefetch') or [])
+    if settings.PREFETCH_DESIRED:
+        images += [service['image'] for service in desired_state.get('services', [])]
+    return images
+
+
+class Prefetcher(Thread):
+    """Pulls offered images in the background with low priority."""
+
+    def __init__(self, pull_manager, busy=None, concurrency=None, max_bytes_per_minute=None,
+                 seen_ttl=None, seen_size=None):
+        """Init prefetcher, busy() returns True while reconciliation is in progress."""
+        Thread.__init__(self)
+        self.daemon = True
+        self.pull_manager = pull_manager
+        self._busy = busy or (lambda: False)
+        self._slots = BoundedSemaphore(concurrency or settings.PREFETCH_CONCURRENCY)
+        self.max_bytes_per_minute = (max_bytes_per_minute or
+                                     settings.PREFETCH_MAX_BYTES_PER_MINUTE)
+        self._cond = Condition()
+        self._queue = deque()
+        self.seen_ttl = settings.PREFETCH_SEEN_TTL if seen_ttl is None else seen_ttl
+        self.seen_size = seen_size or settings.PREFETCH_SEEN_SIZE
+        self._seen = OrderedDict()  # image -> monotonic time it was first offered
+        self._downloads = deque()  # (monotonic time, bytes) of recent prefetches
+        self.failures = 0
+
+    def offer(self, images):
+        """Queue images that have not been offered in the last seen_ttl seconds."""
+        now = time.monotonic()
+        with self._cond:
+            # oldest first, an image offered again keeps its first offer time
+            while self._seen and now - next(iter(self._seen.values())) >= self.seen_ttl:
+                self._seen.popitem(last=False)
+            for image in images:
+                if image not in self._seen:
+                    self._seen[image] = now
+                    self._queue.append(image)
+            while len(self._seen) > self.seen_size:
+                self._seen.popitem(last=False)
+            self._cond.notify()
+
+    def yield_to_reconciliation(self):
+        """Block while reconciliation pulls or the bandwidth budget need it."""
+        while True:
+            now = time.monotonic()
+            with self._cond:
+                while self._downloads and now - self._downloads[0][0] > 60:
+                    self._downloads.popleft()
+                downloaded = sum(size for _, size in self._downloads)
+            over_budget = self.max_bytes_per_minute and downloaded >= self.max_bytes_per_minute
+            if not (self._busy() or self.pull_manager.active_pulls or over_budget):
+                return
+            time.sleep(settings.PREFETCH_IDLE_POLL)
+
+    def prefetch(self, image):
+        """Pull a single image if it is not available locally."""
+        try:
+            before = self.pull_manager.stats['bytes_pulled']
+            self.pull_manager.ensure(image, IF_NOT_PRESENT, prefetch=True)
+            with self._cond:
+                self._downloads.append((time.monotonic(),
+                                        self.pull_manager.stats['bytes_pulled'] - before))
+        except Exception as ex:
+            self.failures += 1
+            # allow offering the image again later
+            with self._cond:
+                self._seen.pop(image, None)
+            logger.warning('prefetching %s failed: %s', image, ex)
+        finally:
+            self._slots.release()
+
+    def run(self):
+        """Prefetch offered images forever."""
+        logger.info('Prefetcher started.')
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._queue)
+                image = self._queue.popleft()
+            self._slots.acquire()
+            self.yield_to_reconciliation()
+            Thread(target=self.prefetch, args=(image,), daemon=True).start()
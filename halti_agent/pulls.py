@@ -0,0 +1,243 @@
+"""
+pulls deduplicates image pulls and caches resolved image digests.
+
+Many services on a node often share an image tag, and a crash-looping or
+redeployed service would otherwise pull its image again on every start.
+PullManager makes sure that:
+
+- concurrent pulls of the same image reference share a single pull
+- recently resolved images are served from an in-memory TTL/LRU cache
+- every service spec can choose a pull policy (see POLICIES)
+- a failed pull is not repeated within settings.PULL_NEGATIVE_TTL seconds
+
+PullManager receives the functions that talk to Docker as params for
+testability (see: PullManager.__init__).
+"""
+import logging
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Condition, Event
+
+from halti_agent import settings
+
+logger = logging.getLogger('halti-agent-pulls')
+
+# pull unless the image was resolved less than settings.PULL_CACHE_TTL ago
+ALWAYS = 'always'
+# pull only if the image is not available locally
+IF_NOT_PRESENT = 'if-not-present'
+# image is pinned by digest (image@sha256:...) and thus immutable,
+# pull only if not available locally and never expire it from the cache
+DIGEST_PINNED = 'digest-pinned'
+
+POLICIES = {ALWAYS, IF_NOT_PRESENT, DIGEST_PINNED}
+
+
+def is_digest_pinned(image):
+    """Return True if image reference is pinned by digest."""
+    return '@' in image
+
+
+def image_digest(image_info):
+    """Return the most specific identifier of an inspected image."""
+    repo_digests = image_info.get('RepoDigests') or []
+    return repo_digests[0] if repo_digests else image_info['Id']
+
+
+class _Flight(object):
+    """A pull in progress that other callers can wait for."""
+
+    def __init__(self):
+        self.done = Event()
+        self.digest = None
+        self.error = None
+
+
+class PullManager(object):
+    """Single-flight, cached image pulls."""
+
+    def __init__(self, pull, inspect, ttl=None, max_entries=None, negative_ttl=None):
+        """Init pull manager.
+
+        - pull(image) pulls an image and returns the number of bytes downloaded
+        - inspect(image) returns Docker's image dict or None if image is not present
+        """
+        self._pull = pull
+        self._inspect = inspect
+        self.ttl = settings.PULL_CACHE_TTL if ttl is None else ttl
+        self.max_entries = max_entries or settings.PULL_CACHE_SIZE
+        self.negative_ttl = settings.PULL_NEGATIVE_TTL if negative_ttl is None else negative_ttl
+
+        self._lock = Condition()
+        self._cache = OrderedDict()  # image -> (digest, resolved_at, pinned)
+        self._flights = {}  # image -> _Flight
+        self._paused = 0
+        self._prefetched = set()  # images prefetched but not yet used
+        self._failed = {}  # image -> (error, failed_at) of the latest failed pull
+        # pulls in progress that something is waiting to start
+        self.active_pulls = 0
+        self.stats = {
+            'pulls': 0,
+            'pull_failures': 0,
+            'pull_seconds': 0.0,
+            'bytes_pulled': 0,
+            'cache_hits': 0,
+            'local_hits': 0,
+            'coalesced': 0,
+            'prefetches': 0,
+            'prefetch_hits': 0,
+            'negative_hits': 0,
+        }
+
+    def ensure(self, image, policy=ALWAYS, prefetch=False):
+        """Make image available locally according to policy, return its digest.
+
+        prefetch=True marks a background pull that nothing is waiting for yet.
+        """
+        if policy not in POLICIES:
+            logger.warning('unknown pull policy %s, using %s', policy, ALWAYS)
+            policy = ALWAYS
+        if policy == DIGEST_PINNED and not is_digest_pinned(image):
+            logger.warning('%s is not pinned by digest, using %s', image, ALWAYS)
+            policy = ALWAYS
+        digest = self._cached(image)
+        if digest is None and policy in (IF_NOT_PRESENT, DIGEST_PINNED):
+            image_info = self._inspect(image)
+            if image_info is not None:
+                with self._lock:
+                    self.stats['local_hits'] += 1
+                digest = self._remember(image, image_digest(image_info), policy == DIGEST_PINNED)
+        if digest is not None:
+            if not prefetch:
+                self._used_prefetched(image, hit=True)
+            return digest
+
+        if not prefetch:
+            # pulled again, the prefetch did not save the pull
+            self._used_prefetched(image, hit=False)
+        self._raise_if_failed(image)
+        return self._pull_once(image, policy == DIGEST_PINNED, prefetch)
+
+    def forget(self, image):
+        """Drop image from the cache, e.g. after it has been removed locally."""
+        with self._lock:
+            self._cache.pop(image, None)
+            self._failed.pop(image, None)
+            self._prefetched.discard(image)
+
+    @contextmanager
+    def paused(self):
+        """Hold back new pulls and wait for the pulls in progress to finish.
+
+        Used to remove images without racing a pull (see imagegc).
+        """
+        with self._lock:
+            self._paused += 1
+            self._lock.wait_for(lambda: not self._flights)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._paused -= 1
+                self._lock.notify_all()
+
+    def _cached(self, image):
+        """Return cached digest of image or None if missing or expired."""
+        with self._lock:
+            entry = self._cache.get(image)
+            if entry is None:
+                return None
+            digest, resolved_at, pinned = entry
+            if not pinned and time.monotonic() - resolved_at >= self.ttl:
+                del self._cache[image]
+                return None
+            self._cache.move_to_end(image)
+            self.stats['cache_hits'] += 1
+            return digest
+
+    def _remember(self, image, digest, pinned):
+        with self._lock:
+            self._cache[image] = (digest, time.monotonic(), pinned)
+            self._cache.move_to_end(image)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return digest
+
+    def _raise_if_failed(self, image):
+        """Raise the error of a pull of image that failed less than negative_ttl ago."""
+        with self._lock:
+            error, failed_at = self._failed.get(image, (None, None))
+            if error is None:
+                return
+            if time.monotonic() - failed_at >= self.negative_ttl:
+                del self._failed[image]
+                return
+            self.stats['negative_hits'] += 1
+        raise error
+
+    def _used_prefetched(self, image, hit):
+        """Forget image was prefetched, count a hit if it was ready without a pull."""
+        with self._lock:
+            if image in self._prefetched:
+                self._prefetched.discard(image)
+                if hit:
+                    self.stats['prefetch_hits'] += 1
+
+    def _pull_once(self, image, pinned, prefetch=False):
+        """Pull image, or wait for a pull of the same image already in progress."""
+        with self._lock:
+            self._lock.wait_for(lambda: not self._paused)
+            flight = self._flights.get(image)
+            leader = flight is None
+            if leader:
+                flight = self._flights[image] = _Flight()
+            else:
+                self.stats['coalesced'] += 1
+            if not prefetch:
+                self.active_pulls += 1
+
+        try:
+            return self._join_or_lead(image, pinned, prefetch, flight, leader)
+        finally:
+            if not prefetch:
+                with self._lock:
+                    self.active_pulls -= 1
+
+    def _join_or_lead(self, image, pinned, prefetch, flight, leader):
+        """Wait for flight of another caller, or pull image as the flight's leader."""
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.digest
+
+        started = time.monotonic()
+        try:
+            pulled_bytes = self._pull(image)
+            image_info = self._inspect(image)
+            digest = image_digest(image_info) if image_info else image
+            flight.digest = self._remember(image, digest, pinned)
+        except Exception as ex:
+            flight.error = ex
+            with self._lock:
+                self.stats['pull_failures'] += 1
+                self._failed[image] = (ex, time.monotonic())
+            raise
+        finally:
+            with self._lock:
+                del self._flights[image]
+                self._lock.notify_all()
+            flight.done.set()
+
+        seconds = time.monotonic() - started
+        with self._lock:
+            self._failed.pop(image, None)
+            if prefetch:
+                self._prefetched.add(image)
+                self.stats['prefetches'] += 1
+            self.stats['pulls'] += 1
+            self.stats['pull_seconds'] += seconds
+            self.stats['bytes_pulled'] += pulled_bytes or 0
+        logger.info('pulled %s (%s bytes) in %.2fs', image, pulled_bytes, seconds)
+        return flight.digest
@@ -0,0 +1,176 @@
+"""
+push keeps a WebSocket open to Halti Master, so desired state is delivered the
+moment it changes instead of with the next heartbeat response.
+
+Messages are JSON objects with a 'type':
+
+- master -> agent: {'type': 'desired_state', 'state': <heartbeat response>}
+  master sends the current desired state right after the socket is opened
+- agent -> master: {'type': 'container_event', 'id': ..., 'action': ...} for
+  every change of a Halti container (see inventory)
+- both ways: {'type': 'ping'} answered with {'type': 'pong'}, the agent pings
+  after settings.PUSH_PING_INTERVAL seconds of silence and reconnects if
+  nothing arrives within another interval
+
+A dropped socket is reconnected with backoff. The HTTP heartbeat keeps running
+regardless, and its responses are used as desired state whenever the channel
+has not delivered one since it (re)connected (see PushChannel.is_authoritative).
+Otherwise every heartbeat delivers the last pushed state again (see
+PushChannel.redeliver), master pushes only changes but the statekeeper still
+needs a state now and then to repair drift and retry failed services.
+"""
+import json
+import logging
+import time
+from threading import Event, Lock, Thread
+
+import websocket
+
+from halti_agent import settings
+from halti_agent.comms import backoff_delay
+
+logger = logging.getLogger('halti-agent-push')
+
+PUSH_URL = '/api/v1/instances/{}/push'
+
+
+def push_url(instance_id):
+    """Return the WebSocket URL of the push channel (http -> ws, https -> wss)."""
+    base = settings.HALTI_SERVER_URL
+    scheme, _, rest = base.partition('://')
+    return '{}://{}{}'.format('wss' if scheme == 'https' else 'ws', rest,
+                              PUSH_URL.format(instance_id))
+
+
+class PushChannel(Thread):
+    """Reconnecting WebSocket to Halti Master."""
+
+    def __init__(self, url, on_desired_state, connect=None, ping_interval=None):
+        """Init channel, on_desired_state(state) is called for every pushed desired state.
+
+        connect(url) opens a websocket.WebSocket, replaceable for testability.
+        """
+        Thread.__init__(self)
+        self.daemon = True
+        self.url = url
+        self._on_desired_state = on_desired_state
+        self._connect = connect or (
+            lambda url: websocket.create_connection(url, timeout=settings.COMMS_TIMEOUT))
+        self.ping_interval = ping_interval or settings.PUSH_PING_INTERVAL
+
+        self._send_lock = Lock()
+        self._ws = None
+        self.connected = Event()
+        # set once a desired state has been received on the current socket
+        self.authoritative = Event()
+        # the latest pushed desired state, delivered under _state_lock
+        self.last_state = None
+        self._state_lock = Lock()
+        self.connects = self.received = 0
+
+    def is_authoritative(self):
+        """Return True if desired state comes from this channel rather than heartbeats."""
+        return self.connected.is_set() and self.authoritative.is_set()
+
+    def redeliver(self):
+        """Deliver the last pushed desired state again, return False if not authoritative."""
+        with self._state_lock:
+            if not self.is_authoritative() or self.last_state is None:
+                return False
+            self._on_desired_state(self.last_state)
+            return True
+
+    def send(self, message):
+        """Send a message if connected, return False if it was not sent."""
+        if not self.connected.is_set():
+            return False
+        try:
+            with self._send_lock:
+                self._ws.send(json.dumps(message))
+        except (websocket.WebSocketException, OSError, AttributeError) as ex:
+            logger.debug('push channel send failed: %s', ex)
+            return False
+        return True
+
+    def send_container_event(self, container_id, action):
+        """Stream a change of a Halti container to master."""
+        return self.send({'type': 'container_event', 'id': container_id, 'action': action})
+
+    def handle(self, message):
+        """Act on a message received from master."""
+        try:
+            message = json.loads(message)
+        except ValueError:
+            message = None
+        if not isinstance(message, dict):
+            logger.warning('invalid push message %r', str(message)[:100])
+            return
+        if message.get('type') == 'desired_state':
+            state = message.get('state')
+            if not isinstance(state, dict):
+                logger.warning('push message without desired state')
+                return
+            self.received += 1
+            with self._state_lock:
+                self.last_state = state
+                self._on_desired_state(state)
+            self.authoritative.set()
+        elif message.get('type') == 'ping':
+            self.send({'type': 'pong'})
+
+    def session(self):
+        """Connect and handle messages until the socket is closed or goes silent.
+
+        After ping_interval seconds of silence master is pinged, if nothing
+        arrives within another ping_interval the socket is considered dead.
+        """
+        ws = self._connect(self.url)
+        ws.settimeout(self.ping_interval)
+        with self._send_lock:
+            self._ws = ws
+        self.connects += 1
+        self.connected.set()
+        logger.info('Push channel connected to %s.', self.url)
+        pinged = False
+        try:
+            while True:
+                try:
+                    message = ws.recv()
+                except websocket.WebSocketTimeoutException:
+                    if pinged:
+                        logger.warning('No pong from master in %.0fs, reconnecting.',
+                                       self.ping_interval)
+                        return
+                    if not self.send({'type': 'ping'}):
+                        return
+                    pinged = True
+                    continue
+                if not message:
+                    return
+                pinged = False
+                try:
+                    self.handle(message)
+                except Exception as ex:
+                    logger.error('handling push message failed: %s', ex, exc_info=True)
+        finally:
+            self.connected.clear()
+            self.authoritative.clear()
+            with self._send_lock:
+                self._ws = None
+            ws.close()
+
+    def run(self):
+        """Keep the channel open forever."""
+        attempt = 0
+        while True:
+            connects = self.connects
+            try:
+                self.session()
+                logger.warning('Push channel closed by master.')
+            except (websocket.WebSocketException, OSError, ValueError) as ex:
+                logger.warning('Push channel failed: %s', ex)
+            except Exception as ex:
+                logger.error('Push channel failed: %s', ex, exc_info=True)
+            # only back off further if the socket never opened
+            attempt = attempt + 1 if self.connects == connects else 0
+            time.sleep(backoff_delay(attempt, cap=settings.PUSH_BACKOFF_CAP))
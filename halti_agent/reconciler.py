@@ -0,0 +1,228 @@
+"""
+reconciler executes the actions statekeeper has decided on.
+
+Actions of services that do not depend on each other are run concurrently
+in a bounded worker pool. The actions of a single service are run
+in order by one worker, so a container is always stopped and removed before
+its replacement is started.
+
+Pulls and starts are capped separately, because pulls are bound by network and
+registry while starts are bound by the Docker daemon.
+
+Services with a rolling update_strategy are updated in place: the new image is
+pulled while the old container keeps running, and the container client swaps
+the containers (see containers.rolling_update).
+
+Services that others depend on (see dependencies) are started first, and
+their dependents only once they are ready.
+
+Failed pulls, starts and updates are recorded to a failures.FailureTracker,
+which puts the service version in backoff.
+"""
+import logging
+import time
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
+
+from halti_agent import comms, logpipeline, settings
+from halti_agent.dependencies import start_levels
+from halti_agent.failures import FailureTracker
+from halti_agent.specs import ROLLING, update_strategy
+
+logger = logging.getLogger('halti-agent-reconciler')
+
+STOP = 'stop'
+PULL = 'pull'
+START = 'start'
+UPDATE = 'update'
+READY = 'ready'
+
+# error is None when the action succeeded
+ActionTiming = namedtuple('ActionTiming', ['service_id', 'action', 'seconds', 'error'])
+
+
+def plan_actions(current, desired, to_remove, to_start):
+    """Group actions by service: {service_id: [(action, target), ...]}.
+
+    Container names are Halti Service UUIDs, so a service being updated ends up
+    with a stop action followed by a start action, or a single update action
+    (target: (container, spec)) if its update_strategy is rolling.
+    """
+    rolling = {service_id for service_id in to_remove & to_start
+               if update_strategy(desired[service_id]).type == ROLLING}
+    plan = OrderedDict()
+    for name in sorted(to_remove - rolling):
+        plan.setdefault(name, []).append((STOP, current[name]))
+    for service_id in sorted(to_start - rolling):
+        plan.setdefault(service_id, []).append((START, desired[service_id]))
+    for service_id in sorted(rolling):
+        plan[service_id] = [(UPDATE, (current[service_id], desired[service_id]))]
+    return plan
+
+
+class Reconciler(object):
+    """Run planned actions with a bounded worker pool."""
+
+    def __init__(self, workers=None, max_pulls=None, max_starts=None, failures=None):
+        """Init concurrency limits, defaults come from settings."""
+        self.workers = workers or settings.RECONCILE_WORKERS
+        self.pull_slots = BoundedSemaphore(max_pulls or settings.RECONCILE_MAX_PULLS)
+        self.start_slots = BoundedSemaphore(max_starts or settings.RECONCILE_MAX_STARTS)
+        self.failures = failures or FailureTracker()
+
+    def run(self, plan, container_client, dependencies=None, running=()):
+        """Run all actions in plan and return a list of ActionTimings.
+
+        Services are run level by level along dependencies ({service_id: {service_id,
+        ...}}, see dependencies.dependency_graph). A service is run only when each
+        service it depends on is either in running (and not in plan) or was started
+        and became ready in an earlier level, otherwise it is left as it is until
+        the next pass.
+
+        Blocks until every service is done. If an action raised, the first
+        exception is re-raised once all the other services have finished.
+        """
+        if not plan:
+            return []
+
+        dependencies = dependencies or {}
+        graph = {service_id: dependencies.get(service_id, set()) for service_id in plan}
+        # services that others wait for are checked to be ready once started
+        gated = set().union(*graph.values()) & set(plan)
+        succeeded = set()
+        timings = []
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(plan))) as pool:
+            for level in start_levels(graph):
+                futures = {}
+                for service_id in sorted(level):
+                    waiting = sorted(dependency for dependency in graph[service_id]
+                                     if dependency not in (succeeded if dependency in plan
+                                                           else running))
+                    if waiting:
+                        logger.warning('not starting %s, waiting for %s', service_id,
+                                       ', '.join(waiting))
+                        continue
+                    futures[service_id] = pool.submit(
+                        self._run_correlated, logpipeline.correlation_id(), service_id,
+                        plan[service_id], container_client, service_id in gated)
+                for service_id, future in futures.items():
+                    service_timings, ok = future.result()
+                    timings.extend(service_timings)
+                    if ok:
+                        succeeded.add(service_id)
+
+        for timing in timings:
+            logger.debug('%s %s took %.3fs', timing.action, timing.service_id, timing.seconds)
+        errors = [timing.error for timing in timings if timing.error is not None]
+        if errors:
+            raise errors[0]
+        return timings
+
+    def _run_correlated(self, correlation_id, *args):
+        """Run _run_service in a worker that logs with the correlation ID of the pass."""
+        if correlation_id is None:
+            return self._run_service(*args)
+        with logpipeline.correlation(correlation_id):
+            return self._run_service(*args)
+
+    def _run_service(self, service_id, actions, container_client, gated=False):
+        """Run actions of one service in order, stop at the first failure.
+
+        Returns (timings, True if every action succeeded). If gated, a started
+        container must also become ready.
+        """
+        timings = []
+        for action, target in actions:
+            steps = self._steps(action, target, container_client)
+            if gated and action in (START, UPDATE):
+                steps += self._ready_steps(target if action == START else target[1],
+                                           container_client)
+            for step, fn in steps:
+                started = time.monotonic()
+                error = None
+                try:
+                    proceed = fn()
+                except Exception as ex:
+                    logger.error('%s %s failed: %s', step, service_id, ex, exc_info=True)
+                    error, proceed = ex, False
+                timings.append(ActionTiming(service_id, step, time.monotonic() - started, error))
+                if proceed is False:
+                    self._record(action, target, error or '{} failed'.format(step))
+                    return timings, False
+            self._record(action, target)
+        return timings, True
+
+    def _record(self, action, target, error=None):
+        """Record the outcome of a start or update to the failure tracker."""
+        if action == START:
+            spec = target
+        elif action == UPDATE:
+            spec = target[1]
+        else:
+            return
+        if error is None:
+            self.failures.succeeded(spec['service_id'], spec['version'])
+        else:
+            self.failures.failed(spec['service_id'], spec['version'], str(error))
+
+    def _steps(self, action, target, container_client):
+        """Return [(step, fn), ...] for an action. fn returning False ends the chain."""
+        if action == STOP:
+            return [(STOP, lambda: self._stop(target, container_client))]
+
+        pull_image = getattr(container_client, 'pull_image', None)
+        if action == UPDATE:
+            container, spec = target
+            rolling_update = getattr(container_client, 'rolling_update', None)
+            if rolling_update is None or pull_image is None:
+                return (self._steps(STOP, container, container_client) +
+                        self._steps(START, spec, container_client))
+            return [
+                (PULL, lambda: self._pull(spec, pull_image)),
+                (UPDATE, lambda: self._update(container, spec, rolling_update)),
+            ]
+
+        if pull_image is None:
+            # client pulls as part of start_container
+            return [(START, lambda: self._start(target, container_client))]
+        return [
+            (PULL, lambda: self._pull(target, pull_image)),
+            (START, lambda: self._start(target, container_client, pull=False)),
+        ]
+
+    def _ready_steps(self, spec, container_client):
+        """Return [(READY, fn)] waiting for spec's container to become ready, if possible."""
+        wait_ready = getattr(container_client, 'wait_ready', None)
+        if wait_ready is None:
+            return []
+        return [(READY, lambda: self._ready(spec, wait_ready))]
+
+    def _ready(self, spec, wait_ready):
+        # containers are named by service_id
+        if wait_ready(spec['service_id'], update_strategy(spec).ready_timeout):
+            return True
+        logger.error('%s did not become ready, not starting its dependents', spec['service_id'])
+        comms.notify_master(comms.Events.START_CONTAINER_FAILED,
+                            '{} not ready'.format(spec['service_id']))
+        return False
+
+    def _stop(self, container, container_client):
+        name = container['Names'][0][1:]
+        logger.info('removing %s', name)
+        comms.notify_master(comms.Events.STOP_CONTAINER, name)
+        container_client.stop_and_remove(container['Id'])
+
+    def _pull(self, spec, pull_image):
+        with self.pull_slots:
+            return pull_image(spec)
+
+    def _start(self, spec, container_client, **kwargs):
+        logger.info('starting %s', spec['service_id'])
+        with self.start_slots:
+            return container_client.start_container(spec=spec, **kwargs)
+
+    def _update(self, container, spec, rolling_update):
+        logger.info('updating %s to %s', spec['service_id'], spec['version'])
+        with self.start_slots:
+            return rolling_update(container, spec)
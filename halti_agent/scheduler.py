@@ -0,0 +1,89 @@
+"""
+scheduler decides when the agent sends its next Halti Heartbeat.
+
+Heartbeats are scheduled on a monotonic clock: each slot is interval seconds
+after the previous slot, not after the previous heartbeat finished, so slow
+heartbeats do not drift the schedule.
+
+The interval adapts to what the node is doing:
+
+- while reconciliation is in progress, or for a few heartbeats after a local
+  container change, heartbeats are sent every settings.HEARTBEAT_MIN_INTERVAL
+- while stable, the interval grows back to the interval given by Halti Master
+  and from there up to settings.HEARTBEAT_STABLE_FACTOR times that
+
+Every slot is jittered by settings.HEARTBEAT_JITTER (a fraction of the
+interval) so a fleet of agents started together spreads out.
+"""
+import random
+import time
+from threading import Event
+
+from halti_agent import settings
+
+
+class HeartbeatScheduler(object):
+    """Drift-free, adaptive and jittered heartbeat timer."""
+
+    def __init__(self, interval, busy=None, min_interval=None, stable_factor=None, jitter=None):
+        """Init scheduler.
+
+        - interval is the heartbeat interval given by Halti Master
+        - busy() returns True while reconciliation is in progress
+        """
+        self.interval = interval
+        self.min_interval = min(interval, min_interval or settings.HEARTBEAT_MIN_INTERVAL)
+        self.max_interval = interval * (stable_factor or settings.HEARTBEAT_STABLE_FACTOR)
+        self.jitter = settings.HEARTBEAT_JITTER if jitter is None else jitter
+        self._busy = busy or (lambda: False)
+        self._poked = Event()
+        self._fast_ticks = 0
+        self._slot = None
+        self._last_tick = None
+        self.current_interval = interval
+        self.ticks = 0
+
+    def poke(self):
+        """Local containers changed: report soon and keep heartbeats fast for a while."""
+        self._fast_ticks = settings.HEARTBEAT_FAST_TICKS
+        self._poked.set()
+
+    def next_interval(self):
+        """Return the interval until the next heartbeat slot."""
+        if self._busy() or self._fast_ticks > 0:
+            self._fast_ticks = max(0, self._fast_ticks - 1)
+            self.current_interval = self.min_interval
+        elif self.current_interval < self.interval:
+            self.current_interval = self.interval
+        else:
+            self.current_interval = min(self.max_interval, self.current_interval * 1.5)
+        return self.current_interval
+
+    def wait(self):
+        """Sleep until the next heartbeat is due."""
+        now = time.monotonic()
+        interval = self.next_interval()
+        if self._slot is None:
+            # random phase so agents started at the same time spread out
+            self._slot = now + random.uniform(0, self.jitter * interval)
+            self._last_tick = now
+
+        self._slot += interval
+        if self._slot < now:
+            # the previous heartbeat overran this slot, do not burst to catch up
+            self._slot = now
+        deadline = self._slot + random.uniform(-self.jitter, self.jitter) * interval / 2
+
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if self._poked.wait(remaining):
+                self._poked.clear()
+                # report local changes soon, but not more often than min_interval
+                earliest = self._last_tick + self.min_interval
+                if earliest < deadline:
+                    deadline = self._slot = earliest
+
+        self._last_tick = time.monotonic()
+        self.ticks += 1
@@ -7,13 +7,14 @@ that is read and its content loaded as environment variables with `load_dotenv`.
 This allows specifying envs (for `get_env`) in a file rather than as actual
 environment variables. This is useful for development, however, the file
 should always be empty in production.
+
+Importing settings has no other side-effects: logging is configured by
+`configure_logging` and `docker_options` (which imports docker) are built on first use.
 """
 
 import logging
-from logging.config import dictConfig as LOGGING_CONFIG
 import os
 from os.path import dirname
-from docker.utils import kwargs_from_env
 
 
 def get_env(env, default=None):
@@ -27,8 +28,11 @@ def get_env(env, default=None):
 
 
 def load_dotenv():
-    """Load environment variables from .env"""
-    with open(os.path.join(BASE_DIR, '.env')) as f:
+    """Load environment variables from .env if there is one."""
+    path = os.path.join(BASE_DIR, '.env')
+    if not os.path.exists(path):
+        return
+    with open(path) as f:
         for line in f:
             line = line.strip()
             if not line or line.startswith('#') or '=' not in line:
@@ -52,11 +56,148 @@ ALLOW_INSECURE_REGISTRY = get_env('ALLOW_INSEC_REGISTRY', False)
 CAPABILITIES = get_env('CAPABILITIES', '').split(',')
 
 STATE_FILE = 'state.json'
-
-DOCKER_OPTIONS = options = {
-    **kwargs_from_env(),
-    'version': 'auto'
-}
+# applied desired states, used to resume after a restart (see journal)
+STATE_JOURNAL_FILE = get_env('STATE_JOURNAL_FILE', 'journal.jsonl')
+STATE_JOURNAL_MAX_ENTRIES = int(get_env('STATE_JOURNAL_MAX_ENTRIES', 100))
+# report ready at start if running containers match the journal (see statekeeper)
+WARM_START = get_env('WARM_START', True)
+
+# Halti Master connections (see comms)
+COMMS_TIMEOUT = float(get_env('COMMS_TIMEOUT', 10))
+COMMS_RETRIES = int(get_env('COMMS_RETRIES', 2))
+COMMS_BACKOFF_BASE = float(get_env('COMMS_BACKOFF_BASE', 0.5))
+COMMS_BACKOFF_CAP = float(get_env('COMMS_BACKOFF_CAP', 30))
+COMMS_POOL_CONNECTIONS = int(get_env('COMMS_POOL_CONNECTIONS', 2))
+COMMS_POOL_MAXSIZE = int(get_env('COMMS_POOL_MAXSIZE', 4))
+
+# Halti Events are sent in batches, NOTIFY_BATCH_SIZE=1 sends them one by one
+NOTIFY_BATCH_SIZE = int(get_env('NOTIFY_BATCH_SIZE', 50))
+NOTIFY_BATCH_WINDOW = float(get_env('NOTIFY_BATCH_WINDOW', 0.5))
+EVENT_BUFFER_SIZE = int(get_env('EVENT_BUFFER_SIZE', 1000))
+# events are spooled here while master is unreachable
+EVENT_SPOOL_FILE = get_env('EVENT_SPOOL_FILE', 'events.spool')
+EVENT_SPOOL_SIZE = int(get_env('EVENT_SPOOL_SIZE', 10000))
+
+# adaptive heartbeat schedule (see scheduler), intervals are in seconds
+HEARTBEAT_MIN_INTERVAL = float(get_env('HEARTBEAT_MIN_INTERVAL', 1))
+# >1 lets a stable node heartbeat less often than master's heartbeat_interval
+HEARTBEAT_STABLE_FACTOR = float(get_env('HEARTBEAT_STABLE_FACTOR', 1))
+HEARTBEAT_FAST_TICKS = int(get_env('HEARTBEAT_FAST_TICKS', 3))
+HEARTBEAT_JITTER = float(get_env('HEARTBEAT_JITTER', 0.1))
+
+# metrics exporter (see metrics), disabled unless a port or socket is set
+METRICS_PORT = get_env('METRICS_PORT')
+METRICS_BIND = get_env('METRICS_BIND', '127.0.0.1')
+METRICS_SOCKET = get_env('METRICS_SOCKET')
+# log a span tree of every reconcile pass
+TRACING = get_env('TRACING', False)
+
+# 'delta' sends only changed container fields once master acknowledges heartbeats
+HEARTBEAT_MODE = get_env('HEARTBEAT_MODE', 'delta')
+# request body compression of heartbeats: 'gzip', 'deflate' or empty for none
+HEARTBEAT_COMPRESSION = get_env('HEARTBEAT_COMPRESSION') or None
+
+# background image prefetching (see prefetch)
+PREFETCH_DESIRED = get_env('PREFETCH_DESIRED', False)
+PREFETCH_CONCURRENCY = int(get_env('PREFETCH_CONCURRENCY', 1))
+# 0 disables the bandwidth budget
+PREFETCH_MAX_BYTES_PER_MINUTE = int(get_env('PREFETCH_MAX_BYTES_PER_MINUTE', 500 * 1024 ** 2))
+PREFETCH_IDLE_POLL = float(get_env('PREFETCH_IDLE_POLL', 1))
+# an offered image is offered again after this many seconds (e.g. once image GC removed it),
+# at most PREFETCH_SEEN_SIZE offered images are remembered
+PREFETCH_SEEN_TTL = float(get_env('PREFETCH_SEEN_TTL', 600))
+PREFETCH_SEEN_SIZE = int(get_env('PREFETCH_SEEN_SIZE', 1024))
+
+# container resource usage sampling (see stats)
+STATS_ENABLED = get_env('STATS_ENABLED', True)
+STATS_INTERVAL = float(get_env('STATS_INTERVAL', 10))
+STATS_WORKERS = int(get_env('STATS_WORKERS', 4))
+# samples per container that percentiles are calculated from
+STATS_WINDOW = int(get_env('STATS_WINDOW', 30))
+
+# WebSocket push channel from master, heartbeats remain the fallback (see push)
+PUSH_ENABLED = get_env('PUSH_ENABLED', False)
+PUSH_PING_INTERVAL = float(get_env('PUSH_PING_INTERVAL', 30))
+PUSH_BACKOFF_CAP = float(get_env('PUSH_BACKOFF_CAP', 60))
+
+# shipping of container stdout/stderr (see logship)
+LOG_SHIP_ENABLED = get_env('LOG_SHIP_ENABLED', False)
+# 'master' or 'file'
+LOG_SHIP_SINK = get_env('LOG_SHIP_SINK', 'master')
+LOG_SHIP_FILE = get_env('LOG_SHIP_FILE', 'container-logs.jsonl.gz')
+LOG_SHIP_FILE_MAX_BYTES = int(get_env('LOG_SHIP_FILE_MAX_BYTES', 100 * 1024 ** 2))
+# lines kept per container until shipped, older lines are dropped
+LOG_SHIP_BUFFER_LINES = int(get_env('LOG_SHIP_BUFFER_LINES', 1000))
+LOG_SHIP_BATCH_LINES = int(get_env('LOG_SHIP_BATCH_LINES', 500))
+LOG_SHIP_FLUSH_INTERVAL = float(get_env('LOG_SHIP_FLUSH_INTERVAL', 2))
+# longer lines are truncated
+LOG_SHIP_MAX_LINE = int(get_env('LOG_SHIP_MAX_LINE', 16 * 1024))
+
+# node capacity reports in heartbeats (see capacity)
+CAPACITY_INTERVAL = float(get_env('CAPACITY_INTERVAL', 15))
+# relative change of a value that makes a report worth sending
+CAPACITY_THRESHOLD = float(get_env('CAPACITY_THRESHOLD', 0.1))
+CAPACITY_MAX_AGE = float(get_env('CAPACITY_MAX_AGE', 600))
+
+# removal of unused images under disk pressure (see imagegc)
+IMAGE_GC_ENABLED = get_env('IMAGE_GC_ENABLED', True)
+IMAGE_GC_INTERVAL = float(get_env('IMAGE_GC_INTERVAL', 300))
+# previous images kept per desired service for rollbacks
+IMAGE_GC_KEEP_VERSIONS = int(get_env('IMAGE_GC_KEEP_VERSIONS', 2))
+IMAGE_GC_HIGH_WATERMARK = float(get_env('IMAGE_GC_HIGH_WATERMARK', 0.85))
+IMAGE_GC_LOW_WATERMARK = float(get_env('IMAGE_GC_LOW_WATERMARK', 0.75))
+# filesystem to watch, Docker's root dir by default
+IMAGE_GC_PATH = get_env('IMAGE_GC_PATH')
+
+# rolling updates wait this long (seconds) for a new container to become ready
+READY_TIMEOUT = float(get_env('READY_TIMEOUT', 60))
+# a running container without healthcheck or ports is ready after this long
+READY_GRACE = float(get_env('READY_GRACE', 2))
+READY_POLL_INTERVAL = float(get_env('READY_POLL_INTERVAL', 0.5))
+
+# cores handed out to services with exclusive_cpus, e.g. '2-7' (see cpusets)
+CPUSET_POOL = get_env('CPUSET_POOL', '')
+# limit containers to their service's 'memory' and 'cpu' fields (see specs)
+ENFORCE_SERVICE_LIMITS = get_env('ENFORCE_SERVICE_LIMITS', False)
+
+# compiled service specs kept in memory (see specs)
+SPEC_CACHE_SIZE = int(get_env('SPEC_CACHE_SIZE', 512))
+
+# full container listings to repair the event-fed inventory
+INVENTORY_RESYNC_INTERVAL = float(get_env('INVENTORY_RESYNC_INTERVAL', 300))
+INVENTORY_RETRY_INTERVAL = float(get_env('INVENTORY_RETRY_INTERVAL', 5))
+
+# default pull policy of services without 'pull_policy' (see pulls.POLICIES)
+PULL_POLICY = get_env('PULL_POLICY', 'always')
+PULL_CACHE_TTL = float(get_env('PULL_CACHE_TTL', 30))
+PULL_CACHE_SIZE = int(get_env('PULL_CACHE_SIZE', 256))
+# a failed pull of an image is not repeated for this many seconds
+PULL_NEGATIVE_TTL = float(get_env('PULL_NEGATIVE_TTL', 60))
+
+# reconciliation concurrency (see reconciler)
+RECONCILE_WORKERS = int(get_env('RECONCILE_WORKERS', 8))
+RECONCILE_MAX_PULLS = int(get_env('RECONCILE_MAX_PULLS', 2))
+RECONCILE_MAX_STARTS = int(get_env('RECONCILE_MAX_STARTS', 4))
+# backoff of service versions that fail to start (see failures)
+FAILURE_BACKOFF_BASE = float(get_env('FAILURE_BACKOFF_BASE', 10))
+FAILURE_BACKOFF_CAP = float(get_env('FAILURE_BACKOFF_CAP', 600))
+# an unchanged desired state is reconciled again after this many seconds
+RECONCILE_RESYNC_INTERVAL = float(get_env('RECONCILE_RESYNC_INTERVAL', 60))
+
+# negotiated Docker API versions, so version='auto' talks to the daemon only once
+DOCKER_VERSION_CACHE = get_env('DOCKER_VERSION_CACHE', 'docker_api_version.json')
+
+
+_docker_options = None
+
+
+def docker_options():
+    """Return docker.Client keyword arguments from DOCKER_HOST etc., built on first use."""
+    global _docker_options
+    if _docker_options is None:
+        from docker.utils import kwargs_from_env
+        _docker_options = dict(kwargs_from_env(), version=get_env('DOCKER_API_VERSION', 'auto'))
+    return _docker_options
 
 
 LOG_LEVEL_MAP = {
@@ -67,19 +208,18 @@ LOG_LEVEL_MAP = {
 }
 
 LOG_LEVEL = LOG_LEVEL_MAP.get(get_env('LOG_LEVEL'), 'INFO')
-
-LOGGING_CONFIG({
-    'version': 1,
-    'formatters': {
-        'f': {'format': '%(asctime)s - %(name)s - %(levelname)s - %(message)s'}
-    },
-    'handlers': {
-        'h': {'class': 'logging.StreamHandler',
-              'formatter': 'f',
-              'level': LOG_LEVEL}
-    },
-    'root': {
-        'handlers': ['h'],
-        'level': LOG_LEVEL,
-    },
-})
+# 'text' or 'json' (one object per line), see logpipeline
+LOG_FORMAT = get_env('LOG_FORMAT', 'text')
+# records queued for the writer thread, more are dropped
+LOG_QUEUE_SIZE = int(get_env('LOG_QUEUE_SIZE', 10000))
+# warnings and errors passed per call site and interval, 0 disables the limit
+LOG_RATE_BURST = int(get_env('LOG_RATE_BURST', 10))
+LOG_RATE_INTERVAL = float(get_env('LOG_RATE_INTERVAL', 60))
+
+
+def configure_logging():
+    """Configure logging of the agent process (see logpipeline)."""
+    from halti_agent import logpipeline
+    return logpipeline.configure(LOG_LEVEL, json_format=LOG_FORMAT == 'json',
+                                 queue_size=LOG_QUEUE_SIZE, rate_burst=LOG_RATE_BURST,
+                                 rate_interval=LOG_RATE_INTERVAL)
@@ -0,0 +1,405 @@
+"""
+specs translates Halti Services into Docker create_container parameters.
+
+A spec is validated and translated once into an immutable ContainerParams.
+Compiled specs are cached by (service_id, version, spec fingerprint), so
+restarting the same service again and again (a crash loop, a mass redeploy)
+reuses the translation and its host config.
+
+All problems of a spec are collected and raised together as a SpecError.
+
+A spec may limit the resources of its container with a 'resources' block:
+
+    {'memory': '512m', 'memory_swap': '1g', 'cpu_shares': 512, 'cpus': 1.5,
+     'cpuset_cpus': '0-1', 'exclusive_cpus': 2, 'pids_limit': 100,
+     'ulimits': [{'name': 'nofile', 'soft': 1024, 'hard': 2048}]}
+
+'cpus' is a CFS quota in cores (cpu_quota and cpu_period can be given instead).
+'exclusive_cpus' asks for cores no other container is pinned to, which are
+assigned when the container is created (see cpusets).
+
+With settings.ENFORCE_SERVICE_LIMITS the service's own 'memory' (megabytes)
+and 'cpu' (cores) fields are the default memory limit and CPU quota, the
+'resources' block overrides them. It is off by default: the fields have been
+placement hints only, and services that exceed them would be OOM-killed or
+throttled. reservation() counts them either way.
+"""
+from collections import namedtuple, OrderedDict
+import logging
+import re
+from threading import Lock
+
+from halti_agent import settings
+from halti_agent.errors import HaltiException
+from halti_agent.func_utils import fingerprint
+
+logger = logging.getLogger('halti-agent')
+
+REQUIRED_FIELDS = ('service_id', 'name', 'version', 'image', 'environment', 'ports')
+PROTOCOLS = ('tcp', 'udp')
+
+# bytes, optionally with a unit as Docker accepts them
+MEMORY_PATTERN = re.compile(r'^\d+[bkmg]?$', re.IGNORECASE)
+MEMORY_UNITS = {'': 1, 'b': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+CPUSET_PATTERN = re.compile(r'^\d+(-\d+)?(,\d+(-\d+)?)*$')
+CPU_PERIOD = 100000
+# container label of the cores assigned for exclusive_cpus
+CPUSET_LABEL = 'cpuset'
+
+RECREATE = 'recreate'
+ROLLING = 'rolling'
+
+# A node runs one instance of a service, so max_surge >= 1 allows the new version
+# to run next to the old one and max_unavailable >= 1 allows a stop before start.
+UpdateStrategy = namedtuple('UpdateStrategy', ['type', 'max_surge', 'max_unavailable',
+                                               'ready_timeout'])
+
+
+class SpecError(HaltiException):
+    """Halti Service cannot be translated to a container."""
+
+    def __init__(self, service_id, errors):
+        HaltiException.__init__(self, 'invalid spec {}: {}'.format(service_id, '; '.join(errors)))
+        self.service_id = service_id
+        self.errors = errors
+
+
+class ContainerParams(namedtuple('ContainerParams', [
+        'image', 'name', 'ports', 'environment', 'labels', 'host_config', 'command',
+        'exclusive_cpus'])):
+    """Compiled Halti Service. environment and labels are tuples of (key, value) pairs.
+
+    host_config is shared between starts and must not be modified.
+    """
+
+    def create_kwargs(self, name=None, cpuset=None):
+        """Return keyword arguments for docker_client.create_container.
+
+        cpuset pins the container to the cores assigned for exclusive_cpus.
+        """
+        kwargs = {
+            'image': self.image,
+            'name': name or self.name,
+            'ports': list(self.ports),
+            'environment': dict(self.environment),
+            'labels': dict(self.labels),
+            'host_config': self.host_config,
+        }
+        if cpuset:
+            kwargs['labels'][CPUSET_LABEL] = cpuset
+            kwargs['host_config'] = dict(self.host_config, CpusetCpus=cpuset)
+        if self.command:
+            kwargs['command'] = self.command
+        return kwargs
+
+
+def _count(strategy, key, default, errors):
+    value = strategy.get(key, default)
+    if (isinstance(value, bool) or not isinstance(value, int) and not _is_digit(value) or
+            int(value) < 0):
+        errors.append('update_strategy {} must be a non-negative integer'.format(key))
+        return default
+    return int(value)
+
+
+def translate_update_strategy(spec, errors):
+    """Return UpdateStrategy of spec's 'update_strategy' (default: recreate)."""
+    strategy = spec.get('update_strategy') or {}
+    if not isinstance(strategy, dict):
+        errors.append('update_strategy must be an object')
+        strategy = {}
+    strategy_type = strategy.get('type', RECREATE)
+    if strategy_type not in (RECREATE, ROLLING):
+        errors.append('unknown update_strategy type {!r}'.format(strategy_type))
+        strategy_type = RECREATE
+    ready_timeout = strategy.get('ready_timeout', settings.READY_TIMEOUT)
+    try:
+        ready_timeout = float(ready_timeout)
+        if ready_timeout <= 0:
+            raise ValueError(ready_timeout)
+    except (TypeError, ValueError):
+        errors.append('update_strategy ready_timeout must be a positive number')
+        ready_timeout = settings.READY_TIMEOUT
+    return UpdateStrategy(
+        type=strategy_type,
+        max_surge=_count(strategy, 'max_surge', 1, errors),
+        max_unavailable=_count(strategy, 'max_unavailable', 0, errors),
+        ready_timeout=ready_timeout,
+    )
+
+
+def update_strategy(spec):
+    """Return UpdateStrategy of spec's 'update_strategy', recreate if it is invalid.
+
+    Never raises, compile_spec reports an invalid update_strategy as a SpecError.
+    """
+    errors = []
+    strategy = translate_update_strategy(spec, errors)
+    if errors:
+        logger.warning('%s: %s, recreating', spec.get('service_id'), '; '.join(errors))
+        return UpdateStrategy(RECREATE, 1, 0, settings.READY_TIMEOUT)
+    return strategy
+
+
+def binds_host_ports(spec):
+    """Return True if spec binds fixed host ports, which two containers cannot share."""
+    return any(isinstance(port, dict) and 'source' in port for port in spec['ports'])
+
+
+def _is_digit(port):
+    return hasattr(port, 'isdigit') and port.isdigit()
+
+
+def translate_ports(ports, errors):
+    """Return (port declarations, port bindings) of a spec's ports."""
+    declarations = []
+    bindings = {}
+    for port in ports:
+        if type(port) is int or _is_digit(port):
+            # for backwards compatibility
+            declarations.append(port)
+            bindings[int(port)] = (settings.PORT_BIND_IP,)
+            continue
+        if not isinstance(port, dict) or 'port' not in port:
+            errors.append('invalid port {!r}'.format(port))
+            continue
+        protocol = port.get('protocol', 'tcp')
+        if protocol not in PROTOCOLS:
+            errors.append('invalid protocol {!r} of port {}'.format(protocol, port['port']))
+            continue
+        if protocol == 'udp':
+            declarations.append((port['port'], 'udp'))
+        else:
+            declarations.append(port['port'])
+
+        key = '{}/{}'.format(port['port'], protocol)
+        if 'source' in port:
+            bindings[key] = (settings.PORT_BIND_IP, port['source'])
+        else:
+            bindings[key] = (settings.PORT_BIND_IP,)
+    return declarations, bindings
+
+
+def translate_environment(spec, errors):
+    """Return a spec's environment as a dict, HALTI_SERVICE_ID overriding clashes."""
+    env = {}
+    for env_pair in spec['environment']:
+        if not isinstance(env_pair, dict) or 'key' not in env_pair or 'value' not in env_pair:
+            errors.append('invalid environment variable {!r}'.format(env_pair))
+            continue
+        env[env_pair['key']] = env_pair['value']
+    env['HALTI_SERVICE_ID'] = spec['service_id']
+    return env
+
+
+def translate_extra_hosts(spec, errors):
+    """Return a spec's extra_hosts as a dict or None."""
+    if 'extra_hosts' not in spec:
+        return None
+    logger.info('Extra hosts defined in spec %s', spec['name'])
+    extra_hosts = {}
+    for host in spec['extra_hosts']:
+        if not isinstance(host, dict) or 'host' not in host or 'ip' not in host:
+            errors.append('invalid extra host {!r}'.format(host))
+            continue
+        extra_hosts[host['host']] = host['ip']
+    return extra_hosts
+
+
+def _positive_int(resources, key, errors):
+    value = resources.get(key)
+    if value is None:
+        return None
+    if type(value) is not int or value <= 0:
+        errors.append('invalid {} {!r}'.format(key, value))
+        return None
+    return value
+
+
+def _service_limits(spec, errors):
+    """Return create_host_config kwargs of the service's 'memory' and 'cpu' fields."""
+    limits = {}
+    memory, cpu = spec.get('memory'), spec.get('cpu')
+    if memory:
+        if type(memory) in (int, float) and memory > 0:
+            limits['mem_limit'] = int(memory * MEMORY_UNITS['m'])
+        else:
+            errors.append('invalid memory {!r}'.format(memory))
+    if cpu:
+        if type(cpu) in (int, float) and cpu > 0:
+            limits['cpu_period'] = CPU_PERIOD
+            limits['cpu_quota'] = int(cpu * CPU_PERIOD)
+        else:
+            errors.append('invalid cpu {!r}'.format(cpu))
+    return limits
+
+
+def translate_resources(spec, errors, service_limits=None):
+    """Return (create_host_config kwargs, exclusive cpu count) of a spec's resources.
+
+    If service_limits (default: settings.ENFORCE_SERVICE_LIMITS), the service's
+    'memory' and 'cpu' fields are used unless resources limit the memory or CPU
+    time themselves.
+    """
+    resources = spec.get('resources') or {}
+    if not isinstance(resources, dict):
+        errors.append('invalid resources {!r}'.format(resources))
+        return {}, 0
+
+    if service_limits is None:
+        service_limits = settings.ENFORCE_SERVICE_LIMITS
+    limits = _service_limits(spec, errors) if service_limits else {}
+    if any(key in resources for key in ('cpus', 'cpu_quota', 'cpu_period', 'exclusive_cpus')):
+        limits.pop('cpu_quota', None)
+        limits.pop('cpu_period', None)
+    for key, kwarg in (('memory', 'mem_limit'), ('memory_swap', 'memswap_limit')):
+        value = resources.get(key)
+        if value is None:
+            continue
+        if type(value) is int and value > 0 or (isinstance(value, str) and
+                                                MEMORY_PATTERN.match(value)):
+            limits[kwarg] = value
+        else:
+            errors.append('invalid {} {!r}'.format(key, value))
+
+    for key in ('cpu_shares', 'cpu_quota', 'cpu_period', 'pids_limit'):
+        value = _positive_int(resources, key, errors)
+        if value is not None:
+            limits[key] = value
+
+    cpus = resources.get('cpus')
+    if cpus is not None:
+        if not isinstance(cpus, (int, float)) or cpus <= 0:
+            errors.append('invalid cpus {!r}'.format(cpus))
+        else:
+            limits['cpu_period'] = limits.get('cpu_period', CPU_PERIOD)
+            limits['cpu_quota'] = int(cpus * limits['cpu_period'])
+
+    cpuset = resources.get('cpuset_cpus')
+    exclusive_cpus = _positive_int(resources, 'exclusive_cpus', errors) or 0
+    if cpuset is not None:
+        if not isinstance(cpuset, str) or not CPUSET_PATTERN.match(cpuset):
+            errors.append('invalid cpuset_cpus {!r}'.format(cpuset))
+        elif exclusive_cpus:
+            errors.append('cpuset_cpus and exclusive_cpus cannot be used together')
+        else:
+            limits['cpuset_cpus'] = cpuset
+
+    ulimits = resources.get('ulimits')
+    if ulimits is not None:
+        limits['ulimits'] = []
+        for ulimit in ulimits if isinstance(ulimits, list) else [ulimits]:
+            if (not isinstance(ulimit, dict) or 'name' not in ulimit or
+                    not all(type(ulimit.get(key, 0)) is int for key in ('soft', 'hard'))):
+                errors.append('invalid ulimit {!r}'.format(ulimit))
+                continue
+            limits['ulimits'].append({key: ulimit[key] for key in ('name', 'soft', 'hard')
+                                      if key in ulimit})
+    return limits, exclusive_cpus
+
+
+def memory_bytes(value):
+    """'512m' => 536870912, value is a valid memory limit."""
+    if type(value) is int:
+        return value
+    unit = value[-1].lower() if value[-1].isalpha() else ''
+    return int(value[:len(value) - len(unit)]) * MEMORY_UNITS[unit]
+
+
+def reservation(spec):
+    """Return (memory bytes, cores) spec reserves, 0 when unlimited.
+
+    The reservation is what the container is limited to, with the service's
+    'memory' and 'cpu' fields counted whether they are enforced or not. Cores
+    are the CPU quota or the exclusive CPUs, invalid fields are ignored.
+    """
+    limits, exclusive_cpus = translate_resources(spec, [], service_limits=True)
+    memory = memory_bytes(limits['mem_limit']) if 'mem_limit' in limits else 0
+    if exclusive_cpus:
+        cpus = exclusive_cpus
+    elif 'cpu_quota' in limits:
+        cpus = limits['cpu_quota'] / limits.get('cpu_period', CPU_PERIOD)
+    else:
+        cpus = 0
+    return memory, cpus
+
+
+def compile_spec(spec, create_host_config):
+    """Validate and translate spec (= Halti Service) into ContainerParams.
+
+    create_host_config(**kwargs) builds Docker's host config.
+    Raises SpecError listing every problem found.
+    """
+    missing = [field for field in REQUIRED_FIELDS if field not in spec]
+    if missing:
+        raise SpecError(spec.get('service_id'), ['missing {}'.format(f) for f in missing])
+
+    errors = []
+    env = translate_environment(spec, errors)
+    ports_declaration, ports = translate_ports(spec['ports'], errors)
+    extra_hosts = translate_extra_hosts(spec, errors)
+    limits, exclusive_cpus = translate_resources(spec, errors)
+    translate_update_strategy(spec, errors)
+    if errors:
+        raise SpecError(spec['service_id'], errors)
+
+    labels = {'halti': 'true',
+              'service': spec['name'],
+              'version': spec['version']}
+
+    command = None
+    if 'command' in spec and len(spec.get('command')) > 0:
+        logger.info('Command defined in spec %s', spec['name'])
+        command = spec.get('command')
+
+    try:
+        host_config = create_host_config(
+            restart_policy={'Name': 'always'},
+            extra_hosts=extra_hosts,
+            port_bindings=ports,
+            **limits
+        )
+    except Exception as ex:
+        # e.g. the Docker API version does not support a limit
+        raise SpecError(spec['service_id'], [str(ex)])
+
+    return ContainerParams(
+        image=spec['image'],
+        name=spec['service_id'],
+        ports=tuple(ports_declaration),
+        environment=tuple(sorted(env.items())),
+        labels=tuple(sorted(labels.items())),
+        host_config=host_config,
+        command=command,
+        exclusive_cpus=exclusive_cpus,
+    )
+
+
+class SpecCompiler(object):
+    """compile_spec with a bounded LRU cache."""
+
+    def __init__(self, create_host_config, max_entries=None):
+        """Init compiler, create_host_config(**kwargs) builds Docker's host config."""
+        self._create_host_config = create_host_config
+        self.max_entries = max_entries or settings.SPEC_CACHE_SIZE
+        self._lock = Lock()
+        self._cache = OrderedDict()
+        self.hits = self.misses = 0
+
+    def compile(self, spec):
+        """Return ContainerParams of spec, raises SpecError."""
+        key = (spec.get('service_id'), spec.get('version'), fingerprint(spec))
+        with self._lock:
+            params = self._cache.get(key)
+            if params is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return params
+
+        params = compile_spec(spec, self._create_host_config)
+        with self._lock:
+            self.misses += 1
+            self._cache[key] = params
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return params
@@ -0,0 +1,64 @@
+"""
+spool is a small file-backed FIFO of JSON serialisable items.
+
+Items are stored one JSON document per line. Reads skip lines that cannot be
+parsed, e.g. a line that was only partially written when the agent crashed.
+"""
+import json
+import logging
+
+from halti_agent.journal import write_atomic
+
+logger = logging.getLogger('halti-agent')
+
+
+class Spool(object):
+    """FIFO of at most max_items items stored in a JSON lines file."""
+
+    def __init__(self, path, max_items):
+        """Init spool, items left in path by a previous run are kept."""
+        self.path = path
+        self.max_items = max_items
+        self.dropped = 0
+        self._count = len(self._read())
+
+    def __len__(self):
+        return self._count
+
+    def extend(self, items):
+        """Append items, dropping the oldest items if max_items is exceeded."""
+        items = list(items)
+        if not items:
+            return
+        with open(self.path, 'a') as spool_file:
+            for item in items:
+                spool_file.write(json.dumps(item) + '\n')
+        self._count += len(items)
+        if self._count > self.max_items:
+            excess = self._count - self.max_items
+            logger.warning('spool %s full, dropping %s items', self.path, excess)
+            self.dropped += excess
+            self.pop(excess)
+
+    def peek(self, n):
+        """Return (up to) the n oldest items."""
+        return self._read()[:n]
+
+    def pop(self, n):
+        """Remove the n oldest items."""
+        items = self._read()[n:]
+        write_atomic(self.path, ''.join(json.dumps(item) + '\n' for item in items))
+        self._count = len(items)
+
+    def _read(self):
+        items = []
+        try:
+            with open(self.path) as spool_file:
+                for line in spool_file:
+                    try:
+                        items.append(json.loads(line))
+                    except ValueError:
+                        logger.warning('skipping corrupt line in %s', self.path)
+        except FileNotFoundError:
+            pass
+        return items
@@ -8,6 +8,7 @@ import multiprocessing
 import platform
 
 from halti_agent import settings, comms
+from halti_agent.journal import write_atomic
 
 logger = logging.getLogger('halti-agent')
 
@@ -19,22 +20,21 @@ def load_persisted_state():
 
 
 def persist_state(state):
-    """Persist state into STATE_FILE."""
-    with open(settings.STATE_FILE, 'w') as state_file:
-        json.dump(state, state_file)
+    """Persist state into STATE_FILE atomically."""
+    write_atomic(settings.STATE_FILE, json.dumps(state))
 
 
 def load_state(container_client):
     """Load state from settings.STATE_FILE or Halti Master."""
     try:
         state = load_persisted_state()
-        logger.info('Loaded state from {}.'.format(settings.STATE_FILE))
-    except OSError:
-        logger.info('{} not available, registering with master'.format(settings.STATE_FILE))
-        state = comms.register(platform_state(container_client.docker_client))
-        logger.info('Registered with master at {}.'.format(settings.HALTI_SERVER_URL))
+        logger.info('Loaded state from %s.', settings.STATE_FILE)
+    except (OSError, ValueError) as ex:
+        logger.info('%s not available (%s), registering with master', settings.STATE_FILE, ex)
+        state = comms.register(platform_state(container_client.get_docker_client()))
+        logger.info('Registered with master at %s.', settings.HALTI_SERVER_URL)
         persist_state(state)
-        logger.info('State saved to {}.'.format(settings.STATE_FILE))
+        logger.info('State saved to %s.', settings.STATE_FILE)
     return state
 
 
@@ -8,13 +8,20 @@ Statekeeper receives all methods and classes that have side-effects as params
 for testability. (see: StatekeeperWorker.__init__)
 """
 import logging
-from threading import Thread
+import time
+from threading import Event, Thread
 
-from halti_agent import comms
-from halti_agent.func_utils import diff
+from halti_agent import comms, logpipeline, metrics, settings
+from halti_agent.dependencies import (critical_path, dependency_graph, DependencyCycle,
+                                      start_levels)
+from halti_agent.func_utils import diff, fingerprint
+from halti_agent.reconciler import Reconciler, plan_actions
 
 logger = logging.getLogger('halti-agent-statekeeper')
 
+# spec fields set_state reads before a spec is compiled
+PLANNED_FIELDS = ('service_id', 'version', 'image')
+
 
 def current_and_desired(containers, desired_services):
     """Index current and desired state."""
@@ -30,11 +37,39 @@ def current_and_desired(containers, desired_services):
     return current, desired
 
 
-def determine_container_actions(current, desired):
+def is_plannable(service):
+    """Return True if service has the PLANNED_FIELDS set_state reads."""
+    return isinstance(service, dict) and all(
+        isinstance(service.get(field), str) for field in PLANNED_FIELDS)
+
+
+def plannable_services(services):
+    """Return (services set_state can plan with, service_ids of the others).
+
+    A service without a service_id, version or image is neither started nor, if
+    it is running, removed.
+    """
+    plannable, held = [], set()
+    for service in services:
+        if is_plannable(service):
+            plannable.append(service)
+            continue
+        service_id = service.get('service_id') if isinstance(service, dict) else None
+        logger.error('Ignoring invalid service %s, %s are required', service_id,
+                     ', '.join(PLANNED_FIELDS))
+        if isinstance(service_id, str):
+            held.add(service_id)
+    return plannable, held
+
+
+def determine_container_actions(current, desired, skip=None):
     """Return services (to_remove, to_start) 2-tuple based on state.
 
     - to_remove contains container names
     - to_start contains Halti Service UUIDs
+
+    Services for which skip(service_id, version) returns True are neither
+    started nor, if an older version is running, removed.
     """
     to_remove, to_start, to_check = diff(current, desired)
 
@@ -45,46 +80,224 @@ def determine_container_actions(current, desired):
         if new_service['version'] != old_service['Labels']['version']:
             to_remove.add(service_id)
             to_start.add(service_id)
+
+    if skip is not None:
+        for service_id in list(to_start):
+            if skip(service_id, desired[service_id]['version']):
+                to_start.discard(service_id)
+                to_remove.discard(service_id)
     return to_remove, to_start
 
 
-def set_state(desired_state, container_client):
-    """Remove, start or ignore containers based on current and desired state."""
+def hold_back_cycles(graph, desired, to_remove, to_start, failures):
+    """Put services to_start whose dependencies form a cycle in backoff.
+
+    Returns graph without the services that cannot be ordered.
+    """
+    try:
+        start_levels(graph)
+        return graph
+    except DependencyCycle as ex:
+        for service_id in ex.services & to_start:
+            failures.failed(service_id, desired[service_id]['version'], str(ex))
+            to_start.discard(service_id)
+            to_remove.discard(service_id)
+        return {service_id: dependencies for service_id, dependencies in graph.items()
+                if service_id not in ex.services}
+
+
+def set_state(desired_state, container_client, reconciler=None):
+    """Remove, start or ignore containers based on current and desired state.
+
+    Returns a list of reconciler.ActionTimings for the performed actions.
+    """
     logger.debug('Setting state.')
+    reconciler = reconciler or Reconciler()
 
     containers = container_client.list_containers()
-    current, desired = current_and_desired(containers, desired_state['services'])
-    to_remove, to_start = determine_container_actions(current, desired)
+    services, held = plannable_services(desired_state['services'])
+    current, desired = current_and_desired(containers, services)
+    to_remove, to_start = determine_container_actions(current, desired,
+                                                      skip=reconciler.failures.in_backoff)
+    to_remove -= held
+    # services no longer desired are not retried, nor reported in heartbeats
+    reconciler.failures.prune(set(desired) | held)
+    graph = hold_back_cycles(dependency_graph(desired), desired, to_remove, to_start,
+                             reconciler.failures)
+
+    track_images = getattr(container_client, 'track_images', None)
+    if track_images is not None:
+        track_images(services)
 
-    # stop and remove
-    for name in to_remove:
-        logger.info('removing {}'.format(name))
-        container_id = current[name]['Id']
-        # Notify master
-        comms.notify_master(comms.Events.STOP_CONTAINER, name)
+    plan = plan_actions(current, desired, to_remove, to_start)
+    started = time.monotonic()
+    with metrics.span('reconcile') as trace:
+        try:
+            timings = reconciler.run(plan, container_client, dependencies=graph,
+                                     running=set(current) - to_remove)
+        finally:
+            metrics.observe('reconcile_seconds', time.monotonic() - started)
+        for timing in timings:
+            trace.add('{} {}'.format(timing.action, timing.service_id), timing.seconds)
+    if timings:
+        slowest = max(timings, key=lambda timing: timing.seconds)
+        seconds = {}
+        for timing in timings:
+            seconds[timing.service_id] = seconds.get(timing.service_id, 0) + timing.seconds
+        path_seconds = critical_path({service_id: graph.get(service_id, set())
+                                      for service_id in plan}, seconds)
+        metrics.observe('reconcile_critical_path_seconds', path_seconds)
+        logger.info('Reconciled %s services (%s actions) in %.2fs, critical path %.2fs, '
+                    'slowest: %s %s %.2fs', len(plan), len(timings),
+                    time.monotonic() - started, path_seconds,
+                    slowest.action, slowest.service_id, slowest.seconds)
+    return timings
 
-        container_client.stop_and_remove(container_id)
 
-    # start
-    for service_id in to_start:
-        logger.info('starting {}'.format(service_id))
-        container_client.start_container(spec=desired.get(service_id))
+def desired_state_fingerprint(desired_state):
+    """Return a fingerprint of the parts of desired state that set_state uses."""
+    return fingerprint(desired_state['services'])
+
+
+def services_fingerprint(services):
+    """Return a fingerprint of the service versions a node should run."""
+    return fingerprint(sorted([service['service_id'], service['version']]
+                              for service in services))
+
+
+def containers_fingerprint(containers):
+    """Return a fingerprint of the service versions a node runs, see services_fingerprint."""
+    return fingerprint(sorted([container['Names'][0][1:], container['Labels'].get('version')]
+                              for container in containers))
 
 
 class StatekeeperWorker(Thread):
     """Operate Docker on desired state updates."""
 
-    def __init__(self, queue, container_client):
-        """Init thread and give access to desired state queue."""
+    def __init__(self, queue, container_client, reconciler=None, journal=None):
+        """Init thread and give access to desired state queue.
+
+        Applied desired states are recorded to journal (see journal.StateJournal),
+        and the last one recorded is resumed from by warm_start if the node runs it.
+        """
         logger.info('Starting statekeeper...')
         Thread.__init__(self)
         self.queue = queue
         self.container_client = container_client
+        self.reconciler = reconciler or Reconciler()
+        self.journal = journal
+        self.last_applied = None
+        self.last_applied_at = None
+        self.skipped = 0
+        self.reconciling = Event()
+        # set once the node runs the desired state, see warm_start
+        self.ready = Event()
+        # desired state to verify before anything else, set by warm_start
+        self.verify_state = None
+        # monotonic time the desired state being applied was received
+        self.received_at = None
+
+    def warm_start(self, containers):
+        """Become ready at once if containers match the journal's last applied state.
+
+        Nothing is reconciled until the node has been verified with a full
+        set_state, which is the first thing run() does.
+        Returns True if the node matched.
+        """
+        record = self.journal.last_applied() if self.journal is not None else None
+        if record is None:
+            return False
+        # journals of older agents may hold invalid services
+        services = [service for service in record['services'] or () if is_plannable(service)]
+        if containers_fingerprint(containers) != services_fingerprint(services):
+            logger.info('Running containers differ from the last applied state.')
+            # the journaled state must be applied again
+            self.last_applied = None
+            return False
+
+        age = max(0, time.time() - record['applied_at'])
+        logger.info('Running containers match the desired state applied %.0fs ago, ready.',
+                    age)
+        self.last_applied = record['fingerprint']
+        self.last_applied_at = time.monotonic()
+        self.verify_state = {'services': services}
+        self.set_ready('warm start')
+        return True
+
+    def set_ready(self, reason):
+        """Mark the node ready and tell master about it once."""
+        if not self.ready.is_set():
+            self.ready.set()
+            comms.notify_master(comms.Events.AGENT_READY, reason)
+
+    def verify(self):
+        """Run the full set_state deferred by warm_start."""
+        logger.info('Verifying the warm started state.')
+        self.reconciling.set()
+        try:
+            with logpipeline.correlation():
+                set_state(self.verify_state, self.container_client, self.reconciler)
+        except Exception as ex:
+            logger.error('Verifying the warm started state failed: %s', ex, exc_info=True)
+            # apply the next desired state even if unchanged
+            self.last_applied = None
+        finally:
+            self.reconciling.clear()
+            self.verify_state = None
+
+    def record_applied(self, agent_state, timings):
+        """Record an applied desired state, a failing journal does not stop the statekeeper.
+
+        Only the services set_state planned with are recorded (see plannable_services).
+        """
+        if self.journal is None:
+            return
+        services = [service for service in agent_state['services'] if is_plannable(service)]
+        try:
+            self.journal.record(self.last_applied, services, timings)
+        except OSError as ex:
+            logger.error('Recording applied state failed: %s', ex)
+
+    def is_applied(self, agent_state):
+        """Return True if agent_state was applied recently enough to skip it.
+
+        An unchanged desired state is still applied every
+        settings.RECONCILE_RESYNC_INTERVAL seconds to repair drift.
+        """
+        if self.last_applied is None:
+            return False
+        age = time.monotonic() - self.last_applied_at
+        return (desired_state_fingerprint(agent_state) == self.last_applied and
+                age < settings.RECONCILE_RESYNC_INTERVAL)
+
+    def lag_seconds(self):
+        """Return how long the desired state being applied has waited to be applied."""
+        if not self.reconciling.is_set():
+            return 0
+        return time.monotonic() - self.received_at
 
     def run(self):
         """Start statekeeper in a forever loop."""
         logger.info('Statekeeper started.')
+        if self.verify_state is not None:
+            self.verify()
         while True:
             agent_state = self.queue.get()  # blocks until something to return
-            set_state(agent_state, self.container_client)
+            self.received_at = getattr(self.queue, 'last_put_at', None) or time.monotonic()
+            if self.is_applied(agent_state):
+                self.skipped += 1
+                logger.debug('Desired state unchanged, skipping set_state.')
+            else:
+                self.reconciling.set()
+                try:
+                    with logpipeline.correlation():
+                        timings = set_state(agent_state, self.container_client,
+                                            self.reconciler)
+                finally:
+                    self.reconciling.clear()
+                metrics.observe('reconcile_lag_seconds', time.monotonic() - self.received_at)
+                self.last_applied = desired_state_fingerprint(agent_state)
+                self.last_applied_at = time.monotonic()
+                self.record_applied(agent_state, timings)
+                self.set_ready('reconciled')
             self.queue.task_done()
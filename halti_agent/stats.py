@@ -0,0 +1,175 @@
+"""
+stats samples resource usage of the containers managed by Halti.
+
+StatsSampler takes a one-shot Docker stats sample (stream=False) of every
+container every settings.STATS_INTERVAL seconds. Samples are taken by a pool of
+at most settings.STATS_WORKERS threads, so a large node is sampled in a bounded
+number of concurrent calls instead of one blocking call after another.
+
+Every metric of a container keeps the last settings.STATS_WINDOW values in a
+fixed-size array, and heartbeats carry percentiles of these windows only:
+
+    {'<container name>': {'cpu_percent': {'p50': ..., 'p95': ..., 'max': ...}, ...}}
+
+StatsSampler receives the functions that talk to Docker as params for
+testability (see: StatsSampler.__init__).
+"""
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import time
+from threading import Lock, Thread
+
+from halti_agent import settings
+
+logger = logging.getLogger('halti-agent-stats')
+
+# rates are per second, memory is in bytes
+METRICS = ('cpu_percent', 'memory_bytes', 'net_rx_bytes', 'net_tx_bytes',
+           'blkio_read_bytes', 'blkio_write_bytes')
+# cumulative counters that are turned into rates
+COUNTERS = ('net_rx_bytes', 'net_tx_bytes', 'blkio_read_bytes', 'blkio_write_bytes')
+
+
+class RingBuffer(object):
+    """Fixed-size window of the latest float values."""
+
+    def __init__(self, size):
+        self._values = array('d', bytes(8 * size))
+        self._next = 0
+        self.count = 0
+
+    def append(self, value):
+        """Add value, overwriting the oldest value when full."""
+        self._values[self._next] = value
+        self._next = (self._next + 1) % len(self._values)
+        self.count = min(self.count + 1, len(self._values))
+
+    def values(self):
+        """Return the values in the window (in no particular order)."""
+        return self._values[:self.count]
+
+    def summary(self):
+        """Return p50, p95 and max of the window."""
+        values = sorted(self.values())
+        if not values:
+            return None
+
+        def percentile(p):
+            return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+        return {'p50': round(percentile(50), 2), 'p95': round(percentile(95), 2),
+                'max': round(values[-1], 2)}
+
+
+def cpu_percent(sample):
+    """Return CPU usage of a Docker stats sample in percent of one CPU."""
+    cpu, precpu = sample.get('cpu_stats') or {}, sample.get('precpu_stats') or {}
+    usage = cpu.get('cpu_usage') or {}
+    previous_usage = (precpu.get('cpu_usage') or {}).get('total_usage', 0)
+    cpu_delta = usage.get('total_usage', 0) - previous_usage
+    system_delta = cpu.get('system_cpu_usage', 0) - precpu.get('system_cpu_usage', 0)
+    if cpu_delta <= 0 or system_delta <= 0:
+        return 0.0
+    cpus = cpu.get('online_cpus') or len(usage.get('percpu_usage') or []) or 1
+    return cpu_delta / float(system_delta) * cpus * 100
+
+
+def parse_sample(sample):
+    """Return {metric: value} of a Docker stats sample, COUNTERS are cumulative."""
+    memory = sample.get('memory_stats') or {}
+    networks = (sample.get('networks') or {}).values()
+    blkio = (sample.get('blkio_stats') or {}).get('io_service_bytes_recursive') or []
+    return {
+        'cpu_percent': cpu_percent(sample),
+        'memory_bytes': memory.get('usage', 0) - (memory.get('stats') or {}).get('cache', 0),
+        'net_rx_bytes': sum(network.get('rx_bytes', 0) for network in networks),
+        'net_tx_bytes': sum(network.get('tx_bytes', 0) for network in networks),
+        'blkio_read_bytes': sum(entry['value'] for entry in blkio if entry.get('op') == 'Read'),
+        'blkio_write_bytes': sum(entry['value'] for entry in blkio if entry.get('op') == 'Write'),
+    }
+
+
+class ContainerWindow(object):
+    """Rolling windows of one container's metrics."""
+
+    def __init__(self, size):
+        self.buffers = {metric: RingBuffer(size) for metric in METRICS}
+        self._previous = None  # (monotonic time, parsed sample)
+
+    def add(self, parsed, now):
+        """Add a parsed sample taken at monotonic time now."""
+        previous, self._previous = self._previous, (now, parsed)
+        for metric in METRICS:
+            if metric not in COUNTERS:
+                self.buffers[metric].append(parsed[metric])
+            elif previous is not None and now > previous[0]:
+                # a restarted container resets its counters
+                delta = max(0, parsed[metric] - previous[1][metric])
+                self.buffers[metric].append(delta / (now - previous[0]))
+
+    def summary(self):
+        return {metric: buffer.summary() for metric, buffer in self.buffers.items()
+                if buffer.count}
+
+
+class StatsSampler(Thread):
+    """Samples stats of all Halti containers with bounded concurrency."""
+
+    def __init__(self, list_containers, stats, interval=None, workers=None, window=None):
+        """Init sampler.
+
+        - list_containers() returns Halti containers (see containers.list_containers)
+        - stats(container_id) returns a single Docker stats sample
+        """
+        Thread.__init__(self)
+        self.daemon = True
+        self._list_containers = list_containers
+        self._stats = stats
+        self.interval = interval or settings.STATS_INTERVAL
+        self.workers = workers or settings.STATS_WORKERS
+        self.window = window or settings.STATS_WINDOW
+
+        self._lock = Lock()
+        self._windows = {}  # container name -> ContainerWindow
+        self.failures = 0
+        self.sample_seconds = 0.0
+
+    def _sample_one(self, name, container_id):
+        try:
+            parsed = parse_sample(self._stats(container_id))
+        except Exception as ex:
+            logger.debug('sampling %s failed: %s', name, ex)
+            with self._lock:
+                self.failures += 1
+            return
+        with self._lock:
+            window = self._windows.setdefault(name, ContainerWindow(self.window))
+            window.add(parsed, time.monotonic())
+
+    def sample(self, pool):
+        """Sample every container once."""
+        started = time.monotonic()
+        containers = {container['Names'][0][1:]: container['Id']
+                      for container in self._list_containers()}
+        with self._lock:
+            for name in set(self._windows) - set(containers):
+                del self._windows[name]
+        list(pool.map(lambda item: self._sample_one(*item), containers.items()))
+        self.sample_seconds = time.monotonic() - started
+
+    def summary(self):
+        """Return percentiles of every container's windows for the heartbeat."""
+        with self._lock:
+            return {name: window.summary() for name, window in self._windows.items()}
+
+    def run(self):
+        """Sample forever, a round starts every interval or when the previous one ends."""
+        logger.info('Stats sampler started.')
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while True:
+                started = time.monotonic()
+                try:
+                    self.sample(pool)
+                except Exception as ex:
+                    logger.error('sampling stats failed: %s', ex, exc_info=True)
+                time.sleep(max(0, self.interval - (time.monotonic() - started)))
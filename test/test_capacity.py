@@ -0,0 +1,56 @@
+from halti_agent.capacity import CapacityReporter, changed, measure, read_meminfo
+
+from test_statekeeper import mock_service, UUID1, UUID2
+
+
+def test_read_meminfo(tmpdir):
+    meminfo = tmpdir.join('meminfo')
+    meminfo.write('MemTotal:        2048 kB\nMemAvailable:    1024 kB\nHugePages_Total:       0\n')
+    assert read_meminfo(str(meminfo)) == {'MemTotal': 2048 * 1024, 'MemAvailable': 1024 * 1024,
+                                          'HugePages_Total': 0}
+
+
+def test_measure_reserved_and_used():
+    services = [mock_service(UUID1, 'hello1', 'v1'), mock_service(UUID2, 'hello2', 'v1')]
+    stats = {'hello1': {'memory_bytes': {'p50': 1000}, 'cpu_percent': {'p50': 50}},
+             'hello2': {}}
+    capacity = measure('.', services, stats)
+    assert capacity['reserved_memory_bytes'] == 200 * 1024 ** 2
+    assert capacity['reserved_cpus'] == 0.2
+    assert capacity['used_memory_bytes'] == 1000
+    assert capacity['used_cpus'] == 0.5
+    assert capacity['disk_free_bytes'] <= capacity['disk_total_bytes']
+
+
+def test_measure_skips_invalid_services():
+    services = [mock_service(UUID1, 'hello1', 'v1'), 'garbage', None, {'memory': 'lots'}]
+    capacity = measure('.', services)
+    assert capacity['reserved_memory_bytes'] == 100 * 1024 ** 2
+    assert capacity['reserved_cpus'] == 0.1
+
+
+def test_changed():
+    assert not changed({'a': 100}, {'a': 105}, 0.1)
+    assert changed({'a': 100}, {'a': 111}, 0.1)
+    assert not changed({'a': 0}, {'a': 0.05}, 0.1)
+    assert changed({'a': 0}, {'b': 0}, 0.1)
+
+
+def test_reporter_sends_only_changes():
+    """A report is sent first, then only when it changes beyond the threshold."""
+    reports = [{'free': 100}, {'free': 105}, {'free': 150}]
+    reporter = CapacityReporter(lambda: reports.pop(0), threshold=0.1, interval=0)
+
+    capacity = reporter.report()
+    assert capacity == {'free': 100}
+    reporter.sent(capacity)
+    assert reporter.report() is None
+    assert reporter.report() == {'free': 150}
+
+    # measurements are cached for the interval
+    reporter = CapacityReporter(lambda: reports.pop(0), interval=60)
+    reports[:] = [{'free': 1}, {'free': 2}]
+    assert reporter.report() == reporter.report() == {'free': 1}
+    reporter.sent({'free': 1})
+    reporter.invalidate()
+    assert reporter.report() == {'free': 1}
@@ -0,0 +1,105 @@
+import os
+import tempfile
+
+from halti_agent import comms, settings
+from halti_agent.spool import Spool
+
+import requests_mock
+
+
+def bulk_url():
+    return settings.HALTI_SERVER_URL + comms.NOTIFY_BULK_URL.format(comms.INSTANCE_ID)
+
+
+def test_event_buffer_batches_in_order():
+    """Events should be sent in order, in batches of at most batch_size."""
+    comms.INSTANCE_ID = 'foobar-1'
+    buffer = comms.EventBuffer(batch_size=2, window=0.01)
+
+    with requests_mock.mock() as m:
+        m.post(bulk_url(), text='{}')
+        for i in range(3):
+            buffer.put(comms.halti_event('PULL_START', str(i)))
+        assert buffer.flush(timeout=5)
+
+        batches = [[e['event_meta'] for e in r.json()['events']] for r in m.request_history]
+        assert batches == [['0', '1'], ['2']]
+        assert buffer.sent == 3 and buffer.batches == 2
+
+
+def test_event_buffer_spools_while_master_is_down():
+    """Failed events should be spooled to disk and replayed first."""
+    comms.INSTANCE_ID = 'foobar-1'
+    with tempfile.TemporaryDirectory() as tmp:
+        spool = Spool(os.path.join(tmp, 'events.spool'), max_items=100)
+        buffer = comms.EventBuffer(batch_size=10, window=0.01, spool=spool)
+
+        with requests_mock.mock() as m:
+            m.post(bulk_url(), [{'status_code': 503, 'text': '{}'}, {'text': '{}'}])
+            buffer.put(comms.halti_event('PULL_START', 'a'))
+            buffer.put(comms.halti_event('PULL_FAILED', 'b'))
+            assert buffer.flush(timeout=5)
+
+            assert m.call_count == 2
+            assert [e['event_meta'] for e in m.request_history[1].json()['events']] == ['a', 'b']
+            assert buffer.failed_attempts == 1 and len(spool) == 0
+
+
+def test_event_buffer_falls_back_to_single_events():
+    """A master without the bulk endpoint gets events one by one, only unsent ones again."""
+    comms.INSTANCE_ID = 'foobar-1'
+    single_url = settings.HALTI_SERVER_URL + comms.NOTIFY_URL.format(comms.INSTANCE_ID)
+    buffer = comms.EventBuffer(batch_size=10, window=0.01)
+
+    with requests_mock.mock() as m:
+        m.post(bulk_url(), status_code=404, text='{}')
+        m.post(single_url, [{'status_code': 400, 'text': '{}'}, {'text': '{}'},
+                            {'status_code': 503, 'text': '{}'}, {'text': '{}'}])
+        for meta in 'abc':
+            buffer.put(comms.halti_event('PULL_START', meta))
+        assert buffer.flush(timeout=5)
+
+        urls = [request.url for request in m.request_history]
+        assert urls == [bulk_url()] + [single_url] * 4
+        # a is rejected and dropped, b is not sent again when c fails
+        assert [request.json()['event_meta'] for request in m.request_history[1:]] == \
+            ['a', 'b', 'c', 'c']
+        assert buffer.failed_attempts == 1 and not buffer.bulk
+        assert buffer.sent == 2 and buffer.rejected == 1
+
+
+def test_event_buffer_drops_rejected_events():
+    """An event master rejects does not hold back the events after it."""
+    comms.INSTANCE_ID = 'foobar-1'
+    single_url = settings.HALTI_SERVER_URL + comms.NOTIFY_URL.format(comms.INSTANCE_ID)
+    buffer = comms.EventBuffer(batch_size=10, window=0.01)
+
+    with requests_mock.mock() as m:
+        m.post(bulk_url(), [{'status_code': 400, 'text': '{}'}, {'text': '{}'}])
+        m.post(single_url, [{'status_code': 422, 'text': '{}'}, {'text': '{}'}])
+        buffer.put(comms.halti_event('PULL_START', 'bad'))
+        buffer.put(comms.halti_event('PULL_START', 'good'))
+        assert buffer.flush(timeout=5)
+        buffer.put(comms.halti_event('PULL_START', 'next'))
+        assert buffer.flush(timeout=5)
+
+        urls = [request.url for request in m.request_history]
+        assert urls == [bulk_url(), single_url, single_url, bulk_url()]
+        assert buffer.failed_attempts == 0 and buffer.bulk
+        assert buffer.sent == 2 and buffer.rejected == 1
+
+
+def test_spool_survives_restart_and_drops_oldest():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'events.spool')
+        Spool(path, max_items=2).extend([1, 2, 3])
+
+        spool = Spool(path, max_items=2)
+        assert len(spool) == 2 and spool.peek(5) == [2, 3]
+        spool.pop(1)
+        assert spool.peek(5) == [3]
+
+
+def test_backoff_delay_is_capped():
+    assert 0.25 <= comms.backoff_delay(0, base=0.5, cap=30) <= 0.5
+    assert 15 <= comms.backoff_delay(20, base=0.5, cap=30) <= 30
@@ -1,36 +1,202 @@
 from halti_agent import containers, comms, settings
-from docker.errors import DockerException
+from halti_agent.cpusets import CpusetAllocator
+from halti_agent.specs import compile_spec
+from docker.errors import APIError, DockerException
 
+import requests
 import requests_mock
 
+from test_statekeeper import mock_container, mock_service, UUID1
+
 
 def failing_pull_container(*args, **kwargs):
     """pull container that raises DockerException."""
     raise DockerException('pull failed')
 
 
-def test_start_container_notifies_master_on_failure():
+def test_start_container_notifies_master_on_failure(monkeypatch):
     """start_container should notify master if pull fails."""
 
     # monkeypatches
     comms.INSTANCE_ID = 'foobar-1'
+    # events of other tests are not sent in the same batch
+    monkeypatch.setattr(comms, 'event_buffer', comms.EventBuffer())
     containers.pull_container = failing_pull_container
 
-    mock_url = settings.HALTI_SERVER_URL + comms.NOTIFY_URL.format(comms.INSTANCE_ID)
+    mock_url = settings.HALTI_SERVER_URL + comms.NOTIFY_BULK_URL.format(comms.INSTANCE_ID)
 
     with requests_mock.mock() as m:
 
         m.post(mock_url, text='{}')
         containers.start_container({'image': 'tutum/hello-world'})
+        assert comms.flush(timeout=5)
 
-        assert m.called and m.call_count == 2
-
+        # both events are sent in one batch
+        assert m.called and m.call_count == 1
         assert m.request_history[0].method == 'POST'
-        assert m.request_history[0].json() == {'event': 'PULL_START',
-                                               'event_type': 'INFO',
-                                               'event_meta': 'tutum/hello-world'}
-
-        assert m.request_history[1].method == 'POST'
-        assert m.request_history[1].json() == {'event': 'PULL_FAILED',
-                                               'event_type': 'ERROR',
-                                               'event_meta': str(DockerException('pull failed'))}
+        assert m.request_history[0].json() == {'events': [
+            {'event': 'PULL_START',
+             'event_type': 'INFO',
+             'event_meta': 'tutum/hello-world'},
+            {'event': 'PULL_FAILED',
+             'event_type': 'ERROR',
+             'event_meta': str(DockerException('pull failed'))},
+        ]}
+
+
+def test_published_ports():
+    """Only published TCP ports should be checked for readiness."""
+    info = {'NetworkSettings': {'Ports': {
+        '80/tcp': [{'HostIp': '0.0.0.0', 'HostPort': '32768'}],
+        '53/udp': [{'HostIp': '0.0.0.0', 'HostPort': '5353'}],
+        '443/tcp': None,
+    }}}
+    assert containers.published_ports(info) == [('127.0.0.1', 32768)]
+
+
+def test_published_ports_probe_address(monkeypatch):
+    """Ports bound to all addresses are probed at PORT_BIND_IP, or at the container."""
+    info = {'NetworkSettings': {'IPAddress': '', 'Networks': {'bridge': {
+        'IPAddress': '172.17.0.2'}}, 'Ports': {
+        '80/tcp': [{'HostIp': '0.0.0.0', 'HostPort': '32768'}],
+        '81/tcp': [{'HostIp': '10.0.0.2', 'HostPort': '32769'}],
+    }}}
+    monkeypatch.setattr(settings, 'PORT_BIND_IP', '10.0.0.1')
+    assert sorted(containers.published_ports(info)) == [('10.0.0.1', 32768), ('10.0.0.2', 32769)]
+    monkeypatch.setattr(settings, 'PORT_BIND_IP', '0.0.0.0')
+    assert sorted(containers.published_ports(info)) == [('10.0.0.2', 32769), ('172.17.0.2', 80)]
+
+
+def api_error(status_code=500):
+    response = requests.Response()
+    response.status_code, response.reason = status_code, 'Server Error'
+    return APIError('docker failed', response)
+
+
+def test_rolling_update_survives_docker_errors(monkeypatch):
+    """Docker errors while waiting or swapping keep the old container and drop the new one."""
+    class FakeClient(object):
+        def __init__(self, failing):
+            self.failing = failing
+            self.removed = []
+
+        def create_host_config(self, **kwargs):
+            return kwargs
+
+        def create_container(self, **kwargs):
+            return {'Id': 'new'}
+
+        def start(self, container):
+            pass
+
+        def inspect_container(self, container_id):
+            if self.failing == 'inspect':
+                raise api_error()
+            return {'State': {'Running': True, 'Health': {'Status': 'healthy'}}}
+
+        def stop(self, container_id):
+            pass
+
+        def remove_container(self, container_id, force=False):
+            self.removed.append(container_id)
+
+        def rename(self, container_id, name):
+            raise api_error()
+
+    monkeypatch.setattr(comms, 'notify_master', lambda event, meta: None)
+    monkeypatch.setattr(containers, 'spec_compiler', containers.SpecCompiler(
+        create_host_config=lambda **kwargs: kwargs))
+    spec = dict(mock_service(UUID1, 'hello1', 'v2'),
+                ports=[{'port': 80}], update_strategy={'type': 'rolling'})
+    old = mock_container(UUID1, 'v1', id='old')
+
+    for failing, removed in (('inspect', [UUID1 + '-next', 'new']),
+                             ('rename', [UUID1 + '-next', 'old', 'new'])):
+        client = FakeClient(failing)
+        monkeypatch.setattr(containers, 'docker_client', client)
+        assert containers.rolling_update(old, spec) is False
+        assert client.removed == removed
+
+
+def test_docker_client_is_created_lazily(tmpdir, monkeypatch):
+    """The negotiated API version should be cached for the next start."""
+    created = []
+
+    class FakeClient(object):
+        api_version = '1.24'
+
+        def __init__(self, **kwargs):
+            created.append(kwargs)
+
+    monkeypatch.setattr(settings, 'docker_options', lambda: {'version': 'auto'})
+    monkeypatch.setattr(settings, 'DOCKER_VERSION_CACHE', str(tmpdir.join('version.json')))
+    monkeypatch.setattr(containers, 'Client', FakeClient)
+    monkeypatch.setattr(containers, 'docker_client', None)
+
+    client = containers.get_docker_client()
+    assert containers.get_docker_client() is client
+    assert created[0]['version'] == 'auto'
+
+    monkeypatch.setattr(containers, 'docker_client', None)
+    containers.get_docker_client()
+    assert created[1]['version'] == '1.24'
+
+
+def test_rejected_api_version_is_negotiated_again(tmpdir, monkeypatch):
+    """A cached API version the daemon rejects is dropped with the client."""
+    created = []
+
+    class FakeResponse(object):
+        def __init__(self, status_code, text):
+            self.status_code, self.text = status_code, text
+
+    class FakeClient(object):
+        api_version = '1.23'
+
+        def __init__(self, **kwargs):
+            created.append(kwargs)
+            self.hooks = {'response': []}
+
+        def respond(self, response):
+            for hook in self.hooks['response']:
+                hook(response)
+
+    cache = tmpdir.join('version.json')
+    cache.write('{"default": "1.30", "tcp://other:2376": "1.25"}')
+    monkeypatch.setattr(settings, 'docker_options', lambda: {'version': 'auto'})
+    monkeypatch.setattr(settings, 'DOCKER_VERSION_CACHE', str(cache))
+    monkeypatch.setattr(containers, 'Client', FakeClient)
+    monkeypatch.setattr(containers, 'docker_client', None)
+
+    client = containers.get_docker_client()
+    assert created[0]['version'] == '1.30'
+    client.respond(FakeResponse(404, 'no such container'))
+    client.respond(FakeResponse(400, 'bad parameter'))
+    assert containers.get_docker_client() is client
+
+    client.respond(FakeResponse(
+        400, 'client version 1.30 is too new. Maximum supported API version is 1.23'))
+    assert containers.load_api_versions() == {'tcp://other:2376': '1.25'}
+    assert containers.get_docker_client() is not client
+    assert created[1]['version'] == 'auto'
+    # versions cached for other daemons are kept
+    assert containers.load_api_versions() == {'default': '1.23', 'tcp://other:2376': '1.25'}
+
+
+def test_cpuset_skips_cores_of_stopped_containers(monkeypatch):
+    """Cores of a stopped container are not handed out, it is started again."""
+    stopped = mock_container('stopped', 'v1')
+    stopped['Labels']['cpuset'] = '2,3'
+    listed = []
+
+    class FakeClient(object):
+        def containers(self, all=False, filters=None):
+            listed.append((all, filters))
+            return [stopped] if all else []
+
+    monkeypatch.setattr(containers, 'docker_client', FakeClient())
+    monkeypatch.setattr(containers, 'cpuset_allocator', CpusetAllocator('2-5'))
+    spec = dict(mock_service(UUID1, 'hello1', 'v1'), resources={'exclusive_cpus': 2})
+    params = compile_spec(spec, lambda **kwargs: kwargs)
+    assert containers.assign_cpuset(params, UUID1) == '4,5'
+    assert listed == [(True, {'label': 'halti'})]
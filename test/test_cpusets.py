@@ -0,0 +1,61 @@
+from threading import Thread
+from time import sleep
+
+from halti_agent.cpusets import CpusetAllocator, CpusetError, format_cpuset, parse_cpuset
+
+from test_statekeeper import mock_container
+
+
+def test_parse_cpuset():
+    assert parse_cpuset('0-2,5') == {0, 1, 2, 5}
+    assert parse_cpuset('') == set()
+    assert format_cpuset({5, 0, 1}) == '0,1,5'
+
+
+def test_allocator_assigns_free_cores():
+    """Cores of containers and pending assignments are not handed out twice."""
+    pinned = mock_container('pinned', 'v1')
+    pinned['Labels']['cpuset'] = '2,3'
+    containers = [pinned]
+    allocator = CpusetAllocator('2-7')
+
+    assert allocator.allocate('a', 2, lambda: containers) == '4,5'
+    assert allocator.allocate('b', 1, lambda: containers) == '6'
+    try:
+        allocator.allocate('c', 2, lambda: containers)
+        assert False
+    except CpusetError:
+        pass
+
+    # once created, the container's label tells its cores in the next listing
+    allocator.created('a')
+    allocator.release('b')
+    created = mock_container('a', 'v1')
+    created['Labels']['cpuset'] = '4,5'
+    containers.append(created)
+    assert allocator.allocate('c', 1, lambda: containers) == '6'
+    assert allocator.allocate('d', 1, lambda: containers) == '7'
+
+    # the listing tells from now on: a removed container frees its cores
+    containers.remove(created)
+    allocator.release('c')
+    allocator.release('d')
+    assert allocator.allocate('e', 4, lambda: containers) == '4,5,6,7'
+
+
+def test_concurrent_allocations_do_not_overlap():
+    """Containers are listed under the lock, so concurrent starts get different cores."""
+    allocator = CpusetAllocator('0-3')
+
+    def slow_listing():
+        sleep(0.01)
+        return []
+
+    cpusets = []
+    threads = [Thread(target=lambda owner=owner: cpusets.append(
+        allocator.allocate(owner, 1, slow_listing))) for owner in 'abcd']
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(cpusets) == ['0', '1', '2', '3']
@@ -0,0 +1,106 @@
+import pytest
+
+from halti_agent.dependencies import (critical_path, dependency_graph, DependencyCycle,
+                                      start_levels)
+from halti_agent.failures import FailureTracker
+from halti_agent.reconciler import Reconciler, plan_actions, READY
+from halti_agent.statekeeper import hold_back_cycles
+
+from test_reconciler import RecordingContainerClient
+from test_statekeeper import mock_container, mock_service, UUID1, UUID2, UUID3
+
+
+def with_dependencies(spec, *names):
+    return dict(spec, depends_on=list(names))
+
+
+class GatedContainerClient(RecordingContainerClient):
+    """container_client whose containers become ready unless listed in not_ready."""
+
+    def __init__(self, not_ready=()):
+        RecordingContainerClient.__init__(self)
+        self.not_ready = set(not_ready)
+
+    def wait_ready(self, name, timeout):
+        self._enter(('ready', name))
+        self._exit()
+        return name not in self.not_ready
+
+
+def test_levels_by_name_or_service_id():
+    """Dependencies are resolved by name or service_id, unknown ones are ignored."""
+    desired = {
+        UUID1: mock_service(UUID1, 'db', 'v1'),
+        UUID2: with_dependencies(mock_service(UUID2, 'api', 'v1'), 'db', 'elsewhere'),
+        UUID3: with_dependencies(mock_service(UUID3, 'web', 'v1'), UUID2, 'db'),
+    }
+    graph = dependency_graph(desired)
+    assert graph == {UUID1: set(), UUID2: {UUID1}, UUID3: {UUID1, UUID2}}
+    assert start_levels(graph) == [{UUID1}, {UUID2}, {UUID3}]
+    assert critical_path(graph, {UUID1: 2, UUID2: 1, UUID3: 0.5}) == 3.5
+    assert critical_path({UUID1: set(), UUID2: set()}, {UUID1: 2, UUID2: 1}) == 2
+
+
+def test_cycles_are_detected():
+    """Services in a cycle and their dependents cannot be ordered."""
+    desired = {
+        UUID1: with_dependencies(mock_service(UUID1, 'a', 'v1'), 'b'),
+        UUID2: with_dependencies(mock_service(UUID2, 'b', 'v1'), 'a'),
+        UUID3: with_dependencies(mock_service(UUID3, 'c', 'v1'), 'a'),
+        'solo': with_dependencies(mock_service('solo', 'solo', 'v1'), 'solo'),
+    }
+    graph = dependency_graph(desired)
+    with pytest.raises(DependencyCycle) as cycle:
+        start_levels(graph)
+    assert cycle.value.services == {UUID1, UUID2, UUID3, 'solo'}
+
+    failures = FailureTracker(base=10, cap=10)
+    to_remove, to_start = {UUID1}, {UUID1, UUID2}
+    assert hold_back_cycles(graph, desired, to_remove, to_start, failures) == {}
+    assert to_remove == set() and to_start == set()
+    assert failures.in_backoff(UUID1, 'v1') and failures.in_backoff(UUID2, 'v1')
+    assert not failures.in_backoff(UUID3, 'v1')
+
+
+def test_dependents_start_after_dependencies_are_ready():
+    """A level starts only once the services it depends on are ready."""
+    desired = {
+        UUID1: mock_service(UUID1, 'db', 'v1'),
+        UUID2: mock_service(UUID2, 'cache', 'v1'),
+        UUID3: with_dependencies(mock_service(UUID3, 'api', 'v1'), 'db', 'cache'),
+    }
+    client = GatedContainerClient()
+    plan = plan_actions({}, desired, set(), set(desired))
+    timings = Reconciler(workers=4).run(plan, client, dependencies=dependency_graph(desired))
+
+    api = client.calls.index(('pull', UUID3))
+    assert client.calls.index(('ready', UUID1)) < api
+    assert client.calls.index(('ready', UUID2)) < api
+    # nothing waits for api
+    assert ('ready', UUID3) not in client.calls
+    assert [timing.action for timing in timings if timing.service_id == UUID1][-1] == READY
+
+
+def test_dependents_wait_for_failed_or_missing_dependencies():
+    """Dependents are left alone when a dependency is not ready or not running."""
+    desired = {
+        UUID1: mock_service(UUID1, 'db', 'v1'),
+        UUID2: with_dependencies(mock_service(UUID2, 'api', 'v2'), 'db'),
+    }
+    current = {UUID2: mock_container(UUID2, 'v1', id='old-api')}
+    graph = dependency_graph(desired)
+    reconciler = Reconciler()
+    client = GatedContainerClient(not_ready={UUID1})
+    reconciler.run(plan_actions(current, desired, {UUID2}, set(desired)), client,
+                   dependencies=graph)
+    assert ('stop', 'old-api') not in client.calls and ('pull', UUID2) not in client.calls
+    assert reconciler.failures.in_backoff(UUID1, 'v1')
+
+    # a running dependency outside the plan is ready, a missing one is not
+    plan = plan_actions(current, desired, {UUID2}, {UUID2})
+    client = GatedContainerClient()
+    reconciler.run(plan, client, dependencies=graph, running={UUID1})
+    assert ('start', UUID2) in client.calls
+    client = GatedContainerClient()
+    reconciler.run(plan, client, dependencies=graph, running=set())
+    assert client.calls == []
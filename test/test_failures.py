@@ -0,0 +1,56 @@
+from halti_agent.failures import FailureTracker
+from halti_agent.reconciler import Reconciler, plan_actions
+from halti_agent.statekeeper import current_and_desired, determine_container_actions, set_state
+
+from test_reconciler import RecordingContainerClient
+from test_statekeeper import mock_container, mock_heartbeat, mock_service, UUID1, UUID2, UUID3
+
+
+def test_backoff_grows_and_ends():
+    """Consecutive failures back off longer, a success or new version ends the backoff."""
+    failures = FailureTracker(base=10, cap=25)
+    delays = [failures.failed(UUID1, 'v1', 'pull failed') for _ in range(4)]
+    assert 5 <= delays[0] <= 10 and 12.5 <= delays[3] <= 25
+    assert failures.in_backoff(UUID1, 'v1')
+    assert not failures.in_backoff(UUID1, 'v2')
+    report = failures.report()[UUID1]
+    assert (report['version'], report['failures'], report['reason']) == ('v1', 4, 'pull failed')
+
+    failures.failed(UUID1, 'v2', 'start failed')
+    assert failures.report()[UUID1]['failures'] == 1
+    failures.succeeded(UUID1, 'v2')
+    assert failures.report() == {}
+
+
+def test_services_in_backoff_are_skipped():
+    """A service in backoff is not started and its running version is not removed."""
+    current = [mock_container(UUID1, 'v1')]
+    desired = [mock_service(UUID1, 'hello1', 'v2'), mock_service(UUID2, 'hello2', 'v1')]
+    in_backoff = {(UUID1, 'v2'), (UUID2, 'v1')}
+    to_remove, to_start = determine_container_actions(
+        *current_and_desired(current, desired),
+        skip=lambda service_id, version: (service_id, version) in in_backoff)
+    assert to_remove == set() and to_start == set()
+
+
+def test_reconciler_records_failures():
+    desired = {UUID2: mock_service(UUID2, 'hello2', 'v1'),
+               UUID3: mock_service(UUID3, 'broken', 'v1')}
+    reconciler = Reconciler()
+    reconciler.run(plan_actions({}, desired, set(), set(desired)), RecordingContainerClient())
+    assert reconciler.failures.in_backoff(UUID3, 'v1')
+    assert not reconciler.failures.in_backoff(UUID2, 'v1')
+
+
+def test_failures_of_removed_services_are_forgotten():
+    """set_state prunes the failures of services that are no longer desired."""
+    class IdleContainerClient(object):
+        def list_containers(self):
+            return []
+
+    reconciler = Reconciler()
+    reconciler.failures.failed(UUID1, 'v1', 'start failed')
+    reconciler.failures.failed(UUID2, 'v1', 'start failed')
+    set_state(mock_heartbeat([mock_service(UUID2, 'hello2', 'v1')]), IdleContainerClient(),
+              reconciler)
+    assert set(reconciler.failures.report()) == {UUID2}
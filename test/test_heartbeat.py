@@ -0,0 +1,47 @@
+import gzip
+import json
+
+from halti_agent import comms
+from halti_agent.heartbeat import HeartbeatEncoder, FULL, DELTA
+
+from test_statekeeper import mock_container
+
+
+def test_delta_heartbeats_after_ack():
+    """Only changed fields should be sent once master has acknowledged a heartbeat."""
+    encoder = HeartbeatEncoder(mode=DELTA)
+    c1, c2 = mock_container('hello1', 'v1', id='c1'), mock_container('hello2', 'v1', id='c2')
+
+    first = encoder.encode({'containers': [c1, c2]})
+    assert first['mode'] == FULL and first['seq'] == 1 and first['containers'] == [c1, c2]
+
+    # no acknowledgement (e.g. an old master) => full heartbeats
+    encoder.acknowledge({'services': []})
+    assert encoder.encode({'containers': [c1, c2]})['mode'] == FULL
+
+    encoder.acknowledge({'services': [], 'ack_seq': 2})
+    c1_up = dict(c1, Status='Up 50 minutes')
+    delta = encoder.encode({'containers': [c1_up]})
+    assert delta['mode'] == DELTA and 'containers' not in delta
+    assert delta['delta'] == {'base_seq': 2,
+                              'changed': {'c1': {'Status': 'Up 50 minutes'}},
+                              'removed': ['c2']}
+
+    encoder.acknowledge({'services': [], 'resync': True})
+    assert encoder.encode({'containers': [c1_up]})['mode'] == FULL
+
+
+def test_full_mode_never_sends_deltas():
+    encoder = HeartbeatEncoder(mode=FULL)
+    encoder.encode({'containers': []})
+    encoder.acknowledge({'ack_seq': 1})
+    assert encoder.encode({'containers': []})['mode'] == FULL
+
+
+def test_encode_json_compression():
+    """Compressed bodies should decode to the original payload."""
+    payload = {'containers': [mock_container('hello1', 'v1')]}
+    body, headers = comms.encode_json(payload, 'gzip')
+    assert headers == {'Content-Encoding': 'gzip'}
+    assert json.loads(gzip.decompress(body).decode('utf-8')) == payload
+    assert comms.encode_json(payload) == (json.dumps(payload).encode('utf-8'), {})
@@ -0,0 +1,63 @@
+from halti_agent.imagegc import ImageCollector, disk_usage
+from halti_agent.pulls import PullManager
+
+from test_pulls import FakeDocker
+
+
+class FakeDisk(object):
+    """Disk whose usage drops by 0.1 for every removed image."""
+
+    def __init__(self, usage):
+        self.usage = usage
+        self.removed = []
+
+    def remove_image(self, image):
+        if image == 'in-use:v1':
+            raise Exception('conflict: image is being used by a running container')
+        self.removed.append(image)
+        self.usage -= 0.1
+
+
+def make_collector(disk, **kwargs):
+    docker = FakeDocker()
+    manager = PullManager(docker.pull, docker.inspect)
+    return ImageCollector(disk.remove_image, lambda: disk.usage, manager, **kwargs)
+
+
+def service(service_id, image):
+    return {'service_id': service_id, 'image': image}
+
+
+def test_keeps_desired_and_recent_versions():
+    """Desired images and keep_versions previous images of each service are kept."""
+    collector = make_collector(FakeDisk(0.5), keep_versions=1)
+    for version in range(1, 5):
+        collector.track([service('a', 'a:v{}'.format(version)), service('b', 'b:v1')])
+    assert collector.protected() == {'a:v4', 'a:v3', 'b:v1'}
+    assert collector.candidates() == ['a:v1', 'a:v2']
+
+    # images of removed services are no longer protected
+    collector.track([service('a', 'a:v4')])
+    assert collector.candidates() == ['a:v1', 'a:v2', 'b:v1']
+
+
+def test_collect_only_under_disk_pressure():
+    """Images are removed LRU-first only until usage drops to the low watermark."""
+    disk = FakeDisk(0.8)
+    collector = make_collector(disk, keep_versions=0, high_watermark=0.85, low_watermark=0.6)
+    collector.track([service('a', 'in-use:v1')])
+    for version in range(1, 5):
+        collector.track([service('a', 'a:v{}'.format(version))])
+    assert collector.collect() == []
+
+    disk.usage = 0.9
+    collector.pull_manager.ensure('a:v1')
+    assert collector.collect() == ['a:v1', 'a:v2', 'a:v3']
+    assert disk.removed == ['a:v1', 'a:v2', 'a:v3']
+    assert collector.candidates() == ['in-use:v1']
+    # removed images are pulled again when needed
+    assert collector.pull_manager._cached('a:v1') is None
+
+
+def test_disk_usage():
+    assert 0 <= disk_usage('.') <= 1
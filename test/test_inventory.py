@@ -0,0 +1,47 @@
+from halti_agent.inventory import ContainerInventory
+
+from test_statekeeper import mock_container
+
+
+class FakeDocker(object):
+    """Fake poll/events functions for ContainerInventory."""
+
+    def __init__(self, containers):
+        self.running = {container['Id']: container for container in containers}
+        self.polls = []
+
+    def poll(self, filters=None):
+        self.polls.append(filters)
+        if filters and 'id' in filters:
+            container = self.running.get(filters['id'])
+            return [container] if container else []
+        return list(self.running.values())
+
+    def events(self, since, until):
+        return iter([])
+
+
+def test_inventory_follows_events():
+    """Events should update only the affected containers."""
+    docker = FakeDocker([mock_container('hello1', 'v1', id='c1')])
+    inventory = ContainerInventory(docker.poll, docker.events, resync_interval=60)
+    assert not inventory.is_synced()
+
+    inventory.resync()
+    assert inventory.is_synced()
+    assert [c['Id'] for c in inventory.containers()] == ['c1']
+
+    docker.running['c2'] = mock_container('hello2', 'v1', id='c2')
+    inventory.handle_event({'Type': 'container', 'Action': 'start', 'Actor': {'ID': 'c2'}})
+    assert {c['Id'] for c in inventory.containers()} == {'c1', 'c2'}
+
+    del docker.running['c1']
+    inventory.handle_event({'status': 'die', 'id': 'c1'})
+    inventory.handle_event({'status': 'exec_start: ls', 'id': 'c2'})
+    assert [c['Id'] for c in inventory.containers()] == ['c2']
+
+    inventory.handle_event({'status': 'destroy', 'id': 'c2'})
+    assert inventory.containers() == []
+
+    # one full listing and two single container refreshes
+    assert docker.polls == [None, {'id': 'c2'}, {'id': 'c1'}]
@@ -0,0 +1,48 @@
+import json
+
+from halti_agent.journal import StateJournal, write_atomic
+from halti_agent.reconciler import ActionTiming, START
+
+from test_statekeeper import mock_service, UUID1
+
+
+def test_journal_resumes_last_applied(tmpdir):
+    """A new journal should return the latest record with its services."""
+    path = str(tmpdir.join('journal.jsonl'))
+    services = [mock_service(UUID1, 'hello1', 'v1')]
+    assert StateJournal(path, 10).last_applied() is None
+
+    journal = StateJournal(path, 10)
+    journal.record('a', services, [ActionTiming(UUID1, START, 0.5, None)])
+    journal.record('a', services)
+    # unchanged services are not written again
+    assert json.loads(tmpdir.join('journal.jsonl').readlines()[1])['services'] is None
+
+    # a torn line left by a crash is skipped
+    with open(path, 'a') as journal_file:
+        journal_file.write('{"fingerprint": "b", "servi')
+
+    last = StateJournal(path, 10).last_applied()
+    assert last['fingerprint'] == 'a'
+    assert last['services'] == services
+    assert last['actions'] == []
+
+
+def test_journal_compaction(tmpdir):
+    """Journal should be compacted into its latest record."""
+    path = str(tmpdir.join('journal.jsonl'))
+    journal = StateJournal(path, 3)
+    for fingerprint in 'abcdef':
+        journal.record(fingerprint, [])
+    journal.record('f', [])
+    assert len(tmpdir.join('journal.jsonl').readlines()) <= 3
+    last = StateJournal(path, 3).last_applied()
+    assert last['fingerprint'] == 'f' and last['services'] == []
+
+
+def test_write_atomic(tmpdir):
+    path = str(tmpdir.join('state.json'))
+    write_atomic(path, 'one')
+    write_atomic(path, 'two')
+    assert tmpdir.join('state.json').read() == 'two'
+    assert tmpdir.listdir() == [tmpdir.join('state.json')]
@@ -0,0 +1,113 @@
+import io
+import json
+import logging
+
+import pytest
+
+from halti_agent import logpipeline
+from halti_agent.reconciler import Reconciler, plan_actions
+
+from test_reconciler import RecordingContainerClient
+from test_statekeeper import mock_container, UUID1, UUID2
+
+
+@pytest.fixture
+def pipeline():
+    """Route the root logger through the pipeline into a buffer, restore it afterwards."""
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    output = io.StringIO()
+    listener = logpipeline.configure(logging.INFO, json_format=True, rate_burst=0,
+                                     stream=output)
+
+    def records():
+        listener.stop()
+        return [json.loads(line) for line in output.getvalue().splitlines()]
+    yield records
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+
+
+class CountingArg(object):
+    """Log argument that counts how often it is formatted."""
+
+    def __init__(self):
+        self.formatted = 0
+
+    def __str__(self):
+        self.formatted += 1
+        return 'arg'
+
+
+def test_json_records_with_correlation(pipeline):
+    """Records are written as JSON by the listener and carry the correlation ID."""
+    logger = logging.getLogger('test-logpipeline')
+    skipped = CountingArg()
+    logger.debug('not formatted %s', skipped)
+    logger.info('outside %s', 1)
+    with logpipeline.correlation('abc') as correlation_id:
+        assert correlation_id == logpipeline.correlation_id() == 'abc'
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            logger.error('inside %s', 2, exc_info=True)
+    assert logpipeline.correlation_id() is None
+
+    outside, inside = pipeline()
+    assert skipped.formatted == 0
+    assert outside['message'] == 'outside 1' and 'correlation_id' not in outside
+    assert (inside['message'], inside['level'], inside['correlation_id']) == \
+        ('inside 2', 'ERROR', 'abc')
+    assert 'ValueError: boom' in inside['exception']
+    # 2024-05-01T10:00:00.123+00:00
+    assert len(inside['time']) == 29 and inside['time'].endswith('+00:00')
+
+
+def test_reconciler_workers_inherit_correlation(pipeline):
+    """Records of reconciler worker threads carry the correlation ID of the pass."""
+    current = {UUID1: mock_container(UUID1, 'v1'), UUID2: mock_container(UUID2, 'v1')}
+    plan = plan_actions(current, {}, {UUID1, UUID2}, set())
+    with logpipeline.correlation('pass-1'):
+        Reconciler(workers=2).run(plan, RecordingContainerClient())
+
+    removals = [record for record in pipeline() if record['message'].startswith('removing')]
+    assert len(removals) == 2
+    assert {record['correlation_id'] for record in removals} == {'pass-1'}
+
+
+def make_record(lineno=10, level=logging.ERROR, args=('x',)):
+    return logging.LogRecord('test', level, 'agent.py', lineno, 'failed %s', args, None)
+
+
+def test_rate_limit_repeated_records():
+    """Only burst repeated records pass per interval, the next one tells how many did not."""
+    now = [0]
+    rate_limit = logpipeline.RateLimitFilter(burst=2, interval=60, clock=lambda: now[0])
+    suppressed_before = logpipeline.stats['suppressed']
+
+    passed = [rate_limit.filter(make_record()) for _ in range(5)]
+    assert passed == [True, True, False, False, False]
+    # other call sites, other arguments and levels below warning are not limited
+    assert rate_limit.filter(make_record(lineno=11))
+    assert rate_limit.filter(make_record(args=('y',)))
+    assert all(rate_limit.filter(make_record(level=logging.INFO)) for _ in range(5))
+    assert logpipeline.stats['suppressed'] - suppressed_before == 3
+
+    now[0] = 60
+    record = make_record()
+    assert rate_limit.filter(record)
+    assert record.suppressed == 3
+    prepared = logpipeline.AsyncHandler(None).prepare(record)
+    assert prepared.getMessage() == 'failed x (3 similar records suppressed)'
+    assert rate_limit.filter(make_record()) and not rate_limit.filter(make_record())
+
+    # only the latest max_keys windows are kept
+    rate_limit = logpipeline.RateLimitFilter(burst=1, interval=60, clock=lambda: now[0],
+                                             max_keys=2)
+    for args in [('a',), ('b',), ('c',)]:
+        assert rate_limit.filter(make_record(args=args))
+    assert not rate_limit.filter(make_record(args=('c',)))
+    assert rate_limit.filter(make_record(args=('a',)))
@@ -0,0 +1,98 @@
+import gzip
+import json
+
+from halti_agent.logship import FileSink, LogBuffer, LogFollower, LogShipper, stamp_key
+
+from test_statekeeper import mock_container, UUID1, UUID2
+
+
+def stream(*lines):
+    """Docker log stream of lines split into chunks that do not end at newlines."""
+    data = b''.join(b'2024-05-01T10:00:00.%dZ %s\n' % (i + 1, line)
+                    for i, line in enumerate(lines))
+    return [data[i:i + 7] for i in range(0, len(data), 7)]
+
+
+def drain(buffer):
+    lines = []
+    while len(buffer):
+        lines.append(buffer.pop())
+    return lines
+
+
+def test_ring_buffer_drops_oldest():
+    """A full buffer keeps the latest lines and counts the dropped ones."""
+    buffer = LogBuffer(3)
+    for i in range(5):
+        buffer.append(i)
+    assert buffer.dropped == 2
+    assert drain(buffer) == [2, 3, 4]
+    assert buffer.pop() is None
+
+
+def test_follower_splits_lines_and_resumes():
+    """Chunks are split into lines, a restarted follower skips lines it has read."""
+    calls = []
+
+    def logs(container_id, since):
+        calls.append((container_id, since))
+        return iter(stream(b'hello', b'x' * 30, b'world'))
+
+    follower = LogFollower('web', 'abc', logs, buffer_lines=10, max_line=20)
+    follower.follow()
+    lines = drain(follower.buffer)
+    assert [line['line'] for line in lines] == ['hello', 'x' * 20, 'world']
+    assert lines[0] == {'container': 'web', 'time': '2024-05-01T10:00:00.1Z', 'line': 'hello'}
+
+    resumed = LogFollower('web', 'abc', logs, since='2024-05-01T10:00:00.2Z')
+    resumed.follow()
+    assert [line['line'] for line in drain(resumed.buffer)] == ['world']
+    assert calls == [('abc', None), ('abc', 1714557600)]
+    assert stamp_key('2024-05-01T10:00:00.1234Z') < stamp_key('2024-05-01T10:00:00.12345Z')
+
+
+def test_shipper_batches_round_robin():
+    """Containers are followed once and their lines are shipped in fair batches."""
+    containers = [mock_container(UUID1, 'v1', id='one'), mock_container(UUID2, 'v1', id='two')]
+    chunks = {'one': stream(*[b'one'] * 4), 'two': stream(b'two')}
+    batches = []
+    shipper = LogShipper(list_containers=lambda: containers,
+                         logs=lambda container_id, since: iter(chunks[container_id]),
+                         sink=batches.append, batch_lines=2)
+    shipper.update_followers()
+    for follower in shipper.followers.values():
+        follower.join(1)
+    shipper.flush()
+
+    assert [[line['line'] for line in batch] for batch in batches] == \
+        [['one', 'two'], ['one', 'one'], ['one']]
+    assert shipper.stats['lines_shipped'] == 5 and shipper.stats['batches_shipped'] == 3
+
+    # finished followers are forgotten and resumed while their container runs
+    containers.pop()
+    shipper.update_followers()
+    assert set(shipper.followers) == {'one'}
+    assert shipper.followers['one'].last_stamp == '2024-05-01T10:00:00.4Z'
+
+
+def test_failed_batches_are_dropped(tmpdir):
+    """A sink that fails drops the batch with counters, the file sink writes gzip members."""
+    def failing_sink(lines):
+        raise OSError('master unreachable')
+    containers = [mock_container(UUID1, 'v1', id='one')]
+    shipper = LogShipper(list_containers=lambda: containers,
+                         logs=lambda container_id, since: iter(stream(b'a', b'b')),
+                         sink=failing_sink)
+    shipper.update_followers()
+    shipper.followers['one'].join(1)
+    shipper.flush()
+    assert shipper.stats['lines_failed'] == 2 and shipper.stats['batches_failed'] == 1
+
+    path = str(tmpdir.join('logs.jsonl.gz'))
+    sink = FileSink(path, max_bytes=1)
+    sink([{'line': 'a'}])
+    sink([{'line': 'b'}, {'line': 'c'}])
+    with gzip.open(path) as log_file:
+        assert [json.loads(line)['line'] for line in log_file] == ['b', 'c']
+    with gzip.open(path + '.1') as log_file:
+        assert [json.loads(line)['line'] for line in log_file] == ['a']
@@ -0,0 +1,25 @@
+from threading import Thread
+
+from halti_agent.mailbox import DesiredStateMailbox
+
+
+def test_mailbox_keeps_only_latest():
+    """Putting twice before a get should drop the first item."""
+    mailbox = DesiredStateMailbox()
+    mailbox.put({'services': [], 'n': 1})
+    mailbox.put({'services': [], 'n': 2})
+
+    assert mailbox.qsize() == 1
+    assert mailbox.get() == {'services': [], 'n': 2}
+    assert mailbox.dropped == 1
+    assert mailbox.qsize() == 0
+    assert mailbox.get(timeout=0.01) is None
+
+
+def test_mailbox_get_blocks_until_put():
+    """get should wake up when another thread puts an item."""
+    mailbox = DesiredStateMailbox()
+    putter = Thread(target=mailbox.put, args=({'services': []},))
+    putter.start()
+    assert mailbox.get(timeout=1) == {'services': []}
+    putter.join()
@@ -0,0 +1,63 @@
+import socket
+
+import pytest
+
+from halti_agent import metrics
+
+
+def test_disabled_metrics_are_not_recorded():
+    metrics.ENABLED = False
+    registry = metrics.registry
+    with metrics.timed('disabled_seconds'):
+        pass
+    metrics.inc('disabled_total')
+    assert 'disabled_seconds' not in registry.histograms
+    assert 'disabled_total' not in registry.counters
+
+
+def test_render_exposition_format():
+    """Counters, histograms and gauges should render in the Prometheus text format."""
+    metrics.ENABLED = True
+    try:
+        metrics.inc('docker_calls_total', call='pull')
+        metrics.inc('docker_calls_total', 2, call='pull')
+        metrics.observe('pull_seconds', 0.3, image='hello')
+        metrics.gauge('queue_depth', lambda: 1)
+        text = metrics.registry.render()
+    finally:
+        metrics.ENABLED = False
+
+    assert 'halti_agent_docker_calls_total{call="pull"} 3.0' in text
+    assert 'halti_agent_pull_seconds_bucket{image="hello",le="0.25"} 0' in text
+    assert 'halti_agent_pull_seconds_bucket{image="hello",le="0.5"} 1' in text
+    assert 'halti_agent_pull_seconds_count{image="hello"} 1' in text
+    assert '# TYPE halti_agent_queue_depth gauge\nhalti_agent_queue_depth 1' in text
+
+
+def test_span_collects_children():
+    span = metrics.Span('reconcile')
+    with span:
+        span.add('start foo', 0.5)
+    assert str(span).startswith('reconcile ') and str(span).endswith('[start foo 0.500s]')
+
+
+def test_exporter_rebinds_stale_socket(tmpdir, monkeypatch):
+    """A socket left by a previous process is replaced, one in use is not."""
+    path = str(tmpdir.join('metrics.sock'))
+    monkeypatch.setattr(metrics.settings, 'METRICS_PORT', None)
+    monkeypatch.setattr(metrics.settings, 'METRICS_SOCKET', path)
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(path)
+    stale.close()
+
+    servers = metrics.start_exporter()
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(path)
+            assert client.makefile('rb').read().endswith(b'\n')
+        with pytest.raises(OSError):
+            metrics.start_exporter()
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
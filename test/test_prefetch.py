@@ -0,0 +1,91 @@
+from threading import Event
+from time import sleep
+
+from halti_agent import settings
+from halti_agent.prefetch import Prefetcher, prefetch_images
+from halti_agent.pulls import PullManager
+
+from test_pulls import FakeDocker
+
+
+def wait_for(predicate, timeout=2):
+    for _ in range(int(timeout / 0.01)):
+        if predicate():
+            return True
+        sleep(0.01)
+    return False
+
+
+def test_prefetch_images(monkeypatch):
+    """Advertised images are prefetched, desired services only if enabled."""
+    state = {'prefetch': ['next:v2'], 'services': [{'image': 'current:v1'}]}
+    assert prefetch_images(state) == ['next:v2']
+    assert prefetch_images({}) == []
+
+    monkeypatch.setattr(settings, 'PREFETCH_DESIRED', True)
+    assert prefetch_images(state) == ['next:v2', 'current:v1']
+
+
+def test_prefetcher_yields_to_reconciliation(monkeypatch):
+    """Prefetching should wait while statekeeper is reconciling."""
+    monkeypatch.setattr(settings, 'PREFETCH_IDLE_POLL', 0.01)
+    docker = FakeDocker()
+    manager = PullManager(docker.pull, docker.inspect)
+    reconciling = Event()
+    reconciling.set()
+
+    prefetcher = Prefetcher(manager, busy=reconciling.is_set)
+    prefetcher.start()
+    prefetcher.offer(['tutum/hello-world', 'tutum/hello-world'])
+    sleep(0.05)
+    assert docker.pulls == 0
+
+    reconciling.clear()
+    assert wait_for(lambda: manager.stats['prefetches'] == 1)
+    assert docker.pulls == 1
+
+    # the same image is not offered twice
+    prefetcher.offer(['tutum/hello-world'])
+    sleep(0.05)
+    assert docker.pulls == 1
+
+
+def test_prefetcher_bandwidth_budget(monkeypatch):
+    """Prefetching pauses once the bytes per minute budget is used."""
+    monkeypatch.setattr(settings, 'PREFETCH_IDLE_POLL', 0.01)
+    docker = FakeDocker()
+    docker.inspect = lambda image: None
+    manager = PullManager(docker.pull, docker.inspect)
+
+    prefetcher = Prefetcher(manager, max_bytes_per_minute=1000)
+    prefetcher.start()
+    prefetcher.offer(['first', 'second'])
+    assert wait_for(lambda: docker.pulls == 1)
+    sleep(0.05)
+    assert docker.pulls == 1
+
+
+def test_prefetcher_offers_images_again_after_ttl():
+    """An image is prefetched again once its offer has expired, e.g. after image GC."""
+    docker = FakeDocker()
+    docker.inspect = lambda image: None
+    manager = PullManager(docker.pull, docker.inspect, ttl=0)
+
+    prefetcher = Prefetcher(manager, seen_ttl=0.05)
+    prefetcher.start()
+    prefetcher.offer(['first'])
+    prefetcher.offer(['first'])
+    assert wait_for(lambda: docker.pulls == 1)
+    sleep(0.06)
+    prefetcher.offer(['first'])
+    assert wait_for(lambda: docker.pulls == 2)
+
+    # only seen_size offers are remembered
+    prefetcher = Prefetcher(manager, seen_ttl=60, seen_size=1)
+    prefetcher.start()
+    prefetcher.offer(['first', 'first'])
+    prefetcher.offer(['second'])
+    prefetcher.offer(['first'])
+    assert wait_for(lambda: docker.pulls == 5)
+    sleep(0.05)
+    assert docker.pulls == 5
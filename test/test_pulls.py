@@ -0,0 +1,138 @@
+from threading import Event, Thread
+from time import sleep
+
+from halti_agent.pulls import PullManager, ALWAYS, IF_NOT_PRESENT, DIGEST_PINNED
+
+IMAGE_INFO = {'Id': 'sha256:abc', 'RepoDigests': ['tutum/hello-world@sha256:def']}
+
+
+class FakeDocker(object):
+    """Fake pull/inspect functions for PullManager."""
+
+    def __init__(self, present=False, release=None):
+        self.present = present
+        self.release = release
+        self.pulls = 0
+
+    def pull(self, image):
+        self.pulls += 1
+        if self.release is not None:
+            self.release.wait(1)
+        self.present = True
+        return 1024
+
+    def inspect(self, image):
+        return IMAGE_INFO if self.present else None
+
+
+def test_always_pulls_once_within_ttl():
+    """Repeated ensure within the TTL should hit the cache."""
+    docker = FakeDocker()
+    manager = PullManager(docker.pull, docker.inspect, ttl=60)
+
+    assert manager.ensure('tutum/hello-world', ALWAYS) == 'tutum/hello-world@sha256:def'
+    assert manager.ensure('tutum/hello-world', ALWAYS) == 'tutum/hello-world@sha256:def'
+    assert docker.pulls == 1
+    assert manager.stats['cache_hits'] == 1
+    assert manager.stats['bytes_pulled'] == 1024
+
+    manager = PullManager(docker.pull, docker.inspect, ttl=0)
+    manager.ensure('tutum/hello-world', ALWAYS)
+    manager.ensure('tutum/hello-world', ALWAYS)
+    assert docker.pulls == 3
+
+
+def test_if_not_present_uses_local_image():
+    """if-not-present and digest-pinned should not pull images that exist locally."""
+    docker = FakeDocker(present=True)
+    manager = PullManager(docker.pull, docker.inspect, ttl=0)
+
+    manager.ensure('tutum/hello-world', IF_NOT_PRESENT)
+    manager.ensure('tutum/hello-world@sha256:def', DIGEST_PINNED)
+    assert docker.pulls == 0
+    assert manager.stats['local_hits'] == 2
+
+    # unpinned image falls back to always
+    manager.ensure('tutum/hello-world', DIGEST_PINNED)
+    assert docker.pulls == 1
+
+
+def test_concurrent_pulls_are_coalesced():
+    """Concurrent ensures of the same image should share one pull."""
+    release = Event()
+    docker = FakeDocker(release=release)
+    manager = PullManager(docker.pull, docker.inspect, ttl=0)
+
+    threads = [Thread(target=manager.ensure, args=('tutum/hello-world',)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for _ in range(1000):
+        if manager.stats['coalesced'] == 3:
+            break
+        sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert docker.pulls == 1
+
+
+def test_prefetched_image_counts_a_hit():
+    """A prefetched image should be counted as a hit once statekeeper needs it."""
+    docker = FakeDocker()
+    manager = PullManager(docker.pull, docker.inspect, ttl=60)
+
+    manager.ensure('tutum/hello-world', IF_NOT_PRESENT, prefetch=True)
+    assert manager.stats['prefetches'] == 1
+    assert manager.active_pulls == 0
+
+    manager.ensure('tutum/hello-world', IF_NOT_PRESENT)
+    manager.ensure('tutum/hello-world', IF_NOT_PRESENT)
+    assert docker.pulls == 1
+    assert manager.stats['prefetch_hits'] == 1
+
+    # a prefetch that expired before it was needed is not a hit
+    manager = PullManager(docker.pull, docker.inspect, ttl=0)
+    manager.ensure('tutum/hello-world', ALWAYS, prefetch=True)
+    manager.ensure('tutum/hello-world', ALWAYS)
+    manager.ensure('tutum/hello-world', ALWAYS)
+    assert docker.pulls == 4
+    assert manager.stats['prefetches'] == 1 and manager.stats['prefetch_hits'] == 0
+
+
+def test_paused_holds_back_pulls():
+    """Pulls should wait while the manager is paused."""
+    docker = FakeDocker()
+    manager = PullManager(docker.pull, docker.inspect)
+
+    with manager.paused():
+        puller = Thread(target=manager.ensure, args=('tutum/hello-world',))
+        puller.start()
+        sleep(0.05)
+        assert docker.pulls == 0
+    puller.join(1)
+    assert docker.pulls == 1
+
+
+def test_failed_pull_is_cached():
+    """A failed pull is not repeated within the negative TTL."""
+    docker = FakeDocker()
+    attempts = []
+
+    def failing_pull(image):
+        attempts.append(image)
+        raise Exception('manifest unknown')
+
+    manager = PullManager(failing_pull, docker.inspect, negative_ttl=60)
+    for _ in range(3):
+        try:
+            manager.ensure('tutum/hello-world:nope')
+            assert False
+        except Exception as ex:
+            assert str(ex) == 'manifest unknown'
+    assert len(attempts) == 1
+    assert manager.stats['negative_hits'] == 2
+
+    manager.forget('tutum/hello-world:nope')
+    manager._pull = docker.pull
+    assert manager.ensure('tutum/hello-world:nope')
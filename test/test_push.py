@@ -0,0 +1,113 @@
+from queue import Queue
+import json
+from time import sleep
+
+import websocket
+
+from halti_agent import settings
+from halti_agent.push import PushChannel, push_url
+
+
+class FakeWebSocket(object):
+    """WebSocket that returns queued messages and records sent ones."""
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.sent = []
+        self.closed = False
+
+    def settimeout(self, timeout):
+        pass
+
+    def recv(self):
+        message = self.messages.get()
+        if message is TimeoutError:
+            raise websocket.WebSocketTimeoutException('timed out')
+        return message
+
+    def send(self, data):
+        self.sent.append(json.loads(data))
+
+    def close(self):
+        self.closed = True
+
+
+def test_push_url(monkeypatch):
+    monkeypatch.setattr(settings, 'HALTI_SERVER_URL', 'https://master:4040')
+    assert push_url('foo') == 'wss://master:4040/api/v1/instances/foo/push'
+
+
+def test_push_channel_delivers_desired_state():
+    """Pushed desired states are delivered, and the channel pings while idle."""
+    messages = Queue()
+    states = []
+    sockets = []
+
+    def connect(url):
+        sockets.append(FakeWebSocket(messages))
+        return sockets[-1]
+
+    channel = PushChannel('ws://master/push', states.append, connect=connect)
+    channel.start()
+    assert not channel.is_authoritative()
+
+    messages.put('not json')
+    messages.put(json.dumps({'type': 'desired_state', 'state': {'services': []}}))
+    messages.put(TimeoutError)
+    sleep(0.05)
+    assert states == [{'services': []}]
+    assert channel.is_authoritative()
+    # heartbeats deliver the pushed state again, e.g. for the statekeeper to resync
+    assert channel.redeliver()
+    assert states == [{'services': []}, {'services': []}]
+    assert channel.send_container_event('abc', 'die')
+    assert sockets[0].sent == [{'type': 'ping'},
+                               {'type': 'container_event', 'id': 'abc', 'action': 'die'}]
+
+    # closed by master: heartbeats are the source of desired state until the next push
+    messages.put('')
+    sleep(0.05)
+    assert sockets[0].closed
+    assert not channel.is_authoritative()
+    assert not channel.send({'type': 'ping'})
+    assert not channel.redeliver()
+
+    # and reconnects after a backoff
+    for _ in range(100):
+        if channel.connected.is_set():
+            break
+        sleep(0.01)
+    assert len(sockets) == 2 and channel.connected.is_set()
+
+
+def test_push_channel_survives_bad_messages_and_silence():
+    """Invalid messages and failing callbacks are skipped, a silent socket is closed."""
+    messages = Queue()
+    states = []
+    sockets = []
+
+    def on_desired_state(state):
+        states.append(state)
+        if state.get('fail'):
+            raise RuntimeError('apply failed')
+
+    def connect(url):
+        sockets.append(FakeWebSocket(messages))
+        return sockets[-1]
+
+    channel = PushChannel('ws://master/push', on_desired_state, connect=connect)
+    channel.start()
+    for message in ({'type': 'desired_state'}, [1, 2], {'type': 'desired_state', 'state': 'x'},
+                    {'type': 'desired_state', 'state': {'fail': True}},
+                    {'type': 'desired_state', 'state': {'services': []}}):
+        messages.put(json.dumps(message))
+    sleep(0.05)
+    assert states == [{'fail': True}, {'services': []}]
+    assert channel.is_alive() and channel.is_authoritative()
+
+    # a ping without an answer within the interval drops the socket
+    messages.put(TimeoutError)
+    messages.put(TimeoutError)
+    sleep(0.05)
+    assert sockets[0].sent == [{'type': 'ping'}]
+    assert sockets[0].closed and not channel.is_authoritative()
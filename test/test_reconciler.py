@@ -0,0 +1,95 @@
+from threading import Lock
+from time import sleep
+
+from halti_agent.reconciler import Reconciler, plan_actions, STOP, PULL, START, UPDATE
+
+from test_statekeeper import mock_container, mock_service, UUID1, UUID2, UUID3
+
+
+class RecordingContainerClient(object):
+    """container_client that records the order of calls and max concurrency."""
+
+    def __init__(self):
+        self.calls = []
+        self.lock = Lock()
+        self.running = self.max_running = 0
+
+    def _enter(self, call):
+        with self.lock:
+            self.calls.append(call)
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+
+    def _exit(self):
+        with self.lock:
+            self.running -= 1
+
+    def stop_and_remove(self, container_id):
+        self._enter(('stop', container_id))
+        sleep(0.01)
+        self._exit()
+
+    def pull_image(self, spec):
+        self._enter(('pull', spec['service_id']))
+        sleep(0.01)
+        self._exit()
+        return spec['name'] != 'broken'
+
+    def start_container(self, spec, pull=True):
+        assert pull is False
+        self._enter(('start', spec['service_id']))
+        sleep(0.01)
+        self._exit()
+
+
+def test_plan_actions_orders_stop_before_start():
+    """A service being updated should be stopped before it is started."""
+    current = {UUID1: mock_container(UUID1, 'v1', id='old')}
+    desired = {UUID1: mock_service(UUID1, 'hello1', 'v2')}
+    plan = plan_actions(current, desired, {UUID1}, {UUID1})
+    assert [action for action, _ in plan[UUID1]] == [STOP, START]
+
+
+def test_reconciler_runs_services_concurrently_in_order():
+    """Services run in parallel, but each service stops before it pulls and starts."""
+    current = {UUID1: mock_container(UUID1, 'v1', id='old')}
+    desired = {
+        UUID1: mock_service(UUID1, 'hello1', 'v2'),
+        UUID2: mock_service(UUID2, 'hello2', 'v2'),
+        UUID3: mock_service(UUID3, 'broken', 'v2'),
+    }
+    client = RecordingContainerClient()
+    reconciler = Reconciler(workers=4, max_pulls=1, max_starts=1)
+    timings = reconciler.run(plan_actions(current, desired, {UUID1}, set(desired)), client)
+
+    assert client.calls.index(('stop', 'old')) < client.calls.index(('pull', UUID1))
+    assert client.calls.index(('pull', UUID1)) < client.calls.index(('start', UUID1))
+    assert ('start', UUID3) not in client.calls
+    assert client.max_running > 1
+
+    steps = [(timing.service_id, timing.action) for timing in timings]
+    assert (UUID1, STOP) in steps and (UUID2, PULL) in steps and (UUID2, START) in steps
+    assert all(timing.seconds > 0 and timing.error is None for timing in timings)
+
+
+def test_rolling_update_pulls_before_swapping():
+    """A rolling service should be pulled and updated without a separate stop."""
+    class RollingContainerClient(RecordingContainerClient):
+        def rolling_update(self, container, spec):
+            self._enter(('update', container['Id'], spec['service_id']))
+            self._exit()
+            return True
+
+    rolling = dict(mock_service(UUID1, 'hello1', 'v2'), update_strategy={'type': 'rolling'})
+    current = {UUID1: mock_container(UUID1, 'v1', id='old')}
+    plan = plan_actions(current, {UUID1: rolling}, {UUID1}, {UUID1})
+    assert [action for action, _ in plan[UUID1]] == [UPDATE]
+
+    client = RollingContainerClient()
+    Reconciler().run(plan, client)
+    assert client.calls == [('pull', UUID1), ('update', 'old', UUID1)]
+
+    # clients without rolling_update fall back to stop and start
+    client = RecordingContainerClient()
+    Reconciler().run(plan, client)
+    assert client.calls == [('stop', 'old'), ('pull', UUID1), ('start', UUID1)]
@@ -0,0 +1,38 @@
+from threading import Timer
+import time
+
+from halti_agent.scheduler import HeartbeatScheduler
+
+
+def test_intervals_adapt_to_activity():
+    """Heartbeats should be fast while busy or after a change and slow down when stable."""
+    busy = [True]
+    scheduler = HeartbeatScheduler(10, busy=lambda: busy[0], min_interval=1,
+                                   stable_factor=3, jitter=0)
+    assert scheduler.next_interval() == 1
+
+    busy[0] = False
+    assert [scheduler.next_interval() for _ in range(4)] == [10, 15, 22.5, 30]
+
+    scheduler.poke()
+    fast = [scheduler.next_interval() for _ in range(3)]
+    assert fast == [1, 1, 1]
+    assert scheduler.next_interval() == 10
+
+
+def test_wait_does_not_drift():
+    """Time spent between waits should not push the following slots back."""
+    scheduler = HeartbeatScheduler(0.05, jitter=0)
+    started = time.monotonic()
+    for _ in range(4):
+        time.sleep(0.02)  # a slow heartbeat
+        scheduler.wait()
+    assert time.monotonic() - started < 0.05 * 4 + 0.04
+
+
+def test_poke_wakes_wait_early():
+    scheduler = HeartbeatScheduler(5, min_interval=0.01, jitter=0)
+    Timer(0.05, scheduler.poke).start()
+    started = time.monotonic()
+    scheduler.wait()
+    assert time.monotonic() - started < 1
@@ -0,0 +1,144 @@
+from halti_agent import settings
+from halti_agent.specs import (SpecCompiler, SpecError, compile_spec, reservation,
+                               update_strategy, RECREATE)
+
+from test_statekeeper import mock_service, UUID1
+
+
+def host_config(**kwargs):
+    return dict(kwargs)
+
+
+def test_compile_spec():
+    """Spec should translate to create_container parameters."""
+    spec = dict(mock_service(UUID1, 'hello1', 'v1'),
+                ports=[80, '81', {'protocol': 'udp', 'port': 53, 'source': 5353}],
+                extra_hosts=[{'host': 'db', 'ip': '10.0.0.1'}],
+                command='run')
+    kwargs = compile_spec(spec, host_config).create_kwargs()
+
+    assert kwargs['name'] == UUID1
+    assert kwargs['ports'] == [80, '81', (53, 'udp')]
+    assert kwargs['environment'] == {'PORT': '80', 'HALTI_SERVICE_ID': UUID1}
+    assert kwargs['labels'] == {'halti': 'true', 'service': 'hello1', 'version': 'v1'}
+    assert kwargs['command'] == 'run'
+    assert kwargs['host_config'] == {
+        'restart_policy': {'Name': 'always'},
+        'extra_hosts': {'db': '10.0.0.1'},
+        'port_bindings': {80: (settings.PORT_BIND_IP,),
+                          81: (settings.PORT_BIND_IP,),
+                          '53/udp': (settings.PORT_BIND_IP, 5353)},
+    }
+
+
+def test_compile_spec_collects_all_errors():
+    spec = dict(mock_service(UUID1, 'hello1', 'v1'),
+                ports=[{'protocol': 'sctp', 'port': 80}, 'http'],
+                environment=[{'key': 'PORT'}])
+    try:
+        compile_spec(spec, host_config)
+        assert False, 'SpecError not raised'
+    except SpecError as ex:
+        assert ex.service_id == UUID1
+        assert len(ex.errors) == 3
+
+    try:
+        compile_spec({'service_id': UUID1}, host_config)
+        assert False, 'SpecError not raised'
+    except SpecError as ex:
+        assert 'missing image' in ex.errors
+
+
+def test_compiler_caches_by_version_and_content():
+    calls = []
+    compiler = SpecCompiler(lambda **kwargs: calls.append(kwargs) or kwargs, max_entries=2)
+    spec = mock_service(UUID1, 'hello1', 'v1')
+
+    assert compiler.compile(spec) is compiler.compile(dict(spec))
+    assert len(calls) == 1 and compiler.hits == 1
+
+    compiler.compile(dict(spec, image='tutum/hello-world:2'))
+    compiler.compile(dict(spec, version='v2'))
+    assert len(calls) == 3
+    # the first spec has been evicted
+    compiler.compile(spec)
+    assert len(calls) == 4
+
+
+def test_compile_spec_resources():
+    """Resource limits should be passed to the host config."""
+    spec = dict(mock_service(UUID1, 'hello1', 'v1'), resources={
+        'memory': '512m', 'cpu_shares': 512, 'cpus': 1.5, 'pids_limit': 100,
+        'ulimits': [{'name': 'nofile', 'soft': 1024, 'hard': 2048}]})
+    params = compile_spec(spec, host_config)
+    assert params.exclusive_cpus == 0
+    config = params.host_config
+    assert config['mem_limit'] == '512m'
+    assert (config['cpu_quota'], config['cpu_period']) == (150000, 100000)
+    assert config['cpu_shares'] == 512 and config['pids_limit'] == 100
+    assert config['ulimits'] == [{'name': 'nofile', 'soft': 1024, 'hard': 2048}]
+
+    spec['resources'] = {'exclusive_cpus': 2}
+    params = compile_spec(spec, host_config)
+    kwargs = params.create_kwargs(cpuset='2,3')
+    assert params.exclusive_cpus == 2
+    assert kwargs['host_config']['CpusetCpus'] == '2,3'
+    assert kwargs['labels']['cpuset'] == '2,3'
+    # the shared host config is not modified
+    assert 'CpusetCpus' not in params.host_config
+
+    spec['resources'] = {'memory': '1x', 'cpus': -1, 'cpuset_cpus': 'all', 'pids_limit': '5',
+                         'ulimits': [{'soft': 1}]}
+    try:
+        compile_spec(spec, host_config)
+        assert False
+    except SpecError as ex:
+        assert len(ex.errors) == 5
+
+
+def test_service_memory_and_cpu_limit_the_container(monkeypatch):
+    """If enforced, the service's memory and cpu are the defaults of resources."""
+    spec = mock_service(UUID1, 'hello1', 'v1')
+    # reserved but not enforced by default
+    assert 'mem_limit' not in compile_spec(spec, host_config).host_config
+    compile_spec(dict(spec, memory='lots'), host_config)
+    assert reservation(spec) == (100 * 1024 ** 2, 0.1)
+    assert reservation(dict(spec, memory=0, cpu=None)) == (0, 0)
+
+    monkeypatch.setattr(settings, 'ENFORCE_SERVICE_LIMITS', True)
+    config = compile_spec(spec, host_config).host_config
+    assert (config['mem_limit'], config['cpu_quota']) == (100 * 1024 ** 2, 10000)
+
+    spec['resources'] = {'memory': '1g', 'cpus': 2}
+    config = compile_spec(spec, host_config).host_config
+    assert (config['mem_limit'], config['cpu_quota']) == ('1g', 200000)
+    assert reservation(spec) == (1024 ** 3, 2)
+
+    spec['resources'] = {'exclusive_cpus': 3}
+    config = compile_spec(spec, host_config).host_config
+    assert 'cpu_quota' not in config and config['mem_limit'] == 100 * 1024 ** 2
+    assert reservation(spec) == (100 * 1024 ** 2, 3)
+
+    try:
+        compile_spec(dict(spec, memory='lots', cpu=-1), host_config)
+        assert False, 'SpecError not raised'
+    except SpecError as ex:
+        assert ex.errors == ["invalid memory 'lots'", 'invalid cpu -1']
+
+
+def test_invalid_update_strategy():
+    """An invalid update_strategy is a SpecError, planning falls back to recreate."""
+    for strategy in ({'type': 'rolling', 'max_surge': '25%'}, 'rolling',
+                     {'type': 'rolling', 'max_unavailable': -1},
+                     {'type': 'canary'}, {'ready_timeout': 'soon'}):
+        spec = dict(mock_service(UUID1, 'hello1', 'v1'), update_strategy=strategy)
+        try:
+            compile_spec(spec, host_config)
+            assert False, 'SpecError not raised'
+        except SpecError as ex:
+            assert len(ex.errors) == 1
+        assert update_strategy(spec) == (RECREATE, 1, 0, settings.READY_TIMEOUT)
+
+    spec = dict(mock_service(UUID1, 'hello1', 'v1'),
+                update_strategy={'type': 'rolling', 'max_surge': '2', 'ready_timeout': 5})
+    assert update_strategy(spec) == ('rolling', 2, 0, 5.0)
@@ -8,7 +8,7 @@ from halti_agent.state import platform_state
 
 def test_platform_state():
     """Test platform_state returns JSON serialisable data with correct keys."""
-    docker_client = Client(**settings.DOCKER_OPTIONS)
+    docker_client = Client(**settings.docker_options())
     data = platform_state(docker_client)
 
     assert {'info', 'system', 'docker_client'} == set(data.keys())
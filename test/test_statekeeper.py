@@ -160,3 +160,126 @@ def test_statekeeper_thread():
     assert container_client.list_called == 1
     assert container_client.stop_and_remove_called == 1
     assert container_client.start_called == 3
+
+
+def test_statekeeper_skips_unchanged_desired_state():
+    """The same desired state should be applied only once within the resync interval."""
+
+    class CountingContainerClient(object):
+        list_called = 0
+
+        def list_containers(self):
+            self.list_called += 1
+            return []
+
+        def start_container(self, spec):
+            pass
+
+    mock_queue = Queue()
+    container_client = CountingContainerClient()
+    statekeeper = StatekeeperWorker(mock_queue, container_client=container_client)
+    statekeeper.daemon = True
+    statekeeper.start()
+
+    services = [mock_service(UUID1, 'hello1', 'v1')]
+    mock_queue.put(mock_heartbeat(services))
+    mock_queue.put(dict(mock_heartbeat(services), heartbeat='2016-09-26T10:45:54.605Z'))
+    mock_queue.join()
+
+    assert container_client.list_called == 1
+    assert statekeeper.skipped == 1
+
+
+def test_set_state_survives_invalid_specs():
+    """Invalid services are left alone while the valid ones are started."""
+    from halti_agent.statekeeper import set_state
+
+    class StartingContainerClient(object):
+        started = []
+
+        def list_containers(self):
+            return [mock_container(UUID3, 'v1')]
+
+        def start_container(self, spec):
+            self.started.append(spec['service_id'])
+            return True
+
+    services = [
+        dict(mock_service(UUID1, 'hello1', 'v1'),
+             update_strategy={'type': 'rolling', 'max_surge': '25%'}),
+        mock_service(UUID2, 'hello2', 'v1'),
+        {'service_id': UUID3, 'name': 'hello3'},
+        'garbage',
+    ]
+    container_client = StartingContainerClient()
+    set_state(mock_heartbeat(services), container_client)
+    # UUID3 has no version, its running container is kept
+    assert sorted(container_client.started) == [UUID1, UUID2]
+
+
+def test_invalid_specs_are_not_journaled(tmpdir):
+    """Only valid services are journaled, an older journal with invalid ones still warm starts."""
+    from halti_agent.journal import StateJournal
+
+    valid = mock_service(UUID1, 'hello1', 'v1')
+    invalid = {'service_id': UUID2, 'name': 'bad'}
+    journal = StateJournal(str(tmpdir.join('journal.jsonl')), 10)
+    statekeeper = StatekeeperWorker(Queue(), container_client=None, journal=journal)
+    statekeeper.record_applied(mock_heartbeat([valid, invalid, 'garbage']), [])
+    assert journal.last_applied()['services'] == [valid]
+
+    journal.record('fingerprint', [valid, invalid, 'garbage'])
+    statekeeper = StatekeeperWorker(Queue(), container_client=None, journal=journal)
+    assert statekeeper.warm_start([mock_container(UUID1, 'v1')])
+    assert statekeeper.verify_state == {'services': [valid]}
+
+
+def test_statekeeper_resumes_from_journal(tmpdir):
+    """A journaled desired state is skipped only if the running containers match it."""
+    from halti_agent.journal import StateJournal
+    from halti_agent.statekeeper import desired_state_fingerprint
+
+    services = [mock_service(UUID1, 'hello1', 'v1')]
+    journal = StateJournal(str(tmpdir.join('journal.jsonl')), 10)
+    journal.record(desired_state_fingerprint(mock_heartbeat(services)), services)
+
+    statekeeper = StatekeeperWorker(Queue(), container_client=None, journal=journal)
+    assert not statekeeper.is_applied(mock_heartbeat(services))
+    # nothing runs, e.g. the node was rebooted
+    assert not statekeeper.warm_start([])
+    assert not statekeeper.is_applied(mock_heartbeat(services))
+
+    assert statekeeper.warm_start([mock_container(UUID1, 'v1')])
+    assert statekeeper.is_applied(mock_heartbeat(services))
+    assert not statekeeper.is_applied(mock_heartbeat([mock_service(UUID1, 'hello1', 'v2')]))
+
+
+def test_statekeeper_warm_start(tmpdir):
+    """Matching containers make the node ready before the deferred verification."""
+    from halti_agent.journal import StateJournal
+
+    class VerifyingContainerClient(object):
+        list_called = 0
+
+        def list_containers(self):
+            self.list_called += 1
+            return [mock_container(UUID1, 'v1')]
+
+    services = [mock_service(UUID1, 'hello1', 'v1')]
+    journal = StateJournal(str(tmpdir.join('journal.jsonl')), 10)
+    journal.record('fingerprint', services)
+
+    container_client = VerifyingContainerClient()
+    statekeeper = StatekeeperWorker(Queue(), container_client=container_client, journal=journal)
+    assert not statekeeper.warm_start([mock_container(UUID1, 'v0')])
+    assert not statekeeper.ready.is_set()
+
+    assert statekeeper.warm_start([mock_container(UUID1, 'v1')])
+    assert statekeeper.ready.is_set()
+    assert container_client.list_called == 0
+
+    statekeeper.daemon = True
+    statekeeper.start()
+    sleep(0.05)
+    assert container_client.list_called == 1
+    assert statekeeper.verify_state is None
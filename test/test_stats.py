@@ -0,0 +1,68 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import sleep
+
+from halti_agent.stats import RingBuffer, StatsSampler, parse_sample
+
+from test_statekeeper import mock_container
+
+
+def docker_sample(total_usage, rx_bytes):
+    return {
+        'cpu_stats': {'cpu_usage': {'total_usage': total_usage, 'percpu_usage': [0, 0]},
+                      'system_cpu_usage': 2000},
+        'precpu_stats': {'cpu_usage': {'total_usage': 0}, 'system_cpu_usage': 1000},
+        'memory_stats': {'usage': 300, 'stats': {'cache': 100}},
+        'networks': {'eth0': {'rx_bytes': rx_bytes, 'tx_bytes': 0}},
+        'blkio_stats': {'io_service_bytes_recursive': [{'op': 'Read', 'value': 5},
+                                                       {'op': 'Write', 'value': 7}]},
+    }
+
+
+def test_parse_sample():
+    parsed = parse_sample(docker_sample(total_usage=250, rx_bytes=10))
+    assert parsed['cpu_percent'] == 50.0
+    assert parsed['memory_bytes'] == 200
+    assert parsed['net_rx_bytes'] == 10
+    assert (parsed['blkio_read_bytes'], parsed['blkio_write_bytes']) == (5, 7)
+    assert parse_sample({})['cpu_percent'] == 0.0
+
+
+def test_ring_buffer_keeps_latest_values():
+    buffer = RingBuffer(4)
+    assert buffer.summary() is None
+    for value in range(10):
+        buffer.append(value)
+    assert sorted(buffer.values()) == [6, 7, 8, 9]
+    assert buffer.summary() == {'p50': 8, 'p95': 9, 'max': 9}
+
+
+def test_sampler_bounded_concurrency():
+    """All containers are sampled, but no more than workers at once."""
+    lock = Lock()
+    running = {'now': 0, 'max': 0}
+    containers = [mock_container('service{}'.format(i), 'v1', id=str(i)) for i in range(8)]
+
+    def stats(container_id):
+        with lock:
+            running['now'] += 1
+            running['max'] = max(running['max'], running['now'])
+        sleep(0.01)
+        with lock:
+            running['now'] -= 1
+        return docker_sample(total_usage=int(container_id) * 100, rx_bytes=1000)
+
+    sampler = StatsSampler(lambda: containers, stats, workers=2, window=5)
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        sampler.sample(pool)
+        sampler.sample(pool)
+        summary = sampler.summary()
+        assert set(summary) == {'service{}'.format(i) for i in range(8)}
+        assert summary['service1']['cpu_percent']['max'] == 20.0
+        # counters become rates once there are two samples
+        assert summary['service1']['net_rx_bytes']['max'] == 0
+
+        containers.pop()
+        sampler.sample(pool)
+        assert 'service7' not in sampler.summary()
+    assert running['max'] == 2